@@ -0,0 +1,241 @@
+"""
+Alternating Least Squares solver for the factor matrices, an alternative to the feature-wise SGD of SVDNetflix.
+
+Each sweep fixes the movies matrix and solves, for every user, the regularized least squares problem
+
+    min_p  sum_{j rated by u} (r_uj - p . q_j)^2 + regularizeParameter * n_u * |p|^2
+
+which is the objective minimized by SGD, with n_u the number of ratings of the user. Then users are fixed and movies
+are solved the same way. Every row is a k * k linear system: systems of a chunk of rows are built with vectorized
+sums over their ratings and solved at once with batched np.linalg.solve. Chunks are spread over a process pool,
+started once per training: ratings (by user and by movie) and both factor matrices live in shared memory
+(see shared_workers), so workers read the fixed matrix and write their rows of the solved one in place.
+
+Temporary arrays hold k * k values per rating, so chunks are sized from a memory budget: a chunk has at most
+chunkMemory / (8 * k * k) rows and its ratings are summed in blocks of that many ratings, however many ratings its rows
+have.
+"""
+
+import numpy as np
+from scipy import sparse
+
+import instrumentation
+import shared_workers
+from shared_workers import SharedWorkers
+
+# Ratings read, factor matrix fixed and factor matrix solved by each half of a sweep
+SIDES = {
+    "users": ("byUser", "moviesPreferences", "usersPreferences"),
+    "movies": ("byMovie", "usersPreferences", "moviesPreferences"),
+}
+
+# (regularizeParameter, blockSize) of every worker process
+_workerParameters = None
+
+
+def _set_parameters(parameters):
+    """
+    Initializer of the worker processes, once attached to the shared arrays: keep the parameters of the solver.
+    :param parameters: (regularizeParameter, blockSize)
+    """
+    global _workerParameters
+    _workerParameters = parameters
+
+
+def _solve_chunk(task):
+    """
+    Solve the rows of a chunk in the shared arrays.
+    :param task: (side, start, end)
+    """
+    side, start, end = task
+    solve_side(shared_workers.workerArrays, side, start, end, *_workerParameters)
+
+
+def solve_side(arrays, side, start, end, regularizeParameter, blockSize):
+    """
+    Solve a range of rows of one side and write them in its factor matrix.
+    :param arrays: dictionary with the ratings (<name>Indptr, <name>Indices, <name>Data) and factor matrices
+    :param side: "users" or "movies" (see SIDES)
+    :param start: first row
+    :param end: row after the last one
+    :param regularizeParameter: regularization
+    :param blockSize: number of ratings summed at once
+    """
+    ratings, fixed, solved = SIDES[side]
+
+    arrays[solved][start:end] = solve_rows(arrays[ratings + "Indptr"], arrays[ratings + "Indices"],
+                                           arrays[ratings + "Data"], arrays[fixed], regularizeParameter, start, end,
+                                           blockSize)
+
+
+def solve_rows(indptr, indices, data, fixed, regularizeParameter, start, end, blockSize=None):
+    """
+    Solve the regularized least squares problem of a range of rows of a sparse matrix.
+    :param indptr: CSR/CSC pointers of the ratings matrix, with the rows to solve as major axis
+    :param indices: indexes in the fixed matrix of every rating
+    :param data: score of every rating
+    :param fixed: factor matrix of the other side, fixed
+    :param regularizeParameter: regularization, scaled by the number of ratings of every row
+    :param start: first row
+    :param end: row after the last one
+    :param blockSize: number of ratings summed at once, which bounds the temporary arrays to blockSize * k * k values.
+    Defaults to every rating of the rows
+    :return: (end - start, k) array of solved rows
+    """
+    numFeatures = fixed.shape[1]
+    counts = np.diff(indptr[start:end + 1])
+    first, last = indptr[start], indptr[end]
+    blockSize = max(1, blockSize or last - first)
+
+    # Row of every rating of the chunk, relative to start
+    rows = np.repeat(np.arange(end - start), counts)
+
+    # A = sum q q^T + lambda * n * I and b = sum r q, summed per row over contiguous blocks of ratings
+    systems = np.zeros((end - start, numFeatures * numFeatures))
+    targets = np.zeros((end - start, numFeatures))
+
+    for blockStart in range(0, last - first, blockSize):
+        block = slice(blockStart, min(blockStart + blockSize, last - first))
+        factors = fixed[indices[first + block.start:first + block.stop]]
+        blockRows = rows[block]
+
+        # Ratings of a row are contiguous: positions where the row changes
+        boundaries = np.flatnonzero(np.r_[True, blockRows[1:] != blockRows[:-1]])
+        blockRows = blockRows[boundaries]
+
+        outer = np.einsum('ni,nj->nij', factors, factors).reshape(len(factors), numFeatures * numFeatures)
+        systems[blockRows] += np.add.reduceat(outer, boundaries, axis=0)
+        targets[blockRows] += np.add.reduceat(factors * data[first + block.start:first + block.stop, None],
+                                              boundaries, axis=0)
+
+    systems = systems.reshape(end - start, numFeatures, numFeatures)
+    systems += (regularizeParameter * np.maximum(counts, 1))[:, None, None] * np.eye(numFeatures)
+
+    return np.linalg.solve(systems, targets[:, :, None])[:, :, 0]
+
+
+class ALSSolver:
+    """
+    Alternating Least Squares over every feature at once.
+    """
+
+    name = "als"
+
+    def __init__(self, numSweeps=10, numWorkers=1, chunkMemory=256 * 2 ** 20, noise=0.01, seed=0):
+        """
+        :param numSweeps: number of sweeps (users then movies)
+        :param numWorkers: number of processes solving chunks of rows
+        :param chunkMemory: bytes of the temporary arrays of a chunk of rows, in every process
+        :param noise: standard deviation of the noise added to the initial movies matrix. With identical features
+        every feature would get the same solution
+        :param seed: seed of the noise
+        """
+        self.numSweeps = numSweeps
+        self.numWorkers = numWorkers
+        self.chunkMemory = chunkMemory
+        self.noise = noise
+        self.seed = seed
+
+        # Wall time and training RMSE of every sweep: (sweep, seconds, rmse)
+        self.sweepTimes = []
+
+    def block_size(self, numFeatures):
+        """
+        Number of rows of a chunk, and of ratings summed at once, within chunkMemory.
+        :param numFeatures: k
+        :return: int
+        """
+        return max(1, self.chunkMemory // (8 * numFeatures * numFeatures))
+
+    def chunks(self, indptr, blockSize):
+        """
+        Split rows in ranges with at most blockSize rows and ratings (or a single row).
+        :param indptr: CSR/CSC pointers
+        :param blockSize: see block_size
+        :return: list of (start, end)
+        """
+        numRows = len(indptr) - 1
+        bounds = [0]
+
+        while bounds[-1] < numRows:
+            start = bounds[-1]
+            end = np.searchsorted(indptr, indptr[start] + blockSize, side='right') - 1
+            bounds.append(int(min(max(end, start + 1), start + blockSize, numRows)))
+
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def solve(self, arrays, side, regularizeParameter, workers=None):
+        """
+        Solve every row of one side, in place.
+        :param arrays: dictionary of the ratings and factor matrices (see solve_side)
+        :param side: "users" or "movies"
+        :param regularizeParameter: regularization
+        :param workers: SharedWorkers attached to the arrays, None to solve in this process
+        """
+        blockSize = self.block_size(arrays["usersPreferences"].shape[1])
+        tasks = [(side, start, end) for (start, end) in self.chunks(arrays[SIDES[side][0] + "Indptr"], blockSize)]
+
+        if workers is not None:
+            workers.map(_solve_chunk, tasks)
+        else:
+            for (_, start, end) in tasks:
+                solve_side(arrays, side, start, end, regularizeParameter, blockSize)
+
+    def fit(self, coordinates, usersPreferences, moviesPreferences, regularizeParameter):
+        """
+        Train both factor matrices, updated in place.
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings to train with
+        :param usersPreferences: users matrix. Overwritten by the first sweep
+        :param moviesPreferences: movies matrix. Its current values plus noise are the starting point
+        :param regularizeParameter: regularization
+        """
+        userIndexes, movieIndexes, scores = coordinates
+        shape = (usersPreferences.shape[0], moviesPreferences.shape[0])
+
+        ratings = sparse.coo_matrix((scores.astype(np.float64), (userIndexes, movieIndexes)), shape=shape)
+        byUser = ratings.tocsr()
+        byMovie = ratings.T.tocsr()
+
+        moviesPreferences += np.random.RandomState(self.seed).normal(0, self.noise, moviesPreferences.shape)
+
+        arrays = {"usersPreferences": usersPreferences, "moviesPreferences": moviesPreferences}
+
+        for name, matrix in (("byUser", byUser), ("byMovie", byMovie)):
+            arrays.update({name + "Indptr": matrix.indptr, name + "Indices": matrix.indices, name + "Data": matrix.data})
+
+        workers = None
+
+        try:
+            if self.numWorkers > 1:
+                workers = SharedWorkers(arrays, self.numWorkers, initializer=_set_parameters,
+                                        initargs=((regularizeParameter, self.block_size(usersPreferences.shape[1])),))
+                arrays = workers.arrays
+
+            self.sweepTimes = []
+
+            for sweep in range(self.numSweeps):
+                with instrumentation.stage("training.als_sweep", sweep=sweep) as timed:
+                    self.solve(arrays, "users", regularizeParameter, workers)
+                    self.solve(arrays, "movies", regularizeParameter, workers)
+
+                errors = scores - np.einsum('ij,ij->i', arrays["usersPreferences"][userIndexes],
+                                            arrays["moviesPreferences"][movieIndexes])
+                rmse = float(np.sqrt(np.mean(np.square(errors))))
+                self.sweepTimes.append((sweep, timed.elapsed, rmse))
+
+                print("ALS sweep {}: RMSE {:.4f} ({:.3f}s)".format(sweep + 1, rmse, timed.elapsed))
+
+            usersPreferences[...] = arrays["usersPreferences"]
+            moviesPreferences[...] = arrays["moviesPreferences"]
+        finally:
+            # Views must be released before closing the memory
+            arrays = None
+
+            if workers is not None:
+                workers.close()
+
+    def close(self):
+        """
+        Release the resources of the solver. Pools only live during a fit.
+        """
+        pass
@@ -0,0 +1,142 @@
+"""
+Content-addressed cache of the artifacts computed by the system: binary datasets, models and similarities.
+
+An artifact is stored in a directory named after a key, which is a hash of the content of its input files and of the
+parameters used to compute it. When an input file or a parameter changes the key changes too, so stale artifacts are
+never reused and several versions of an artifact (for instance models with different hyperparameters) live side by
+side. Only the most recently used entries of each kind are kept.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import model_store
+
+
+class ArtifactCache:
+    """
+    Cache of artifact directories under a root directory.
+
+    root/index.json keeps the content hash of every input file, keyed by path, size and modification time so that big
+    files are only hashed again when they change, and the last use of every entry.
+    """
+
+    def __init__(self, root, maxEntries=3):
+        """
+        :param root: directory of the cache
+        :param maxEntries: number of entries of each kind kept. Least recently used ones are removed
+        """
+        self.root = root
+        self.maxEntries = maxEntries
+        self.indexPath = os.path.join(root, "index.json")
+
+        os.makedirs(root, exist_ok=True)
+
+        if os.path.isfile(self.indexPath):
+            with open(self.indexPath) as file:
+                self.index = json.load(file)
+        else:
+            self.index = {"files": {}, "entries": {}}
+
+    def save_index(self):
+        """
+        Write the index atomically
+        """
+        temporary = self.indexPath + ".tmp"
+
+        with open(temporary, 'w') as file:
+            json.dump(self.index, file)
+
+        os.replace(temporary, self.indexPath)
+
+    def file_hash(self, filename):
+        """
+        Content hash of an input file. Reused while its size and modification time do not change.
+        :param filename: path of the file
+        :return: hexadecimal digest
+        """
+        filename = os.path.abspath(filename)
+        status = os.stat(filename)
+        known = self.index["files"].get(filename)
+
+        if known is None or known["size"] != status.st_size or known["mtime"] != status.st_mtime_ns:
+            print("Hashing {}...".format(filename))
+            known = {"size": status.st_size, "mtime": status.st_mtime_ns, "sha256": model_store.checksum(filename)}
+            self.index["files"][filename] = known
+            self.save_index()
+
+        return known["sha256"]
+
+    def key(self, kind, inputs=(), parameters=None):
+        """
+        Key of an artifact.
+        :param kind: type of artifact ("dataset", "model"...)
+        :param inputs: paths of the files the artifact is computed from
+        :param parameters: JSON serializable parameters of the computation, including keys of other artifacts
+        :return: hexadecimal key
+        """
+        description = {
+            "kind": kind,
+            "inputs": [self.file_hash(filename) for filename in inputs],
+            "parameters": parameters or {},
+        }
+
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()[:32]
+
+    def path(self, kind, key):
+        """
+        Directory of an artifact, whether it exists or not.
+        :param kind: type of artifact
+        :param key: key returned by key()
+        :return: path
+        """
+        return os.path.join(self.root, kind, key)
+
+    def lookup(self, kind, key):
+        """
+        Find a complete artifact and mark it as used.
+        :param kind: type of artifact
+        :param key: key returned by key()
+        :return: directory of the artifact or None if it is not in the cache
+        """
+        path = self.path(kind, key)
+        entry = self.index["entries"].get(kind + "/" + key)
+
+        if entry is None or not os.path.isdir(path):
+            return None
+
+        entry["lastUsed"] = time.time()
+        self.save_index()
+
+        return path
+
+    def commit(self, kind, key):
+        """
+        Register an artifact once its directory has been completely written, and evict the least recently used
+        artifacts of the same kind.
+        :param kind: type of artifact
+        :param key: key returned by key()
+        :return: directory of the artifact
+        """
+        self.index["entries"][kind + "/" + key] = {"lastUsed": time.time()}
+        self.evict(kind, keep=key)
+        self.save_index()
+
+        return self.path(kind, key)
+
+    def evict(self, kind, keep=None):
+        """
+        Remove the least recently used artifacts of a kind beyond maxEntries.
+        :param kind: type of artifact
+        :param keep: key which is never removed
+        """
+        entries = sorted(((entry["lastUsed"], name) for name, entry in self.index["entries"].items()
+                          if name.startswith(kind + "/") and name != kind + "/" + str(keep)), reverse=True)
+
+        for (_, name) in entries[max(0, self.maxEntries - 1):]:
+            print("Removing old artifact {}...".format(name))
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+            del self.index["entries"][name]
@@ -0,0 +1,301 @@
+"""
+Benchmarks of every stage of the pipeline on synthetic datasets.
+
+Datasets are generated with the layout of the csv files in data/: user activity and movie popularity follow power
+laws, as in MovieLens and Netflix, and scores come from a low-rank model plus noise. For every scale the benchmark
+measures wall time and peak memory (tracemalloc) of:
+
+ * csv_load: Reader parsing the csv files
+ * create_ratings_matrix: columnar ratings, users and movies views and sparse ratings matrix
+ * training_epoch: one SGD epoch of the first feature over every rating
+ * query: single user recommendations (SVDNetflix.query), with per query latencies
+ * recommend_batch: batch recommendations (SVDNetflix.recommend_batch)
+
+Results are written as JSON with the commit and library versions, so runs of two commits can be compared:
+
+    python benchmark.py --scales small medium --output before.json
+    python benchmark.py --scales small medium --output after.json --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from chrono import Timer
+
+import config as cfg
+
+# Predefined scales: number of users, number of movies and fraction of rated cells
+SCALES = {
+    "small": {"numUsers": 10000, "numMovies": 1000, "density": 0.01},
+    "medium": {"numUsers": 100000, "numMovies": 5000, "density": 0.002},
+    "large": {"numUsers": 480000, "numMovies": 17770, "density": 0.001},
+}
+
+
+def power_law(size, exponent, random):
+    """
+    Probabilities proportional to rank ** -exponent, assigned to the items in random order.
+    :param size: number of items
+    :param exponent: exponent of the power law. 0 is uniform
+    :param random: numpy RandomState
+    :return: array of probabilities
+    """
+    weights = np.arange(1, size + 1, dtype=np.float64) ** -exponent
+    random.shuffle(weights)
+
+    return weights / weights.sum()
+
+
+def generate_dataset(path, numUsers, numMovies, density, userExponent=0.8, movieExponent=1.0, numFeatures=5,
+                     tagsPerMovie=5, seed=0):
+    """
+    Write a synthetic dataset with the csv files of data/.
+    :param path: directory of the csv files
+    :param numUsers: number of users
+    :param numMovies: number of movies
+    :param density: fraction of (user, movie) cells rated. Repeated cells are dropped, so the final density is lower
+    :param userExponent: exponent of the power law of the number of ratings of each user
+    :param movieExponent: exponent of the power law of the popularity of each movie
+    :param numFeatures: rank of the model which generates the scores
+    :param tagsPerMovie: number of tags of every movie
+    :param seed: seed of the generator
+    :return: number of ratings
+    """
+    random = np.random.RandomState(seed)
+    os.makedirs(path, exist_ok=True)
+
+    userIds = np.arange(1, numUsers + 1)
+    movieIds = np.arange(1, numMovies + 1)
+
+    pd.DataFrame({0: userIds, 1: ["user{}".format(user) for user in userIds]}).to_csv(
+        os.path.join(path, "users.csv"), header=False, index=False)
+    pd.DataFrame({0: movieIds, 1: ["Movie {}".format(movie) for movie in movieIds]}).to_csv(
+        os.path.join(path, "movie-titles.csv"), header=False, index=False)
+    pd.DataFrame({0: np.repeat(movieIds, tagsPerMovie),
+                  1: ["tag{}".format(tag) for tag in random.zipf(1.5, numMovies * tagsPerMovie) % 1000]}).to_csv(
+        os.path.join(path, "movie-tags.csv"), header=False, index=False)
+
+    # Cells drawn from the power laws, without repetitions
+    numRatings = int(density * numUsers * numMovies)
+    users = random.choice(numUsers, numRatings, p=power_law(numUsers, userExponent, random))
+    movies = random.choice(numMovies, numRatings, p=power_law(numMovies, movieExponent, random))
+    cells = np.unique(users.astype(np.int64) * numMovies + movies)
+    random.shuffle(cells)
+    users, movies = cells // numMovies, cells % numMovies
+
+    # Scores of a low-rank model plus noise, in steps of 0.5 between 0.5 and 5
+    userFactors = random.normal(0, 1, (numUsers, numFeatures))
+    movieFactors = random.normal(0, 1, (numMovies, numFeatures))
+    scores = 3 + 0.5 * np.einsum('ij,ij->i', userFactors[users], movieFactors[movies]) + \
+        random.normal(0, 0.5, len(cells))
+    scores = np.clip(np.round(scores * 2) / 2, 0.5, 5.0)
+
+    pd.DataFrame({0: userIds[users], 1: movieIds[movies], 2: scores}).to_csv(
+        os.path.join(path, "ratings.csv"), header=False, index=False)
+
+    return len(cells)
+
+
+def use_dataset(path):
+    """
+    Point the configuration to the csv files and the artifact cache of a directory.
+    :param path: directory of the csv files
+    """
+    cfg.users = os.path.join(path, "users.csv")
+    cfg.movies = os.path.join(path, "movie-titles.csv")
+    cfg.movies_tags = os.path.join(path, "movie-tags.csv")
+    cfg.ratings = os.path.join(path, "ratings.csv")
+    cfg.cache = os.path.join(path, "cache")
+    cfg.trainingLog = os.path.join(path, "training_log.jsonl")
+
+
+def measure(function, *args):
+    """
+    Run a function measuring its wall time and the peak of memory allocated during the call.
+    :return: (result, {"seconds", "peakMemoryMB"})
+    """
+    tracemalloc.start()
+
+    try:
+        with Timer() as timed:
+            result = function(*args)
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return result, {"seconds": timed.elapsed, "peakMemoryMB": peak / 2 ** 20}
+
+
+def run_scale(path, numQueries=200, batchUsers=10000, engineName="auto", seed=0):
+    """
+    Benchmark every stage on the dataset of a directory.
+    :param path: directory of the csv files
+    :param numQueries: number of single user queries
+    :param batchUsers: number of users of the batch recommendation
+    :param engineName: training engine (see training.get_engine)
+    :param seed: seed of the users queried
+    :return: dictionary key=stage value=measures
+    """
+    from data import Reader, create_ratings_matrix
+    from recommender_system import SVDNetflix
+    from training import get_engine
+
+    use_dataset(path)
+    stages = {}
+
+    reader, stages["csv_load"] = measure(Reader)
+
+    def build_matrix():
+        users, movies = reader.get_users(), reader.get_movies()
+        return (users, movies) + create_ratings_matrix(users, movies)
+
+    (users, movies, ratingsMatrix, userIndexes, moviesIndexes), stages["create_ratings_matrix"] = \
+        measure(build_matrix)
+
+    system = SVDNetflix()
+    system.users, system.movies = users, movies
+    system.ratingsMatrix, system.userIndexes, system.moviesIndexes = ratingsMatrix, userIndexes, moviesIndexes
+    system.ratingsCoordinates = system.trainingCoordinates = ratingsMatrix.coo()
+    system.recommendationCache.maxEntries = 0
+    system.init_factors()
+    system.init_cache(0)
+
+    # Warm up the engine on a few ratings, so compilation time is not measured
+    engine = get_engine(engineName)
+    userIndexes, movieIndexes, _ = system.ratingsCoordinates
+    userValue = np.ascontiguousarray(system.usersPreferences[:, 0])
+    movieValue = np.ascontiguousarray(system.moviesPreferences[:, 0])
+    engine.run_epoch(userIndexes[:1000], movieIndexes[:1000], system.cache[:1000], userValue.copy(),
+                     movieValue.copy(), system.learningRate, system.regularizeParameter)
+
+    _, stages["training_epoch"] = measure(engine.run_epoch, userIndexes, movieIndexes, system.cache, userValue,
+                                          movieValue, system.learningRate, system.regularizeParameter)
+    stages["training_epoch"]["engine"] = engine.name
+    stages["training_epoch"]["ratingsPerSecond"] = len(userIndexes) / stages["training_epoch"]["seconds"]
+    engine.close()
+
+    random = np.random.RandomState(seed)
+    userIds = ratingsMatrix.userIds
+    queried = userIds[random.choice(len(userIds), min(numQueries, len(userIds)), replace=False)].tolist()
+
+    def single_queries():
+        latencies = []
+
+        for user in queried:
+            start = time.perf_counter()
+            system.query(user, 10)
+            latencies.append(time.perf_counter() - start)
+
+        return np.asarray(latencies) * 1000.0
+
+    latencies, stages["query"] = measure(single_queries)
+    stages["query"].update({"queries": len(queried), "p50Ms": float(np.percentile(latencies, 50)),
+                            "p99Ms": float(np.percentile(latencies, 99))})
+
+    batch = userIds[random.choice(len(userIds), min(batchUsers, len(userIds)), replace=False)].tolist()
+    _, stages["recommend_batch"] = measure(system.recommend_batch, batch, 10)
+    stages["recommend_batch"]["usersPerSecond"] = len(batch) / stages["recommend_batch"]["seconds"]
+
+    return stages
+
+
+def environment():
+    """
+    Commit and versions the benchmark ran with.
+    :return: dictionary
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline):
+    """
+    Print the ratio of time and peak memory of every stage against a previous run.
+    :param results: dictionary written by this script
+    :param baseline: dictionary written by a previous run
+    """
+    print("Comparison against commit {}:".format(baseline["environment"]["commit"]))
+
+    for scale, current in results["scales"].items():
+        previous = baseline["scales"].get(scale)
+
+        if previous is None:
+            continue
+
+        for stage, measures in current["stages"].items():
+            if stage not in previous["stages"]:
+                continue
+
+            before = previous["stages"][stage]
+            print("{:>8} {:>22}: time x{:.2f}, peak memory x{:.2f}".format(
+                scale, stage, measures["seconds"] / before["seconds"],
+                measures["peakMemoryMB"] / max(before["peakMemoryMB"], 1e-9)))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark every stage of the pipeline on synthetic datasets")
+    parser.add_argument("--scales", nargs="+", default=["small"], choices=sorted(SCALES))
+    parser.add_argument("--users", type=int, help="custom scale: number of users")
+    parser.add_argument("--movies", type=int, help="custom scale: number of movies")
+    parser.add_argument("--density", type=float, default=0.01, help="custom scale: fraction of rated cells")
+    parser.add_argument("--queries", type=int, default=200, help="number of single user queries")
+    parser.add_argument("--batch-users", type=int, default=10000, help="number of users of the batch recommendation")
+    parser.add_argument("--engine", default="auto", help="training engine")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+
+    scales = {name: SCALES[name] for name in arguments.scales}
+
+    if arguments.users and arguments.movies:
+        scales = {"custom": {"numUsers": arguments.users, "numMovies": arguments.movies,
+                             "density": arguments.density}}
+
+    results = {"environment": environment(), "scales": {}}
+
+    for name, parameters in scales.items():
+        with tempfile.TemporaryDirectory(prefix="svd-benchmark-") as path:
+            print("Generating {} dataset {}...".format(name, parameters))
+            numRatings = generate_dataset(path, seed=arguments.seed, **parameters)
+
+            print("Benchmarking {} dataset with {} ratings...".format(name, numRatings))
+            stages = run_scale(path, arguments.queries, arguments.batch_users, arguments.engine, arguments.seed)
+
+        results["scales"][name] = {"parameters": parameters, "numRatings": numRatings, "stages": stages}
+
+        for stage, measures in stages.items():
+            print("{:>8} {:>22}: {:.3f}s, peak memory {:.1f} MB".format(name, stage, measures["seconds"],
+                                                                          measures["peakMemoryMB"]))
+
+    with open(arguments.output, 'w') as file:
+        json.dump(results, file, indent=2)
+
+    print("Results written to {}".format(arguments.output))
+
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(results, json.load(file))
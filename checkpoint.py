@@ -0,0 +1,124 @@
+"""
+Checkpoints of a training in progress, so a stopped training resumes where it stopped (see SVDNetflix.fit).
+
+A checkpoint is an artifact directory (see model_store) written under a temporary name and renamed once complete, so an
+interrupted write never replaces the last complete checkpoint:
+
+    path/checkpoint_00012.tmp/...   being written, removed when found by a later run
+    path/checkpoint_00011/...       factor matrices, residual caches, RNG state; position and optimizer state as metadata
+    path/checkpoint_00010/...
+
+Checkpoints are numbered in the order they are written and only the last `keep` ones are kept.
+"""
+
+import os
+import re
+import shutil
+
+import numpy as np
+
+import model_store
+
+CHECKPOINT = re.compile(r"^checkpoint_(\d+)$")
+
+
+class CheckpointManager:
+    """
+    Directory of the checkpoints of one training.
+    """
+
+    def __init__(self, path, interval=10, keep=2):
+        """
+        :param path: directory of the checkpoints. Created by the first checkpoint
+        :param interval: number of epochs between checkpoints
+        :param keep: number of checkpoints kept, at least 1
+        """
+        self.path = path
+        self.interval = interval
+        self.keep = max(keep, 1)
+        self.numEpochs = 0
+
+    def numbers(self):
+        """
+        Numbers of the complete checkpoints. Checkpoints whose write was interrupted are removed.
+        :return: sorted list of int
+        """
+        numbers = []
+
+        for name in os.listdir(self.path) if os.path.isdir(self.path) else ():
+            match = CHECKPOINT.match(name)
+
+            if match and model_store.exists(os.path.join(self.path, name)):
+                numbers.append(int(match.group(1)))
+            else:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+        return sorted(numbers)
+
+    def epoch_done(self):
+        """
+        Count an epoch.
+        :return: whether a checkpoint is due
+        """
+        self.numEpochs += 1
+
+        return self.interval > 0 and self.numEpochs % self.interval == 0
+
+    def save(self, arrays, metadata):
+        """
+        Write a checkpoint atomically and remove the oldest ones beyond keep.
+        :param arrays: dictionary key=name value=numpy array
+        :param metadata: JSON serializable dictionary
+        :return: directory of the checkpoint
+        """
+        numbers = self.numbers()
+        numbers.append(numbers[-1] + 1 if numbers else 0)
+        path = os.path.join(self.path, "checkpoint_{:05d}".format(numbers[-1]))
+
+        model_store.write_arrays(path + ".tmp", kind="checkpoint", arrays=arrays, metadata=metadata)
+        os.replace(path + ".tmp", path)
+
+        for number in numbers[:-self.keep]:
+            shutil.rmtree(os.path.join(self.path, "checkpoint_{:05d}".format(number)), ignore_errors=True)
+
+        return path
+
+    def latest(self):
+        """
+        Read the last complete checkpoint in memory. Checkpoints whose arrays do not match their checksums are skipped.
+        :return: (metadata, arrays), None if there is no checkpoint
+        """
+        for number in reversed(self.numbers()):
+            try:
+                return model_store.read_arrays(os.path.join(self.path, "checkpoint_{:05d}".format(number)),
+                                               kind="checkpoint", mmapMode=None, verify=True)
+            except model_store.FormatError:
+                continue
+
+        return None
+
+    def clear(self):
+        """
+        Remove every checkpoint, for instance once the training they belong to has finished.
+        """
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def random_state():
+    """
+    State of the global NumPy random generator.
+    :return: (array of the keys, JSON serializable dictionary with the rest of the state)
+    """
+    algorithm, keys, position, hasGauss, cachedGaussian = np.random.get_state()
+
+    return keys, {"algorithm": algorithm, "position": int(position), "hasGauss": int(hasGauss),
+                  "cachedGaussian": float(cachedGaussian)}
+
+
+def set_random_state(keys, state):
+    """
+    Restore the state of the global NumPy random generator returned by random_state.
+    :param keys: array of the keys
+    :param state: dictionary with the rest of the state
+    """
+    np.random.set_state((state["algorithm"], keys, state["position"], state["hasGauss"], state["cachedGaussian"]))
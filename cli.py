@@ -0,0 +1,211 @@
+"""
+Headless command line of the system, one subcommand per stage:
+
+    python cli.py ingest [--shards]              csv files to the binary dataset (or rating shards) in cfg.cache
+    python cli.py train [--engine E] [--shards DIR] [--output DIR] [--resume]
+    python cli.py evaluate [--k 10] [--mode position]
+    python cli.py export [--model DIR] [--output recommendations.csv]
+    python cli.py serve [--model DIR] [--port 8000]
+
+Stages only exchange on-disk artifacts (dataset and model directories, see model_store and artifact_cache), so each one
+can run on a different machine or schedule given the same cache or model directory: a model directory is loaded with
+the dataset it was trained on, found in the cache by the key stored in the model, and csv files are only read by ingest
+and when no dataset is given (--dataset) or known. Modules are imported by the subcommand that uses them: serving or
+exporting a model does not import pandas (only needed to parse csv files), numba (training) or tkinter (gui.py). Every
+subcommand prints its cold start time, from the start of this script to the moment its data and model are loaded, also
+sent to the instrumentation sinks as the "cli.cold_start" timer.
+"""
+
+import time
+
+started = time.perf_counter()
+
+import argparse
+
+import config as cfg
+
+DATASET_HELP = "dataset directory (see ingest). Defaults to the dataset of the model, or to the one of the csv files"
+
+
+def cold_start(command):
+    """
+    Report the time since the script started.
+    :param command: name of the subcommand
+    """
+    import instrumentation
+
+    seconds = time.perf_counter() - started
+    instrumentation.emit({"type": "timer", "name": "cli.cold_start", "seconds": seconds, "command": command})
+    print("{} ready in {:.3f}s".format(command, seconds))
+
+
+def ingest(arguments):
+    """
+    Parse the csv files into the binary dataset of the artifact cache, or into rating shards.
+    """
+    if arguments.shards:
+        import pandas as pd
+
+        from ingest import ingest_ratings
+
+        cold_start("ingest")
+
+        # Users and movies without ratings get an index too, so shards share the indexes of the dataset
+        users = pd.read_csv(cfg.users, header=None, usecols=[0])[0].values
+        movies = pd.read_csv(cfg.movies, header=None, usecols=[0])[0].values
+        ingest_ratings(cfg.ratings, arguments.output or cfg.ratingShards, users, movies, cfg.ratingsChunkSize)
+        return
+
+    from artifact_cache import ArtifactCache
+    from data import Reader, dataset_key
+
+    cache = ArtifactCache(cfg.cache, maxEntries=cfg.cacheMaxEntries)
+    cold_start("ingest")
+
+    if cache.lookup("dataset", dataset_key(cache)) is not None:
+        print("Serialized data is up to date")
+        return
+
+    Reader(cache=cache).write_serialized()
+
+
+def train(arguments):
+    """
+    Train a model on the dataset of the artifact cache and store it.
+    """
+    from recommender_system import SVDNetflix
+
+    system = SVDNetflix()
+
+    # Ratings stay in the shards: the system only gets their ids and shape, nothing else is read
+    if arguments.shards:
+        from ingest import RatingShards
+
+        shards = RatingShards(arguments.shards)
+        cold_start("train")
+        system.fit_shards(shards, system.create_engine(arguments.engine))
+    else:
+        system.initialize_system(arguments.dataset)
+        cold_start("train")
+        system.train_system(arguments.engine, arguments.resume)
+
+    system.store_data(arguments.output)
+    print("Model stored in {}".format(system.modelPath))
+
+
+def evaluate(arguments):
+    """
+    Train on a per user split of the ratings and report ranking metrics on the held-out ratings.
+    """
+    from evaluation import holdout_report, print_report
+    from recommender_system import SVDNetflix
+
+    system = SVDNetflix()
+    system.initialize_system(arguments.dataset)
+    cold_start("evaluate")
+
+    print_report(holdout_report(system, arguments.k, arguments.holdout, arguments.mode, arguments.relevance,
+                                arguments.engine, arguments.threads, arguments.seed))
+
+
+def export(arguments):
+    """
+    Write the top-n recommendations of every user of a trained model as csv: user id, rank, movie id, predicted rating.
+    """
+    import numpy as np
+
+    from server import load_system
+
+    system = load_system(arguments.model, arguments.dataset)
+    cold_start("export")
+
+    userIds = system.ratingsMatrix.userIds
+    numRows = 0
+
+    with open(arguments.output, 'w') as file:
+        for start in range(0, len(userIds), arguments.chunk):
+            users = userIds[start:start + arguments.chunk]
+            movies, scores = system.recommend_batch(users.tolist(), arguments.n, numThreads=arguments.threads)
+
+            # One row per recommendation, without the padding of users with fewer movies left
+            kept = movies >= 0
+            rows = np.column_stack((np.repeat(users, kept.sum(axis=1)), np.nonzero(kept)[1] + 1, movies[kept],
+                                    scores[kept]))
+            np.savetxt(file, rows, fmt=["%d", "%d", "%d", "%.4f"], delimiter=",")
+            numRows += len(rows)
+
+    print("{} recommendations of {} users written to {}".format(numRows, len(userIds), arguments.output))
+
+
+def serve(arguments):
+    """
+    Serve a trained model over HTTP (see server).
+    """
+    import asyncio
+
+    from server import RecommendationServer, load_system
+
+    server = RecommendationServer(load_system(arguments.model, arguments.dataset, itemIndex=True))
+    cold_start("serve")
+
+    try:
+        asyncio.run(server.serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
+
+
+def parser():
+    """
+    Parser of the arguments of every subcommand.
+    :return: argparse.ArgumentParser
+    """
+    main = argparse.ArgumentParser(description="Headless stages of the SVD recommender system")
+    commands = main.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="parse the csv files into binary data")
+    command.add_argument("--shards", action="store_true", help="write rating shards for streaming training")
+    command.add_argument("--output", help="shards directory. Defaults to cfg.ratingShards")
+    command.set_defaults(function=ingest)
+
+    command = commands.add_parser("train", help="train and store a model")
+    command.add_argument("--engine", help="training engine. Defaults to SVDNetflix.trainingEngine")
+    command.add_argument("--shards", help="train on the rating shards of this directory (see ingest --shards)")
+    command.add_argument("--dataset", help=DATASET_HELP)
+    command.add_argument("--output", help="model directory. Defaults to the artifact cache")
+    command.add_argument("--resume", action="store_true", help="continue a stopped training from its last checkpoint")
+    command.set_defaults(function=train)
+
+    command = commands.add_parser("evaluate", help="ranking metrics on held-out ratings")
+    command.add_argument("--k", type=int, default=10)
+    command.add_argument("--holdout", type=float, default=0.2, help="fraction of the ratings of every user held out")
+    command.add_argument("--mode", choices=["random", "position"], default="random")
+    command.add_argument("--relevance", type=float, default=4.0, help="minimum score of a relevant movie")
+    command.add_argument("--engine", help="training engine. Defaults to SVDNetflix.trainingEngine")
+    command.add_argument("--threads", type=int, default=None)
+    command.add_argument("--seed", type=int, default=0)
+    command.add_argument("--dataset", help=DATASET_HELP)
+    command.set_defaults(function=evaluate)
+
+    command = commands.add_parser("export", help="write the recommendations of every user as csv")
+    command.add_argument("--model", help="model directory. Defaults to the artifact cache")
+    command.add_argument("--output", default="recommendations.csv")
+    command.add_argument("--n", type=int, default=10, help="number of movies recommended to every user")
+    command.add_argument("--chunk", type=int, default=10000, help="number of users written at once")
+    command.add_argument("--threads", type=int, default=1)
+    command.add_argument("--dataset", help=DATASET_HELP)
+    command.set_defaults(function=export)
+
+    command = commands.add_parser("serve", help="serve a model over HTTP")
+    command.add_argument("--model", help="model directory. Defaults to the artifact cache")
+    command.add_argument("--host", default=cfg.serverHost)
+    command.add_argument("--port", type=int, default=cfg.serverPort)
+    command.add_argument("--dataset", help=DATASET_HELP)
+    command.set_defaults(function=serve)
+
+    return main
+
+
+if __name__ == "__main__":
+
+    arguments = parser().parse_args()
+    arguments.function(arguments)
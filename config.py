@@ -21,11 +21,46 @@ movies_tags = os.path.join(DATA_PATH, "movie-tags.csv")
 # Ratings of the movies by the users
 ratings = os.path.join(DATA_PATH, "ratings.csv")
 
-# Serialized object for avoiding realoading csv files and parsing
-serialized = os.path.join(DATA_PATH, "data.pickle")
+# Ratings parsed at once from the ratings file, and stored in every shard by ingest.ingest_ratings
+ratingsChunkSize = 1000000
 
-# Serialized object for avoiding recalculating similarities between movies
-similarities = os.path.join(DATA_PATH, "similarities.pickle")
+# Shards of the ratings written by ingest.ingest_ratings
+ratingShards = os.path.join(DATA_PATH, "shards")
 
-# Matrix from SVD
-matrix = os.path.join(DATA_PATH, "svd.pickle")
\ No newline at end of file
+# Cache of computed artifacts: binary data, similarities and models (see artifact_cache)
+cache = os.path.join(DATA_PATH, "cache")
+
+# Versions of each kind of artifact kept in cache
+cacheMaxEntries = 3
+
+# Number of similar movies stored for every movie (see similarity)
+similarNeighbors = 20
+
+# Metrics of every training epoch, as JSON lines
+trainingLog = os.path.join(DATA_PATH, "training_log.jsonl")
+
+# Interface and port of the HTTP service (see server)
+serverHost = "127.0.0.1"
+serverPort = 8000
+
+# Seconds the service waits for concurrent requests to answer them in one batch, and maximum size of a batch
+batchWindow = 0.002
+maxBatchSize = 256
+
+# Recommendations kept in memory by SVDNetflix.query (see recommendation_cache)
+recommendationCacheSize = 10000
+
+# Instrumentation (see instrumentation), read from environment variables so runs are instrumented without editing code:
+# JSON lines log of every timer and counter, peak memory of every stage, and stages profiled with cProfile
+# (comma-separated names, "*" for every stage) with the directory of the profiles
+instrumentationLog = os.environ.get("SVD_METRICS_LOG")
+instrumentMemory = os.environ.get("SVD_TRACK_MEMORY", "") not in ("", "0")
+profileStages = [name for name in os.environ.get("SVD_PROFILE_STAGES", "").split(",") if name]
+profileDir = os.environ.get("SVD_PROFILE_DIR", ".")
+
+# Results of every trial of the hyperparameter search (see hyperparameter_search)
+searchResults = os.path.join(DATA_PATH, "search_results.csv")
+
+# Epochs of SGD training between checkpoints, 0 to disable them, and number of checkpoints kept (see checkpoint)
+checkpointInterval = 10
+checkpointsKept = 2
@@ -2,39 +2,49 @@
 Class to hold objects that read data from files.
 """
 
-import pandas as pd
 import config as cfg
-import pickle
-import os
+import model_store
+import instrumentation
+from artifact_cache import ArtifactCache
+from similarity import TagSimilarities
+from ingest import read_ratings_columns
 import numpy as np
+from scipy import sparse
+from collections.abc import Mapping
+
+# Version of the arrays of a dataset: ratings in file, CSR and CSC order, text of users and movies as arrays
+DATASET_LAYOUT = 2
 
 class User:
     """
     Class to hold user data
 
+    View over the ratings of the user in RatingsData: only the id, the description and the position of the user are
+    stored, ratings are slices of the shared arrays.
     """
-    def __init__(self, id_user, description, ratings):
+
+    __slots__ = ("id_user", "description", "ratingsData", "index")
+
+    def __init__(self, id_user, description, ratingsData, index):
         """
         Constructor of user class.
 
         :param id_user: id of the user which is being stored
         :param description: of the user. Could be unique
-        :param ratings: pairs of (movie, score) given from the user to movies.
+        :param ratingsData: RatingsData object with the ratings of every user
+        :param index: index of the user in ratingsData
         """
         self.id_user = id_user
         self.description = description
-        self.ratings = ratings
-        self.seen = {}
-
-        # Store key of the already seen films
-        for rating in ratings:
-            self.seen[rating[0]] = True
+        self.ratingsData = ratingsData
+        self.index = index
 
     def to_string(self):
         """
         User description formatted as string
         """
-        return "User: {} Description: {} Ratings: {}".format(self.id_user, self.description, self.ratings)
+        return "User: {} Description: {} Ratings: {}".format(self.id_user, self.description,
+                                                             list(zip(*(array.tolist() for array in self.get_ratings()))))
 
     def get_user_id(self):
         """
@@ -44,41 +54,56 @@ class User:
 
     def get_ratings(self):
         """
-        Getter of ratings list for this user.
+        Getter of ratings of this user, sorted by movie.
+        :return: (movie ids, scores) arrays
         """
-        return self.ratings
+        movieIndex, scores = self.ratingsData.user_ratings(self.index)
+
+        return self.ratingsData.movieIds[movieIndex], scores
 
     def check_movie_seen(self, id_movie):
         """
-        Method to check if a movie have been already seen for the given user.
+        Method to check if a movie have been already seen for the given user. Binary search over the movies rated by
+        the user, which are sorted.
         :param: id_movie: id of the movie to check
 
         return: boolean indicating if user saw the film
         """
+        movieIndex = self.ratingsData.moviesIndexes.get(id_movie)
+
+        if movieIndex is None:
+            return False
 
-        if id_movie in self.seen:
-            return True
+        seen, _ = self.ratingsData.user_ratings(self.index)
+        position = np.searchsorted(seen, movieIndex)
 
-        return False
+        return bool(position < len(seen) and seen[position] == movieIndex)
 
 class Movie:
     """
     Class to hold movie data
+
+    View over the ratings of the movie in RatingsData, like User.
     """
 
-    def __init__(self, id_movie, title, tags, ratings):
+    __slots__ = ("id_movie", "title", "tags", "ratingsData", "index")
+
+    def __init__(self, id_movie, title, tags, ratingsData, index):
         """
         Constructor of the movie class
 
         :param id_movie: of the movie
         :param title: of the movie
         :param tags: associated with a movie (to construct a vector space model in later stages)
+        :param ratingsData: RatingsData object with the ratings of every movie
+        :param index: index of the movie in ratingsData
         """
 
         self.id_movie = id_movie
         self.title = title
         self.tags = tags
-        self.ratings = ratings
+        self.ratingsData = ratingsData
+        self.index = index
 
     def get_tags(self):
         """
@@ -106,124 +131,741 @@ class Movie:
 
     def get_ratings(self):
         """
-        Getter of ratings list for this movie. Pair (user, rating)
+        Getter of ratings of this movie, sorted by user.
+        :return: (user ids, scores) arrays
         """
-        return self.ratings
+        userIndex, scores = self.ratingsData.movie_ratings(self.index)
 
-class Reader:
+        return self.ratingsData.userIds[userIndex], scores
+
+class RatingsData:
     """
-    Class to read data from files and store them in specific data structures.
+    Columnar storage of the ratings.
+
+    Every rating is kept as a (user index, movie index, score) triple spread over three contiguous arrays, in the
+    order of the ratings file. Ratings are also laid out grouped by user (CSR: sorted by (user, movie)) and by movie
+    (CSC: sorted by (movie, user)), with a single sort each, and `userOffsets`/`movieOffsets` delimit the slice of each
+    group. Both layouts are stored, so loading them memory-mapped needs no gather.
     """
 
+    def __init__(self, userIds, movieIds, userIndex, movieIndex, scores, layouts=None):
+        """
+        Constructor of the ratings storage.
+
+        :param userIds: sorted array of user ids. Position in the array is the index of the user.
+        :param movieIds: sorted array of movie ids. Position in the array is the index of the movie.
+        :param userIndex: index of the user of each rating.
+        :param movieIndex: index of the movie of each rating.
+        :param scores: score of each rating.
+        :param layouts: (userOffsets, byUser, movieOffsets, byMovie) computed previously, if available (see byUser and
+        byMovie).
+        """
+        self.userIds = np.asarray(userIds, dtype=np.int64)
+        self.movieIds = np.asarray(movieIds, dtype=np.int64)
+        self.userIndex = np.asarray(userIndex, dtype=np.int32)
+        self.movieIndex = np.asarray(movieIndex, dtype=np.int32)
+        self.scores = np.asarray(scores, dtype=np.float32)
+
+        self.numUsers = len(self.userIds)
+        self.numMovies = len(self.movieIds)
+        self.numRatings = len(self.scores)
+
+        # Group ratings by user (sorted by movie inside each user) and by movie (sorted by user inside each movie)
+        if layouts is None:
+            userOrder = np.lexsort((self.movieIndex, self.userIndex))
+            movieOrder = np.lexsort((self.userIndex, self.movieIndex))
+
+            self.userOffsets = self.offsets(self.userIndex, self.numUsers)
+            self.byUser = (self.movieIndex[userOrder], self.scores[userOrder])
+            self.movieOffsets = self.offsets(self.movieIndex, self.numMovies)
+            self.byMovie = (self.userIndex[movieOrder], self.scores[movieOrder])
+        else:
+            (self.userOffsets, self.byUser, self.movieOffsets, self.byMovie) = layouts
+
+        # Dictionaries id -> index, created on demand
+        self._userIndexes = None
+        self._moviesIndexes = None
+
+    @staticmethod
+    def offsets(index, size):
+        """
+        Boundaries of each group once the ratings are sorted by the given index.
+        :param index: group index of each rating
+        :param size: number of groups
+        :return: array of size + 1 offsets. Group i spans offsets[i]:offsets[i + 1]
+        """
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(index, minlength=size), out=offsets[1:])
+
+        return offsets
+
+    @classmethod
+    def from_columns(cls, knownUsers, knownMovies, ratingUsers, ratingMovies, scores):
+        """
+        Build the storage from raw id columns. Ids are mapped to indexes with np.unique, so users and movies without
+        ratings keep their index and ratings of ids not listed in users/movies files get a new one.
+
+        :param knownUsers: ids read from the users file
+        :param knownMovies: ids read from the movies file
+        :param ratingUsers: user id of each rating
+        :param ratingMovies: movie id of each rating
+        :param scores: score of each rating
+        :return: RatingsData object
+        """
+        knownUsers = np.asarray(knownUsers, dtype=np.int64)
+        knownMovies = np.asarray(knownMovies, dtype=np.int64)
+
+        userIds, userInverse = np.unique(np.concatenate((knownUsers, np.asarray(ratingUsers, dtype=np.int64))),
+                                         return_inverse=True)
+        movieIds, movieInverse = np.unique(np.concatenate((knownMovies, np.asarray(ratingMovies, dtype=np.int64))),
+                                           return_inverse=True)
+
+        return cls(userIds=userIds,
+                   movieIds=movieIds,
+                   userIndex=userInverse[len(knownUsers):],
+                   movieIndex=movieInverse[len(knownMovies):],
+                   scores=scores)
+
+    @property
+    def userIndexes(self):
+        """
+        Dictionary key=user_id value=index of the user
+        """
+        if self._userIndexes is None:
+            self._userIndexes = dict(zip(self.userIds.tolist(), range(self.numUsers)))
+
+        return self._userIndexes
+
+    @property
+    def moviesIndexes(self):
+        """
+        Dictionary key=id_movie value=index of the movie
+        """
+        if self._moviesIndexes is None:
+            self._moviesIndexes = dict(zip(self.movieIds.tolist(), range(self.numMovies)))
+
+        return self._moviesIndexes
+
+    def user_ratings(self, userIndex):
+        """
+        Ratings given by a user, sorted by movie index. Slices of the CSR columns, not copies.
+        :param userIndex: index of the user
+        :return: (movie indexes, scores)
+        """
+        movieIndex, scores = self.byUser
+
+        if userIndex >= self.numUsers:
+            return movieIndex[:0], scores[:0]
+
+        start, end = self.userOffsets[userIndex], self.userOffsets[userIndex + 1]
+
+        return movieIndex[start:end], scores[start:end]
+
+    def movie_ratings(self, movieIndex):
+        """
+        Ratings received by a movie, sorted by user index. Slices of the CSC columns, not copies.
+        :param movieIndex: index of the movie
+        :return: (user indexes, scores)
+        """
+        userIndex, scores = self.byMovie
+
+        if movieIndex >= self.numMovies:
+            return userIndex[:0], scores[:0]
+
+        start, end = self.movieOffsets[movieIndex], self.movieOffsets[movieIndex + 1]
+
+        return userIndex[start:end], scores[start:end]
+
+    def to_arrays(self):
+        """
+        Arrays which hold the ratings, to be stored on disk.
+        :return: dictionary key=name value=array
+        """
+        return {
+            "userIds": self.userIds,
+            "movieIds": self.movieIds,
+            "userIndex": self.userIndex,
+            "movieIndex": self.movieIndex,
+            "scores": self.scores,
+            "userOffsets": self.userOffsets,
+            "byUserMovieIndex": self.byUser[0],
+            "byUserScores": self.byUser[1],
+            "movieOffsets": self.movieOffsets,
+            "byMovieUserIndex": self.byMovie[0],
+            "byMovieScores": self.byMovie[1],
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Build the storage from the arrays returned by to_arrays. Arrays are not copied, so they can be memory-mapped.
+        :param arrays: dictionary key=name value=array
+        :return: RatingsData object
+        """
+        return cls(userIds=arrays["userIds"],
+                   movieIds=arrays["movieIds"],
+                   userIndex=arrays["userIndex"],
+                   movieIndex=arrays["movieIndex"],
+                   scores=arrays["scores"],
+                   layouts=(arrays["userOffsets"], (arrays["byUserMovieIndex"], arrays["byUserScores"]),
+                            arrays["movieOffsets"], (arrays["byMovieUserIndex"], arrays["byMovieScores"])))
+
+    def __getstate__(self):
+        # Dictionaries are rebuilt on demand, do not serialize them
+        state = self.__dict__.copy()
+        state['_userIndexes'] = None
+        state['_moviesIndexes'] = None
+
+        return state
+
+
+class AppendBuffer:
     """
-        Objects to store the ratings matrix with users on the side and items on top, and indexes in these matrix
-        related to users and movies.
+    Array which grows at the end. Capacity is doubled when it is full, so appending is amortized O(1) per item.
     """
-    ratingsMatrix = None
-    userIndexes = {}
-    moviesIndexes = {}
 
-    def __init__(self):
+    def __init__(self, initial, minCapacity=16):
+        """
+        :param initial: initial content. Its dtype and shape of the items are kept
+        :param minCapacity: minimum number of items allocated
+        """
+        initial = np.asarray(initial)
+        self.buffer = np.empty((max(len(initial), minCapacity),) + initial.shape[1:], dtype=initial.dtype)
+        self.buffer[:len(initial)] = initial
+        self.size = len(initial)
 
+    def append(self, values):
         """
-        Constructor: read every csv file using pandas.
+        Add items at the end.
+        :param values: array of items
         """
+        values = np.asarray(values, dtype=self.buffer.dtype)
+        needed = self.size + len(values)
 
-        print("Reading files from csv...")
+        if needed > len(self.buffer):
+            grown = np.empty((max(needed, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            grown[:self.size] = self.buffer[:self.size]
+            self.buffer = grown
 
-        self.users = pd.read_csv(cfg.users, header=None)
-        self.movies = pd.read_csv(cfg.movies, header=None)
-        self.movies_tags = pd.read_csv(cfg.movies_tags, header=None, encoding="ISO-8859-1")
-        self.ratings = pd.read_csv(cfg.ratings, header=None)
+        self.buffer[self.size:needed] = values
+        self.size = needed
 
-        self.ratingsUserMovie = {}
+    @property
+    def array(self):
+        """
+        View of the items. Invalidated by the next append that grows the buffer.
+        """
+        return self.buffer[:self.size]
 
-    def get_users(self):
+    def __len__(self):
+        return self.size
+
+
+class RatingsMatrix:
+    """
+    Sparse ratings matrix with users on the side and movies on top.
+
+    Only rated cells are stored, in CSR layout (rows of users) and CSC layout (columns of movies), so memory grows with
+    the number of ratings instead of users * movies. Ratings, users and movies added after construction (see append)
+    are kept apart in append buffers and merged on read.
+    """
+
+    def __init__(self, ratingsData):
         """
-        Get users with their ratings of the films
+        Constructor: both layouts are the ones of RatingsData, not copies, so memory-mapped ratings stay shared.
+        :param ratingsData: RatingsData object
+        """
+        self.ratingsData = ratingsData
+        self.shape = (ratingsData.numUsers, ratingsData.numMovies)
+        self.nnz = ratingsData.numRatings
 
-        :return: dictionary key=user_id value = User object with every user's data.
+        # Ratings of every user, sorted by movie
+        movieIndex, scores = ratingsData.byUser
+        self.byUser = sparse.csr_matrix(
+            (scores,
+             movieIndex,
+             ratingsData.userOffsets),
+            shape=self.shape)
+
+        # Ratings of every movie, sorted by user
+        userIndex, scores = ratingsData.byMovie
+        self.byMovie = sparse.csc_matrix(
+            (scores,
+             userIndex,
+             ratingsData.movieOffsets),
+            shape=self.shape)
+
+        # Appended ratings and ids, created on the first append
+        self.pending = None
+        self.pendingByUser = {}
+        self.pendingByMovie = {}
+
+    @property
+    def userIds(self):
+        """
+        Id of every user in index order
         """
-        users = {}
+        return self.pending["userIds"].array if self.pending is not None else self.ratingsData.userIds
 
-        for index, row in self.users.iterrows():
+    @property
+    def movieIds(self):
+        """
+        Id of every movie in index order
+        """
+        return self.pending["movieIds"].array if self.pending is not None else self.ratingsData.movieIds
 
-            user_id = int(row[0])
-            description = row[1]
-            user_ratings = []
+    def append(self, userIndexes, movieIndexes, scores, newUserIds=(), newMovieIds=()):
+        """
+        Add ratings without rebuilding the sparse matrices. New users and movies take the next indexes.
+        :param userIndexes: index of the user of each rating
+        :param movieIndexes: index of the movie of each rating
+        :param scores: score of each rating
+        :param newUserIds: ids of the new users, in index order
+        :param newMovieIds: ids of the new movies, in index order
+        """
+        if self.pending is None:
+            self.pending = {
+                "userIndexes": AppendBuffer(np.empty(0, dtype=np.int32)),
+                "movieIndexes": AppendBuffer(np.empty(0, dtype=np.int32)),
+                "scores": AppendBuffer(np.empty(0, dtype=np.float32)),
+                "userIds": AppendBuffer(self.ratingsData.userIds),
+                "movieIds": AppendBuffer(self.ratingsData.movieIds),
+            }
 
-            ratings = self.ratings.loc[self.ratings[0] == user_id]
+        start = len(self.pending["scores"])
 
-            # Get user ratings
-            for index_ratings, row_rating in ratings.iterrows():
+        self.pending["userIndexes"].append(userIndexes)
+        self.pending["movieIndexes"].append(movieIndexes)
+        self.pending["scores"].append(scores)
+        self.pending["userIds"].append(np.asarray(newUserIds, dtype=np.int64))
+        self.pending["movieIds"].append(np.asarray(newMovieIds, dtype=np.int64))
 
-                user_ratings.append((row_rating[1], float(row_rating[2])))  # (movie, score)
+        for position, (userIndex, movieIndex) in enumerate(zip(np.asarray(userIndexes).tolist(),
+                                                              np.asarray(movieIndexes).tolist())):
+            self.pendingByUser.setdefault(userIndex, []).append(start + position)
+            self.pendingByMovie.setdefault(movieIndex, []).append(start + position)
 
-            # Append user object in dictionary
-            users[user_id] = User(id_user=user_id, description=description, ratings=user_ratings)
+        self.shape = (len(self.pending["userIds"]), len(self.pending["movieIds"]))
+        self.nnz += len(scores)
 
-        return users
+    def user_row(self, userIndex):
+        """
+        Ratings of a user.
+        :param userIndex: index of the user
+        :return: (movie indexes, scores)
+        """
+        if userIndex < self.byUser.shape[0]:
+            start, end = self.byUser.indptr[userIndex], self.byUser.indptr[userIndex + 1]
+            movieIndexes, scores = self.byUser.indices[start:end], self.byUser.data[start:end]
+        else:
+            movieIndexes, scores = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
 
-    def get_movies(self):
+        if userIndex in self.pendingByUser:
+            positions = self.pendingByUser[userIndex]
+            movieIndexes = np.concatenate((movieIndexes, self.pending["movieIndexes"].array[positions]))
+            scores = np.concatenate((scores, self.pending["scores"].array[positions]))
+
+        return movieIndexes, scores
+
+    def movie_column(self, movieIndex):
         """
-        Get movies with their tags
+        Ratings of a movie.
+        :param movieIndex: index of the movie
+        :return: (user indexes, scores)
+        """
+        if movieIndex < self.byMovie.shape[1]:
+            start, end = self.byMovie.indptr[movieIndex], self.byMovie.indptr[movieIndex + 1]
+            userIndexes, scores = self.byMovie.indices[start:end], self.byMovie.data[start:end]
+        else:
+            userIndexes, scores = np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
 
-        :return: dictionary key=id_movie value = Movie object
+        if movieIndex in self.pendingByMovie:
+            positions = self.pendingByMovie[movieIndex]
+            userIndexes = np.concatenate((userIndexes, self.pending["userIndexes"].array[positions]))
+            scores = np.concatenate((scores, self.pending["scores"].array[positions]))
+
+        return userIndexes, scores
+
+    def rows_coo(self, rows):
+        """
+        Coordinates of the ratings of some users.
+        :param rows: indexes of the users
+        :return: (positions in rows, movie indexes) of every rating
         """
+        rows = np.asarray(rows)
+        inMatrix = rows < self.byUser.shape[0]
 
-        movies = {}
+        # Rows of users appended later are read as row 0 and discarded
+        selected = self.byUser[np.where(inMatrix, rows, 0)]
+        positions = np.repeat(np.arange(len(rows)), np.diff(selected.indptr))
+        kept = inMatrix[positions]
+        positions, movieIndexes = positions[kept], selected.indices[kept]
 
-        for index, movie in self.movies.iterrows():
+        if self.pendingByUser:
+            extraPositions, extraMovies = [], []
 
-            id_movie = int(movie[0])
-            title = movie[1]
-            movie_tags = []
-            movie_ratings = []
+            for position, row in enumerate(rows.tolist()):
+                for rating in self.pendingByUser.get(row, ()):
+                    extraPositions.append(position)
+                    extraMovies.append(self.pending["movieIndexes"].array[rating])
 
-            # Get tags for each movie
-            tags = self.movies_tags.loc[self.movies_tags[0] == id_movie]
+            positions = np.concatenate((positions, np.asarray(extraPositions, dtype=positions.dtype)))
+            movieIndexes = np.concatenate((movieIndexes, np.asarray(extraMovies, dtype=movieIndexes.dtype)))
 
-            for index_movie, tag in tags.iterrows():
+        return positions, movieIndexes
+
+    def coo(self):
+        """
+        Coordinates of every rating in user order, followed by appended ratings.
+        :return: (user indexes, movie indexes, scores) as int32, int32 and float32 arrays
+        """
+        userIndex = np.repeat(np.arange(self.byUser.shape[0], dtype=np.int32), np.diff(self.byUser.indptr))
+        coordinates = (userIndex, self.byUser.indices.astype(np.int32, copy=False), self.byUser.data)
 
-                movie_tags.append(tag[1])
+        if self.pending is None:
+            return coordinates
 
-            # Get ratings for each film
-            ratings = self.ratings.loc[self.ratings[1] == id_movie]
+        appended = (self.pending["userIndexes"].array, self.pending["movieIndexes"].array, self.pending["scores"].array)
 
-            # Get user ratings
-            for index_ratings, row_rating in ratings.iterrows():
-                movie_ratings.append((row_rating[0], float(row_rating[2])))  # (id_user, score)
+        return tuple(np.concatenate((base, extra)) for base, extra in zip(coordinates, appended))
 
-            # Create Movie object
-            movie_object = Movie(id_movie=id_movie, title=title, tags=movie_tags, ratings=movie_ratings)
+    def coo_file_order(self):
+        """
+        Coordinates of every rating in the order of the ratings file, followed by appended ratings.
+        :return: (user indexes, movie indexes, scores) as int32, int32 and float32 arrays
+        """
+        data = self.ratingsData
+        coordinates = (data.userIndex, data.movieIndex, data.scores)
 
-            # Append movie_object in dictionary
-            movies[id_movie] = movie_object
+        if self.pending is None:
+            return coordinates
 
-        return movies
+        appended = (self.pending["userIndexes"].array, self.pending["movieIndexes"].array, self.pending["scores"].array)
 
-    def get_ratings(self):
-        for row, data in self.ratings.iterrows():
-            userId = data[0]
-            movieId = data[1]
-            rating = data[2]
+        return tuple(np.concatenate((base, extra)) for base, extra in zip(coordinates, appended))
+
+    def toarray(self):
+        """
+        Dense copy of the matrix. Only meant for small datasets.
+        """
+        dense = np.zeros(self.shape, dtype=np.float32)
+        userIndexes, movieIndexes, scores = self.coo()
+        dense[userIndexes, movieIndexes] = scores
+
+        return dense
+
+
+class UsersView(Mapping):
+    """
+    Read-only dictionary key=user_id value=User object. User objects are created on access from RatingsData.
+    """
+
+    def __init__(self, ratingsData, descriptions):
+        """
+        :param ratingsData: RatingsData object
+        :param descriptions: dictionary key=user_id value=description
+        """
+        self.ratingsData = ratingsData
+        self.descriptions = descriptions
+
+    def __getitem__(self, user_id):
+        return User(id_user=user_id, description=self.descriptions.get(user_id), ratingsData=self.ratingsData,
+                    index=self.ratingsData.userIndexes[user_id])
+
+    def __iter__(self):
+        return iter(self.ratingsData.userIds.tolist())
+
+    def __len__(self):
+        return self.ratingsData.numUsers
+
+
+class MoviesView(Mapping):
+    """
+    Read-only dictionary key=id_movie value=Movie object. Movie objects are created on access from RatingsData.
+    """
+
+    def __init__(self, ratingsData, titles, tags):
+        """
+        :param ratingsData: RatingsData object
+        :param titles: dictionary key=id_movie value=title
+        :param tags: dictionary key=id_movie value=list of tags
+        """
+        self.ratingsData = ratingsData
+        self.titles = titles
+        self.tags = tags
+
+    def __getitem__(self, id_movie):
+        return Movie(id_movie=id_movie, title=self.titles.get(id_movie), tags=self.tags.get(id_movie, []),
+                     ratingsData=self.ratingsData, index=self.ratingsData.moviesIndexes[id_movie])
 
-            # Store tuple
-            self.ratingsUserMovie[(userId, movieId)] = rating
+    def __iter__(self):
+        return iter(self.ratingsData.movieIds.tolist())
 
-        return self.ratingsUserMovie
+    def __len__(self):
+        return self.ratingsData.numMovies
+
+
+class RatingsView(Mapping):
+    """
+    Read-only dictionary key=(userId, movieId) value=rating, backed by RatingsData.
+    """
+
+    def __init__(self, ratingsData):
+        """
+        :param ratingsData: RatingsData object
+        """
+        self.ratingsData = ratingsData
+
+    def __getitem__(self, key):
+        userId, movieId = key
+        data = self.ratingsData
+
+        if userId not in data.userIndexes or movieId not in data.moviesIndexes:
+            raise KeyError(key)
+
+        movieIndex, scores = data.user_ratings(data.userIndexes[userId])
+        position = np.searchsorted(movieIndex, data.moviesIndexes[movieId])
+
+        if position == len(movieIndex) or movieIndex[position] != data.moviesIndexes[movieId]:
+            raise KeyError(key)
+
+        return float(scores[position])
+
+    def __iter__(self):
+        data = self.ratingsData
+        users = np.repeat(data.userIds, np.diff(data.userOffsets)).tolist()
+        movies = data.movieIds[data.byUser[0]].tolist()
+
+        return zip(users, movies)
+
+    def __len__(self):
+        return self.ratingsData.numRatings
+
+def none_if_missing(value):
+    """
+    Replace missing values read by pandas (NaN) with None
+    """
+    import pandas as pd
+
+    return None if pd.isna(value) else value
+
+
+def dataset_key(cache):
+    """
+    Key of the binary data in the artifact cache: depends on the content of every csv file and on the arrays stored.
+    :param cache: ArtifactCache object
+    :return: key
+    """
+    return cache.key("dataset", inputs=[cfg.users, cfg.movies, cfg.movies_tags, cfg.ratings],
+                     parameters={"version": model_store.FORMAT_VERSION, "layout": DATASET_LAYOUT})
+
+
+def text_arrays(users, movies):
+    """
+    Descriptions of users, titles and tags of movies as arrays aligned with the indexes, stored next to the ratings so
+    the header of the dataset stays small. Missing values are empty strings, and tags of movie i span
+    tagOffsets[i]:tagOffsets[i + 1].
+    :param users: dictionary key=user_id value=User object
+    :param movies: dictionary key=id_movie value=Movie object
+    :return: dictionary key=name value=array
+    """
+    def text(value):
+        value = none_if_missing(value)
+        return "" if value is None else str(value)
+
+    tags = [movies.tags.get(movie, []) for movie in movies]
+
+    return {
+        "descriptions": np.array([text(users.descriptions.get(user)) for user in users], dtype=str),
+        "titles": np.array([text(movies.titles.get(movie)) for movie in movies], dtype=str),
+        "tags": np.array([str(tag) for movieTags in tags for tag in movieTags], dtype=str),
+        "tagOffsets": np.cumsum([0] + [len(movieTags) for movieTags in tags], dtype=np.int64),
+    }
+
+
+def similarities_key(cache, k):
+    """
+    Key of the similarities between movies in the artifact cache: depends on the movies, their tags and the number
+    of neighbors.
+    :param cache: ArtifactCache object
+    :param k: number of neighbors of every movie
+    :return: key
+    """
+    return cache.key("similarities", inputs=[cfg.movies, cfg.movies_tags],
+                     parameters={"k": k, "version": model_store.FORMAT_VERSION})
+
+
+def write_similarities(cache, similarities):
+    """
+    Write the k-NN similarities between movies in binary format in the artifact cache.
+    :param cache: ArtifactCache object
+    :param similarities: TagSimilarities object
+    """
+    k = similarities.neighbors.shape[1]
+    key = similarities_key(cache, k)
+
+    # If similarities are yet stored for these movies and tags, do not create them again
+    if cache.lookup("similarities", key) is not None:
+        return None
+
+    print("Storing similarities as binary arrays...")
+    model_store.write_arrays(cache.path("similarities", key), kind="similarities", arrays=similarities.to_arrays(),
+                             metadata={"k": k})
+    cache.commit("similarities", key)
+
+
+def load_similarities(cache, k=None, mmapMode='r'):
+    """
+    Load the k-NN similarities between movies from the artifact cache. Arrays are memory-mapped.
+    :param cache: ArtifactCache object
+    :param k: number of neighbors of every movie. Defaults to cfg.similarNeighbors
+    :param mmapMode: mode to memory-map the arrays, None to read them in memory
+    :return: TagSimilarities object, None if they have not been computed
+    """
+    path = cache.lookup("similarities", similarities_key(cache, k or cfg.similarNeighbors))
+
+    if path is None:
+        return None
+
+    print("Similarities exist. Reading from disk...")
+    _, arrays = model_store.read_arrays(path, kind="similarities", mmapMode=mmapMode)
+
+    return TagSimilarities.from_arrays(arrays)
+
+
+def load_dataset(path, mmapMode='r'):
+    """
+    Load data stored by Reader.write_serialized without reading any csv file.
+    :param path: dataset directory
+    :param mmapMode: mode to memory-map the arrays, None to read them in memory
+    :return: users, movies, ratings
+    """
+    with instrumentation.stage("dataset.load"):
+        _, arrays = model_store.read_arrays(path, kind="dataset", mmapMode=mmapMode)
+
+        if "byUserMovieIndex" not in arrays:
+            raise model_store.FormatError("Dataset in {} was stored without its ratings layouts, ingest it again".format(
+                path))
+
+        ratingsData = RatingsData.from_arrays(arrays)
+
+        userIds = ratingsData.userIds.tolist()
+        movieIds = ratingsData.movieIds.tolist()
+        tags = arrays["tags"].tolist()
+        tagOffsets = arrays["tagOffsets"].tolist()
+
+        users = UsersView(ratingsData=ratingsData,
+                          descriptions=dict(zip(userIds, (text or None for text in arrays["descriptions"].tolist()))))
+        movies = MoviesView(ratingsData=ratingsData,
+                            titles=dict(zip(movieIds, (text or None for text in arrays["titles"].tolist()))),
+                            tags={movie: tags[start:end] for movie, start, end in zip(movieIds, tagOffsets[:-1],
+                                                                                      tagOffsets[1:])})
+
+    return users, movies, RatingsView(ratingsData=ratingsData)
+
+
+class Reader:
+    """
+    Class to read data from files and store them in specific data structures.
+    """
+
+    """
+        Objects to store the ratings matrix with users on the side and items on top, and indexes in these matrix
+        related to users and movies.
+    """
+    ratingsMatrix = None
+    userIndexes = {}
+    moviesIndexes = {}
+
+    def __init__(self, cache=None):
+
+        """
+        Constructor: read every csv file using pandas. Ratings are parsed in chunks into compact columns (see
+        ingest.read_ratings_columns).
+
+        :param cache: ArtifactCache where binary data is stored. Defaults to the cache in cfg.cache
+        """
+
+        import pandas as pd
+
+        self.cache = cache or ArtifactCache(cfg.cache, maxEntries=cfg.cacheMaxEntries)
+
+        print("Reading files from csv...")
+
+        with instrumentation.stage("reader.parse_csv"):
+            self.users = pd.read_csv(cfg.users, header=None)
+            self.movies = pd.read_csv(cfg.movies, header=None)
+            self.movies_tags = pd.read_csv(cfg.movies_tags, header=None, encoding="ISO-8859-1")
+            self.ratings = read_ratings_columns(cfg.ratings, cfg.ratingsChunkSize)
+
+        instrumentation.count("reader.ratings", len(self.ratings[2]))
+
+        self.ratingsData = None
+
+    def get_ratings_data(self):
+        """
+        Get ratings in columnar format. Built once from the ratings DataFrame.
+
+        :return: RatingsData object
+        """
+        if self.ratingsData is None:
+            with instrumentation.stage("reader.ratings_data"):
+                self.ratingsData = RatingsData.from_columns(knownUsers=self.users[0].values,
+                                                            knownMovies=self.movies[0].values,
+                                                            ratingUsers=self.ratings[0],
+                                                            ratingMovies=self.ratings[1],
+                                                            scores=self.ratings[2])
+
+        return self.ratingsData
+
+    def get_users(self):
+        """
+        Get users with their ratings of the films
+
+        :return: dictionary key=user_id value = User object with every user's data.
+        """
+        descriptions = dict(zip(self.users[0].astype(np.int64).tolist(), self.users[1].tolist()))
+
+        return UsersView(ratingsData=self.get_ratings_data(), descriptions=descriptions)
+
+    def get_movies(self):
+        """
+        Get movies with their tags
+
+        :return: dictionary key=id_movie value = Movie object
+        """
+        titles = dict(zip(self.movies[0].astype(np.int64).tolist(), self.movies[1].tolist()))
+
+        # Group tags of every movie in one pass
+        tags = {int(id_movie): list(movie_tags) for id_movie, movie_tags in self.movies_tags.groupby(0, sort=False)[1]}
+
+        return MoviesView(ratingsData=self.get_ratings_data(), titles=titles, tags=tags)
+
+    def get_ratings(self):
+        """
+        Get ratings of every user
+
+        :return: dictionary key=(userId, movieId) value=rating
+        """
+        return RatingsView(ratingsData=self.get_ratings_data())
 
     def write_serialized(self):
         """
-        Write serialized object in a file
+        Write the data in binary format (see model_store) in the artifact cache: ratings arrays and metadata of users
+        and movies.
 
         :return: data which has been read in previous stages
         """
 
-        # If file is yet created, return data and do not create it again
-        if os.path.isfile(cfg.serialized):
+        key = dataset_key(self.cache)
+
+        # If data is yet stored for these csv files, do not create it again
+        if self.cache.lookup("dataset", key) is not None:
             return None
 
+        print("Creating ratings arrays...")
+        ratingsData = self.get_ratings_data()
+
         print("Creating users array...")
         users = self.get_users()
 
@@ -233,88 +875,100 @@ class Reader:
         print("Creating ratings tuples...")
         ratings = self.get_ratings()
 
-        data = (users, movies, ratings)
+        # Text of users and movies aligned with their indexes
+        arrays = ratingsData.to_arrays()
+        arrays.update(text_arrays(users, movies))
 
-        # Save data as serialized object
-        with open(cfg.serialized, 'wb') as serialized:
-            print("Storing data as serialized object...")
-            pickle.dump(data, serialized)
+        print("Storing data as binary arrays...")
+        with instrumentation.stage("reader.serialize"):
+            model_store.write_arrays(self.cache.path("dataset", key), kind="dataset", arrays=arrays)
+        self.cache.commit("dataset", key)
 
         # Return data whenever this function is called
-        return data
+        return (users, movies, ratings)
 
     def load_serialized(self):
         """
-        Load file from pickle or create it if not exists
-        :return: pair of users, movies
+        Load data from binary format or create it if not exists. Arrays are memory-mapped.
+        :return: users, movies, ratings
         """
-        if not os.path.isfile(cfg.serialized):
-            serialized = self.write_serialized()
-        else:
-            print("Serialized object exists. Reading from disk...")
-            with open(cfg.serialized, 'rb') as file:
-                serialized = pickle.load(file)
+        path = self.cache.lookup("dataset", dataset_key(self.cache))
 
-        return serialized[0], serialized[1], serialized[2]  # users, movies, ratings
+        if path is None:
+            return self.write_serialized()
+
+        print("Serialized data exists. Reading from disk...")
+        return load_dataset(path)
 
     def write_similarities(self, data):
         """
-        Write similarities data to file
-        :param data: similarities data
+        Write similarities data to the artifact cache (see write_similarities)
+        :param data: TagSimilarities object
         """
-        # If file is yet created, return data and do not create it again
-        if os.path.isfile(cfg.similarities):
-            return None
+        write_similarities(self.cache, data)
 
-        with open(cfg.similarities, 'wb') as similarities:
-            print("Storing data as serialized object...")
-            pickle.dump(data, similarities)
-
-
-    def load_similarities(self):
+    def load_similarities(self, k=None):
         """
-        Load similarities pickle data
-        :return: similiarities between pairs of movies
+        Load similarities data from the artifact cache (see load_similarities)
+        :param k: number of neighbors of every movie
+        :return: TagSimilarities object, None if they have not been computed
         """
-        if not os.path.isfile(cfg.similarities):
-            return None
-        else:
-            print("Serialized object exists. Reading from disk...")
-            with open(cfg.similarities, 'rb') as file:
-                data = pickle.load(file)
-
-        return data
+        return load_similarities(self.cache, k)
 
     def create_ratings_matrix(self, users, movies):
         """
-        Method to create ratings matrix in a numpy array format.
-        :param users: 
-        :param movies: 
-        :return: (userIndexes, moviesIndexes, ratingsMatrix)
-        """""
+        Method to create the sparse ratings matrix (see create_ratings_matrix).
+        :param users: dictionary of User objects
+        :param movies: dictionary of Movie objects
+        :return: (ratingsMatrix, userIndexes, moviesIndexes)
+        """
 
-        numUsers = len(users)
-        numMovies = len(movies)
+        (self.ratingsMatrix, self.userIndexes, self.moviesIndexes) = create_ratings_matrix(users, movies)
 
-        # Initialize ratings matrix
-        self.ratingsMatrix = np.zeros((numUsers, numMovies), dtype=float)
+        return (self.ratingsMatrix, self.userIndexes, self.moviesIndexes)
 
-        # Associate index to each movie
-        for index, movie in enumerate(movies):
-            self.moviesIndexes[movie] = index
 
-        # Fill ratingsMatrix
-        for indexUser, user in enumerate(users):
-            # Store index of the user
-            self.userIndexes[user] = indexUser
+def split_coordinates(coordinates, holdout=0.1, seed=0):
+    """
+    Split ratings at random into training and held-out sets.
+    :param coordinates: (user indexes, movie indexes, scores) of the ratings
+    :param holdout: fraction of held-out ratings
+    :param seed: seed of the split
+    :return: (training coordinates, held-out coordinates)
+    """
+    heldOut = np.random.RandomState(seed).random_sample(len(coordinates[0])) < holdout
 
-            # Fill ratings matrix
-            for movie in users[user].get_ratings():
-                id_movie = movie[0]
-                indexMovie = self.moviesIndexes[id_movie]
-                rating = movie[1]
+    return tuple(array[~heldOut] for array in coordinates), tuple(array[heldOut] for array in coordinates)
 
-                # Write on ratingMatrix
-                self.ratingsMatrix[indexUser, indexMovie] = rating
 
-        return (self.ratingsMatrix, self.userIndexes, self.moviesIndexes)
\ No newline at end of file
+def create_ratings_matrix(users, movies):
+    """
+    Create the sparse ratings matrix.
+    :param users: dictionary of User objects (view returned by Reader.get_users or any dictionary of User objects)
+    :param movies: dictionary of Movie objects
+    :return: (ratingsMatrix, userIndexes, moviesIndexes)
+    """
+
+    if isinstance(users, UsersView):
+        ratingsData = users.ratingsData
+    else:
+        # Dictionaries of objects: flatten their ratings into columns
+        ratingUsers, ratingMovies, scores = [], [], []
+
+        for user in users:
+            movieIds, userScores = users[user].get_ratings()
+            ratingUsers.append(np.full(len(movieIds), user, dtype=np.int64))
+            ratingMovies.append(movieIds)
+            scores.append(userScores)
+
+        ratingsData = RatingsData.from_columns(knownUsers=list(users), knownMovies=list(movies),
+                                               ratingUsers=np.concatenate(ratingUsers or [np.empty(0, np.int64)]),
+                                               ratingMovies=np.concatenate(ratingMovies or [np.empty(0, np.int64)]),
+                                               scores=np.concatenate(scores or [np.empty(0, np.float32)]))
+
+    # Sparse layouts and dictionaries id -> index
+    with instrumentation.stage("ratings_matrix.build", ratings=ratingsData.numRatings):
+        ratingsMatrix = RatingsMatrix(ratingsData)
+        userIndexes, moviesIndexes = ratingsData.userIndexes, ratingsData.moviesIndexes
+
+    return (ratingsMatrix, userIndexes, moviesIndexes)
@@ -0,0 +1,195 @@
+"""
+Offline evaluation of the ranking quality of the recommendations over held-out ratings.
+
+Ratings are split per user: a fraction of the ratings of every user is held out, chosen at random or as the last ones
+in file order (a proxy of the most recent ones, since ratings have no timestamps). The model is trained on the rest,
+then every user with relevant held-out movies (score >= relevanceThreshold) gets top-k recommendations among the movies
+not rated in training, scored in chunks with one matrix product each (SVDNetflix.top_movies, as recommend_batch).
+Chunks are processed by a pool of threads: matrix products and selections release the GIL.
+
+Metrics are vectorized over the (users, k) matrix of hits of every chunk and averaged over the evaluated users:
+
+ * precision@k: relevant movies among the k recommended, over k
+ * recall@k: relevant movies among the k recommended, over the relevant movies of the user
+ * ndcg@k: discounted cumulative gain of the hits, over the gain of a perfect ranking
+ * map@k: mean over users of the average precision at the rank of every hit
+ * coverage: fraction of the catalog recommended to at least one user
+
+    python evaluation.py --k 10 --holdout 0.2 --mode position       (same arguments as python cli.py evaluate)
+"""
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import scipy.sparse as sp
+
+import instrumentation
+
+METRICS = ("precision", "recall", "ndcg", "map")
+
+
+def split_by_user(coordinates, holdout=0.2, mode="random", minRatings=2, seed=0):
+    """
+    Hold out a fraction of the ratings of every user.
+    :param coordinates: (user indexes, movie indexes, scores) of the ratings
+    :param holdout: fraction of the ratings of every user held out, rounded up
+    :param mode: "random" to hold out ratings at random, "position" to hold out the last ratings of every user in the
+    order of the coordinates (see RatingsMatrix.coo_file_order)
+    :param minRatings: users with fewer ratings are kept in training only
+    :param seed: seed of the random split
+    :return: (training coordinates, held-out coordinates)
+    """
+    userIndexes = coordinates[0]
+
+    if mode == "random":
+        order = np.lexsort((np.random.RandomState(seed).random_sample(len(userIndexes)), userIndexes))
+    elif mode == "position":
+        order = np.argsort(userIndexes, kind='stable')
+    else:
+        raise ValueError("Unknown split mode {}".format(mode))
+
+    # Rank of every rating among the ratings of its user, in the order of the split
+    counts = np.bincount(userIndexes)
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sortedUsers = userIndexes[order]
+    ranks = np.arange(len(order)) - offsets[sortedUsers]
+
+    numHeldOut = np.where(counts >= minRatings, np.ceil(counts * holdout), 0).astype(np.int64)
+    heldOut = np.zeros(len(userIndexes), dtype=bool)
+    heldOut[order] = ranks >= counts[sortedUsers] - numHeldOut[sortedUsers]
+
+    return tuple(array[~heldOut] for array in coordinates), tuple(array[heldOut] for array in coordinates)
+
+
+def ranking_metrics(hits, numRelevant):
+    """
+    Ranking metrics of every user from the hits of its recommendations.
+    :param hits: (users, k) boolean array, True where the recommendation at that rank is relevant
+    :param numRelevant: number of relevant movies of every user, > 0
+    :return: dictionary key=metric value=array of the metric of every user
+    """
+    k = hits.shape[1]
+    ranks = np.arange(1, k + 1)
+    discounts = 1.0 / np.log2(ranks + 1)
+    numHits = hits.sum(axis=1)
+    idealHits = np.minimum(numRelevant, k)
+
+    # Precision at the rank of every hit
+    precisions = np.cumsum(hits, axis=1) / ranks
+
+    return {
+        "precision": numHits / k,
+        "recall": numHits / numRelevant,
+        "ndcg": (hits * discounts).sum(axis=1) / np.cumsum(discounts)[idealHits - 1],
+        "map": (precisions * hits).sum(axis=1) / idealHits,
+    }
+
+
+def evaluate(system, trainSet, testSet, k=10, relevanceThreshold=4.0, chunkSize=None, numThreads=None):
+    """
+    Ranking metrics of the recommendations of a model trained on trainSet against the relevant ratings of testSet.
+    :param system: trained SVDNetflix object
+    :param trainSet: (user indexes, movie indexes, scores) of the training ratings, excluded from the recommendations
+    :param testSet: (user indexes, movie indexes, scores) of the held-out ratings
+    :param k: number of movies recommended to every user
+    :param relevanceThreshold: minimum held-out score of a relevant movie
+    :param chunkSize: number of users scored at once. Defaults to system.batchChunkSize
+    :param numThreads: number of threads processing chunks. Defaults to the number of CPUs
+    :return: dictionary with the mean of every metric, coverage, number of users evaluated and k
+    """
+    chunkSize = chunkSize or system.batchChunkSize
+    numUsers, numMovies = len(system.usersPreferences), len(system.moviesPreferences)
+    k = min(k, numMovies)
+
+    rated = sp.csr_matrix((np.ones(len(trainSet[0]), dtype=bool), (trainSet[0], trainSet[1])),
+                          shape=(numUsers, numMovies))
+    relevant = testSet[2] >= relevanceThreshold
+    relevantMatrix = sp.csr_matrix((np.ones(relevant.sum(), dtype=bool),
+                                    (testSet[0][relevant], testSet[1][relevant])), shape=(numUsers, numMovies))
+
+    # Only users with relevant held-out movies are evaluated
+    numRelevant = np.diff(relevantMatrix.indptr)
+    users = np.flatnonzero(numRelevant)
+
+    def evaluate_chunk(start):
+        rows = users[start:start + chunkSize]
+
+        ranking, scores = system.top_movies(rows, k, rated)
+        recommended = ~np.isneginf(scores)
+        hits = np.take_along_axis(relevantMatrix[rows].toarray(), ranking, axis=1) & recommended
+
+        metrics = ranking_metrics(hits, numRelevant[rows])
+        sums = {name: float(values.sum()) for name, values in metrics.items()}
+
+        return sums, np.unique(ranking[recommended])
+
+    with instrumentation.stage("evaluate", users=len(users), k=k):
+        with ThreadPoolExecutor(max_workers=numThreads or os.cpu_count()) as pool:
+            results = list(pool.map(evaluate_chunk, range(0, len(users), chunkSize)))
+
+    recommended = np.zeros(numMovies, dtype=bool)
+    totals = dict.fromkeys(METRICS, 0.0)
+
+    for sums, movies in results:
+        recommended[movies] = True
+
+        for name in METRICS:
+            totals[name] += sums[name]
+
+    report = {"{}@{}".format(name, k): totals[name] / max(len(users), 1) for name in METRICS}
+    report.update({"coverage": recommended.sum() / numMovies, "users": len(users), "k": k})
+
+    return report
+
+
+def holdout_report(system, k=10, holdout=0.2, mode="random", relevanceThreshold=4.0, engineName=None,
+                   numThreads=None, seed=0):
+    """
+    Train an initialized system on a per user split of its ratings and evaluate it on the held-out ratings.
+    :param system: initialized SVDNetflix object. Its factors are replaced
+    :param k: number of movies recommended to every user
+    :param holdout: fraction of the ratings of every user held out
+    :param mode: "random" or "position" (see split_by_user)
+    :param relevanceThreshold: minimum held-out score of a relevant movie
+    :param engineName: training engine, "als" included. Defaults to system.trainingEngine
+    :param numThreads: number of threads processing chunks. Defaults to the number of CPUs
+    :param seed: seed of the split
+    :return: dictionary returned by evaluate, plus the held-out RMSE
+    """
+    # File order, so "position" holds out the last ratings of every user in the ratings file
+    trainSet, testSet = split_by_user(system.ratingsMatrix.coo_file_order(), holdout, mode, seed=seed)
+    print("Training on {} ratings, {} held out...".format(len(trainSet[0]), len(testSet[0])))
+
+    engine = system.create_engine(engineName)
+    system.init_factors()
+
+    if engine.name == "als":
+        system.fit_als(trainSet, engine)
+    else:
+        system.fit(trainSet, engine)
+
+    report = evaluate(system, trainSet, testSet, k, relevanceThreshold, numThreads=numThreads)
+    report["rmse"] = system.rmse(testSet)
+
+    return report
+
+
+def print_report(report):
+    """
+    Print the metrics returned by evaluate or holdout_report.
+    :param report: dictionary
+    """
+    for name, value in report.items():
+        print("{:>14}: {}".format(name, value if isinstance(value, int) else "{:.5f}".format(value)))
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    import cli
+
+    # Same arguments as python cli.py evaluate
+    arguments = cli.parser().parse_args(["evaluate"] + sys.argv[1:])
+    arguments.function(arguments)
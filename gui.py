@@ -4,6 +4,7 @@ Script for Graphical User Interface
 
 from tkinter import *
 from tkinter import scrolledtext
+from recommender_system import format_recommendations
 
 class GUI:
     """
@@ -68,7 +69,7 @@ class GUI:
         query_limit = int(self.query_limit_txt.get())
 
         # Make query to recommender system.
-        recommendation = self.system.query(user_id, query_limit)
+        recommendation = format_recommendations(self.system.query(user_id, query_limit))
 
         # Add header
         recommendation = "Recommendations for user with id: {}\n************************************\n\n".format(user_id) + recommendation
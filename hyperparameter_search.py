@@ -0,0 +1,293 @@
+"""
+Search of the training hyperparameters of SVDNetflix over a process pool.
+
+Configurations come from a grid (every combination of the values of the search space) or are drawn at random. Every
+trial trains a model from scratch on the same training split and measures the RMSE of the validation split, the
+training time and the peak memory allocated (tracemalloc). With successive halving, every configuration is first
+trained with a fraction of its epochs, and only the best 1/eta of each rung is trained again with eta times more
+epochs, up to the full numEpochs.
+
+The split is written once as binary arrays (see model_store) and every worker memory-maps it read-only, so ratings are
+neither parsed nor copied per trial. Results of every trial go to one table (cfg.searchResults, csv):
+
+    python hyperparameter_search.py --mode random --trials 20 --workers 4 --halving --target-rmse 0.9
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import multiprocessing
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from chrono import Timer
+
+import config as cfg
+import model_store
+
+# Default search space: name of the attribute of SVDNetflix, and its values. A (low, high) tuple is sampled
+# log-uniformly by random search and expanded to its bounds by grid search
+SPACE = {
+    "numLatentFactors": [10, 20, 40],
+    "learningRate": [0.001, 0.005, 0.01],
+    "regularizeParameter": [0.01, 0.02, 0.05],
+    "numEpochs": [30, 60, 120],
+}
+
+# Split memory-mapped by every worker process
+_workerSplit = None
+
+
+def grid(space):
+    """
+    Every combination of the values of a search space.
+    :param space: dictionary key=name value=list of values or (low, high)
+    :return: list of configurations (dictionaries)
+    """
+    names = list(space)
+    values = [list(space[name]) for name in names]
+
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def random_configurations(space, numTrials, seed=0):
+    """
+    Configurations drawn at random from a search space.
+    :param space: dictionary key=name value=list of values, chosen uniformly, or (low, high), sampled log-uniformly
+    (as integers if both bounds are integers)
+    :param numTrials: number of configurations
+    :param seed: seed of the draws
+    :return: list of configurations (dictionaries)
+    """
+    random = np.random.RandomState(seed)
+    configurations = []
+
+    for _ in range(numTrials):
+        configuration = {}
+
+        for name, values in space.items():
+            if isinstance(values, tuple):
+                low, high = values
+                value = float(np.exp(random.uniform(np.log(low), np.log(high))))
+                configuration[name] = int(round(value)) if isinstance(low, int) and isinstance(high, int) else value
+            else:
+                configuration[name] = values[random.randint(len(values))]
+
+        configurations.append(configuration)
+
+    return configurations
+
+
+def write_split(system, path, holdout=0.1, seed=0):
+    """
+    Split the ratings of an initialized system and write both sets as binary arrays.
+    :param system: initialized SVDNetflix object
+    :param path: directory of the split
+    :param holdout: fraction of validation ratings
+    :param seed: seed of the split
+    """
+    from data import split_coordinates
+
+    trainSet, validationSet = split_coordinates(system.ratingsCoordinates, holdout, seed)
+    names = ("userIndexes", "movieIndexes", "scores")
+
+    arrays = dict(zip(["train_" + name for name in names], trainSet))
+    arrays.update(zip(["validation_" + name for name in names], validationSet))
+
+    model_store.write_arrays(path, kind="search_split", arrays=arrays,
+                             metadata={"shape": list(system.ratingsMatrix.shape), "holdout": holdout, "seed": seed})
+
+
+def read_split(path):
+    """
+    Memory-map a split written by write_split.
+    :param path: directory of the split
+    :return: (shape, training coordinates, validation coordinates)
+    """
+    metadata, arrays = model_store.read_arrays(path, kind="search_split", mmapMode='r')
+    names = ("userIndexes", "movieIndexes", "scores")
+
+    return (tuple(metadata["shape"]),
+            tuple(arrays["train_" + name] for name in names),
+            tuple(arrays["validation_" + name] for name in names))
+
+
+def _load_worker_split(path, engineName):
+    """
+    Initializer of the worker processes: memory-map the split and warm up the engine on a few ratings, so compilation
+    time (numba) is not measured by the first trial of the worker.
+    :param path: directory of the split
+    :param engineName: serial training engine run by every trial
+    """
+    from recommender_system import SVDNetflix
+    from training import get_engine
+
+    global _workerSplit
+    _workerSplit = read_split(path)
+
+    shape, trainSet, _ = _workerSplit
+    ratings = tuple(array[:1000] for array in trainSet)
+
+    system = SVDNetflix()
+    system.init_factors(shape)
+    engine = get_engine(engineName)
+    engine.run_epoch(ratings[0], ratings[1], system.residuals(ratings, 0),
+                     np.ascontiguousarray(system.usersPreferences[:, 0]),
+                     np.ascontiguousarray(system.moviesPreferences[:, 0]), system.learningRate,
+                     system.regularizeParameter)
+    engine.close()
+
+
+def run_trial(task):
+    """
+    Train a configuration on the split of the worker and measure it.
+    :param task: (trial number, rung, configuration, fraction of numEpochs, engine name, verbose)
+    :return: dictionary with trial, rung, the configuration, epochs, validationRmse, trainRmse, seconds and
+    peakMemoryMB
+    """
+    from recommender_system import SVDNetflix
+    from training import get_engine
+
+    trial, rung, configuration, fraction, engineName, verbose = task
+    shape, trainSet, validationSet = _workerSplit
+
+    system = SVDNetflix()
+    for name, value in configuration.items():
+        setattr(system, name, value)
+
+    # Metrics of the trials are in the results table: workers do not append to the log of the production training
+    system.trainingLog = None
+
+    system.numEpochs = max(1, int(round(configuration.get("numEpochs", system.numEpochs) * fraction)))
+    engine = get_engine(engineName)
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    tracemalloc.start()
+
+    try:
+        with output, Timer() as timed:
+            system.init_factors(shape)
+            system.fit(trainSet, engine, validationSet)
+
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(configuration, trial=trial, rung=rung, epochs=system.numEpochs,
+                validationRmse=system.rmse(validationSet), trainRmse=system.rmse(trainSet),
+                seconds=timed.elapsed, peakMemoryMB=peak / 2 ** 20)
+
+
+def search(configurations, splitPath, numWorkers=None, halving=False, eta=3, numRungs=3, engineName="auto",
+           verbose=False):
+    """
+    Train and measure every configuration over a process pool.
+    :param configurations: list of configurations (see grid and random_configurations)
+    :param splitPath: directory of the split (see write_split)
+    :param numWorkers: number of processes. Defaults to the number of CPUs
+    :param halving: successive halving: configurations start with numEpochs / eta ** (numRungs - 1) epochs and the best
+    1 / eta of every rung go on with eta times more
+    :param eta: reduction factor of successive halving
+    :param numRungs: number of rungs of successive halving
+    :param engineName: serial training engine run by every trial (see training.get_engine)
+    :param verbose: print the progress of the training of every trial
+    :return: DataFrame with one row per trial and rung
+    """
+    numRungs = numRungs if halving else 1
+    candidates = list(enumerate(configurations))
+    rows = []
+
+    with multiprocessing.get_context().Pool(numWorkers or os.cpu_count(), initializer=_load_worker_split,
+                                            initargs=(splitPath, engineName)) as pool:
+
+        for rung in range(numRungs):
+            fraction = float(eta) ** (rung - numRungs + 1)
+            print("Rung {}: {} configurations with {:.0%} of their epochs...".format(rung + 1, len(candidates),
+                                                                                   fraction))
+
+            results = pool.map(run_trial, [(trial, rung, configuration, fraction, engineName, verbose)
+                                           for (trial, configuration) in candidates])
+            rows.extend(results)
+
+            for result in results:
+                print("Trial {trial}, rung {rung}: validation RMSE {validationRmse:.5f}, {seconds:.2f}s, "
+                      "{peakMemoryMB:.1f} MB".format(**result))
+
+            # Best configurations of the rung go on to the next one
+            ranked = sorted(results, key=lambda result: result["validationRmse"])
+            kept = {result["trial"] for result in ranked[:max(1, len(ranked) // eta)]}
+            candidates = [(trial, configuration) for (trial, configuration) in candidates if trial in kept]
+
+    return pd.DataFrame(rows)
+
+
+def cheapest(results, targetRmse):
+    """
+    Fastest configuration trained with all its epochs whose validation RMSE meets a target.
+    :param results: DataFrame returned by search
+    :param targetRmse: maximum validation RMSE
+    :return: row of the configuration, None if no configuration meets the target
+    """
+    final = results[results["rung"] == results["rung"].max()]
+    meeting = final[final["validationRmse"] <= targetRmse]
+
+    if meeting.empty:
+        return None
+
+    return meeting.sort_values("seconds").iloc[0]
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Search the training hyperparameters of SVDNetflix")
+    parser.add_argument("--mode", choices=["grid", "random"], default="grid")
+    parser.add_argument("--trials", type=int, default=20, help="number of configurations of random search")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--halving", action="store_true", help="use successive halving")
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--rungs", type=int, default=3)
+    parser.add_argument("--holdout", type=float, default=0.1, help="fraction of validation ratings")
+    parser.add_argument("--engine", default="auto")
+    parser.add_argument("--target-rmse", type=float, help="pick the fastest configuration meeting this RMSE")
+    parser.add_argument("--output", default=cfg.searchResults)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true")
+    arguments = parser.parse_args()
+
+    from recommender_system import SVDNetflix
+
+    system = SVDNetflix()
+    system.initialize_system()
+
+    # The split is an artifact of the dataset, written once for every search with the same holdout
+    splitKey = system.artifacts.key("search_split", parameters={
+        "dataset": system.datasetKey, "holdout": arguments.holdout, "seed": arguments.seed})
+    splitPath = system.artifacts.lookup("search_split", splitKey)
+
+    if splitPath is None:
+        write_split(system, system.artifacts.path("search_split", splitKey), arguments.holdout, arguments.seed)
+        splitPath = system.artifacts.commit("search_split", splitKey)
+
+    if arguments.mode == "grid":
+        configurations = grid(SPACE)
+    else:
+        configurations = random_configurations(SPACE, arguments.trials, arguments.seed)
+
+    results = search(configurations, splitPath, arguments.workers, arguments.halving, arguments.eta,
+                     arguments.rungs, arguments.engine, arguments.verbose)
+    results.to_csv(arguments.output, index=False)
+
+    print(results.sort_values(["rung", "validationRmse"], ascending=[False, True]).to_string(index=False))
+    print("Results written to {}".format(arguments.output))
+
+    if arguments.target_rmse is not None:
+        best = cheapest(results, arguments.target_rmse)
+
+        if best is None:
+            print("No configuration reaches a validation RMSE of {}".format(arguments.target_rmse))
+        else:
+            print("Fastest configuration with validation RMSE <= {}:\n{}".format(arguments.target_rmse,
+                                                                                best.to_string()))
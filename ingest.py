@@ -0,0 +1,179 @@
+"""
+Streaming ingestion of the ratings file for datasets larger than memory.
+
+ratings.csv is parsed in chunks of a fixed number of rows with compact dtypes (int32 ids and float32 scores), so peak
+memory is bounded by the chunk size. Chunks are written as shards: artifact directories (see model_store) with the
+user index, movie index and score of every rating as raw columns. Ids are mapped to indexes the same way as
+data.RatingsData.from_columns, so shards and the in-memory ratings share the indexes of users and movies:
+
+    path/header.json          ids of users and movies in index order, names of the shards
+    path/shard_00000/...      userIndexes, movieIndexes and scores of the first chunk of ratings
+    ...
+
+Training iterates over the shards, memory-mapped, in epoch-sized passes (see SVDNetflix.fit_shards).
+"""
+
+import os
+import shutil
+
+import numpy as np
+
+import instrumentation
+import model_store
+
+# Columns of ratings.csv: user id, movie id and score
+RATINGS_DTYPES = {0: np.int32, 1: np.int32, 2: np.float32}
+
+
+def read_ratings_chunks(csvPath, chunkSize=1000000):
+    """
+    Parse a ratings file in chunks.
+    :param csvPath: path of the csv file, without header
+    :param chunkSize: number of ratings parsed at once
+    :return: generator of (user ids, movie ids, scores) arrays
+    """
+    import pandas as pd
+
+    for chunk in pd.read_csv(csvPath, header=None, dtype=RATINGS_DTYPES, chunksize=chunkSize):
+        yield chunk[0].values, chunk[1].values, chunk[2].values
+
+
+def read_ratings_columns(csvPath, chunkSize=1000000):
+    """
+    Read a ratings file in compact columns, parsing it in chunks so that no full DataFrame is built.
+    :param csvPath: path of the csv file, without header
+    :param chunkSize: number of ratings parsed at once
+    :return: (user ids, movie ids, scores) arrays
+    """
+    from data import AppendBuffer
+
+    columns = [AppendBuffer(np.empty(0, dtype=RATINGS_DTYPES[column]), minCapacity=chunkSize)
+               for column in range(3)]
+
+    for chunk in read_ratings_chunks(csvPath, chunkSize):
+        for column, values in zip(columns, chunk):
+            column.append(values)
+
+    return tuple(column.array for column in columns)
+
+
+def ingest_ratings(csvPath, path, knownUsers=(), knownMovies=(), chunkSize=1000000):
+    """
+    Write a ratings file as shards of binary columns.
+
+    The first pass parses the csv file and writes every chunk with its raw ids, collecting the sorted ids of users and
+    movies. The second pass maps the ids of every shard to indexes. The header of the shards directory is written
+    last, so an interrupted ingestion is not considered complete.
+    :param csvPath: path of the csv file, without header
+    :param path: shards directory. Replaced if it exists
+    :param knownUsers: ids of users without ratings which get an index too (users file)
+    :param knownMovies: ids of movies without ratings which get an index too (movies file)
+    :param chunkSize: number of ratings parsed at once and stored in every shard
+    :return: RatingShards object
+    """
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+    userIds = np.unique(np.asarray(knownUsers, dtype=np.int64))
+    movieIds = np.unique(np.asarray(knownMovies, dtype=np.int64))
+    shards = []
+    numRatings = 0
+
+    with instrumentation.stage("ingest.ratings") as timed:
+        for number, (users, movies, scores) in enumerate(read_ratings_chunks(csvPath, chunkSize)):
+            name = "shard_{:05d}".format(number)
+            model_store.write_arrays(os.path.join(path, name + ".raw"), kind="raw_ratings_shard",
+                                     arrays={"userIds": users, "movieIds": movies, "scores": scores})
+
+            userIds = np.union1d(userIds, users)
+            movieIds = np.union1d(movieIds, movies)
+            shards.append(name)
+            numRatings += len(scores)
+
+            print("Parsed {} ratings in {} shards...".format(numRatings, len(shards)))
+
+        # Indexes of users and movies are their positions in the sorted ids
+        for name in shards:
+            rawPath = os.path.join(path, name + ".raw")
+            _, raw = model_store.read_arrays(rawPath, kind="raw_ratings_shard")
+
+            model_store.write_arrays(os.path.join(path, name), kind="ratings_shard", arrays={
+                "userIndexes": np.searchsorted(userIds, raw["userIds"]).astype(np.int32),
+                "movieIndexes": np.searchsorted(movieIds, raw["movieIds"]).astype(np.int32),
+                "scores": raw["scores"],
+            })
+
+            del raw
+            shutil.rmtree(rawPath)
+
+        model_store.write_arrays(path, kind="rating_shards", arrays={"userIds": userIds, "movieIds": movieIds},
+                                 metadata={"shards": shards, "numRatings": numRatings, "chunkSize": chunkSize})
+
+    print("Ingested {} ratings of {} users and {} movies in {:.2f}s".format(numRatings, len(userIds), len(movieIds),
+                                                                           timed.elapsed))
+
+    return RatingShards(path)
+
+
+class RatingShards:
+    """
+    Ratings stored by ingest_ratings. Shards are memory-mapped on access, so only the pages being read are loaded.
+    """
+
+    def __init__(self, path, mmapMode='r'):
+        """
+        :param path: shards directory
+        :param mmapMode: mode to memory-map the arrays, None to read them in memory
+        """
+        metadata, arrays = model_store.read_arrays(path, kind="rating_shards", mmapMode=mmapMode)
+
+        self.path = path
+        self.mmapMode = mmapMode
+        self.userIds = arrays["userIds"]
+        self.movieIds = arrays["movieIds"]
+        self.shards = metadata["shards"]
+        self.numRatings = metadata["numRatings"]
+        self.shape = (len(self.userIds), len(self.movieIds))
+
+    def shard(self, number):
+        """
+        Ratings of one shard.
+        :param number: position of the shard
+        :return: (user indexes, movie indexes, scores) arrays
+        """
+        _, arrays = model_store.read_arrays(os.path.join(self.path, self.shards[number]), kind="ratings_shard",
+                                            mmapMode=self.mmapMode)
+
+        return arrays["userIndexes"], arrays["movieIndexes"], arrays["scores"]
+
+    def __iter__(self):
+        for number in range(len(self.shards)):
+            yield self.shard(number)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def scratch(self, name, dtype=np.float32):
+        """
+        Writable column aligned with the ratings of every shard, stored next to them. Used to keep per-rating state
+        such as training residuals out of memory. Not part of the shards: contents are undefined until written.
+        :param name: name of the column
+        :param dtype: type of the values
+        :return: list of memory-mapped arrays, one per shard
+        """
+        columns = []
+
+        for number, (_, _, scores) in enumerate(self):
+            filename = os.path.join(self.path, self.shards[number], name + ".scratch.npy")
+            columns.append(np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=scores.shape))
+
+        return columns
+
+    def coordinates(self):
+        """
+        Every rating in memory, for datasets which fit in it.
+        :return: (user indexes, movie indexes, scores) arrays
+        """
+        shards = list(self)
+
+        return tuple(np.concatenate([shard[column] for shard in shards]) for column in range(3))
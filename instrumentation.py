@@ -0,0 +1,214 @@
+"""
+Instrumentation of the hot paths: named timers and counters sent to pluggable sinks.
+
+Code wraps a stage with `stage(name, **fields)` and counts events with `count(name, value, **fields)`. Every measure is
+sent as an event dictionary to every sink in `sinks`:
+
+    {"type": "timer", "name": "training.epoch", "seconds": 0.12, "engine": "numba", "feature": 0, "epoch": 3}
+    {"type": "counter", "name": "online.ratings", "value": 5}
+
+The default sink is `registry`, an in-process Registry which aggregates them. Optionally, per stage:
+
+ * peak memory allocated inside the stage over the memory allocated before it, with tracemalloc (added to timer
+   events as peakMemoryBytes)
+ * a cProfile dump of the stage, written as <profileDir>/<name>-<n>.prof
+
+Both slow the stages down and are off by default. They are enabled in config (which reads environment variables), so
+production runs are instrumented without editing code, or with configure. Inside nested stages only the outermost
+profiled stage is profiled, and the peak memory of a stage enclosing others is measured since its last inner stage.
+"""
+
+import cProfile
+import json
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+from chrono import Timer
+
+import config as cfg
+
+
+class Registry:
+    """
+    In-process sink which aggregates timers by name (count, total, maximum, peak memory) and sums counters.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        """
+        Aggregate an event.
+        :param event: event dictionary
+        """
+        with self.lock:
+            if event["type"] == "counter":
+                self.counters[event["name"]] = self.counters.get(event["name"], 0) + event["value"]
+                return
+
+            timer = self.timers.setdefault(event["name"], {"count": 0, "totalSeconds": 0.0, "maxSeconds": 0.0,
+                                                           "peakMemoryBytes": None})
+            timer["count"] += 1
+            timer["totalSeconds"] += event["seconds"]
+            timer["maxSeconds"] = max(timer["maxSeconds"], event["seconds"])
+
+            if event.get("peakMemoryBytes") is not None:
+                timer["peakMemoryBytes"] = max(timer["peakMemoryBytes"] or 0, event["peakMemoryBytes"])
+
+    def summary(self):
+        """
+        Aggregated measures.
+        :return: dictionary with timers (key=name value=count, totalSeconds, meanSeconds, maxSeconds and
+        peakMemoryBytes) and counters (key=name value=sum)
+        """
+        with self.lock:
+            timers = {name: dict(timer, meanSeconds=timer["totalSeconds"] / timer["count"])
+                      for name, timer in self.timers.items()}
+
+            return {"timers": timers, "counters": dict(self.counters)}
+
+    def reset(self):
+        """
+        Forget every measure.
+        """
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+
+class JsonLinesSink:
+    """
+    Sink which appends every event to a file as a JSON line (structured log).
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the log file
+        """
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def record(self, event):
+        """
+        Write an event.
+        :param event: event dictionary
+        """
+        line = json.dumps(event, default=str) + "\n"
+
+        with self.lock:
+            self.file.write(line)
+
+    def close(self):
+        self.file.close()
+
+
+# Sinks receiving every event. Any object with a record(event) method can be added
+registry = Registry()
+sinks = [registry]
+
+# Optional measures, see configure
+trackMemory = False
+profileStages = frozenset()
+profileDir = None
+
+# Number of profiles dumped of every stage, to name the files, and whether a profiler is running
+_profileCounts = {}
+_profiling = False
+
+
+def configure(logPath=None, memory=False, profile=(), profilePath=None):
+    """
+    Choose the sinks and the optional measures. Replaces the previous configuration, keeping the registry.
+    :param logPath: path of a JSON lines log of every event, None not to write it
+    :param memory: track the peak memory of every stage with tracemalloc
+    :param profile: names of the stages to profile with cProfile, "*" for every stage
+    :param profilePath: directory of the profiles. Defaults to the current directory
+    """
+    global trackMemory, profileStages, profileDir
+
+    for sink in sinks:
+        if isinstance(sink, JsonLinesSink):
+            sink.close()
+
+    sinks[:] = [registry]
+
+    if logPath:
+        sinks.append(JsonLinesSink(logPath))
+
+    trackMemory = memory
+    profileStages = frozenset(profile)
+    profileDir = profilePath or "."
+
+
+def emit(event):
+    """
+    Send an event to every sink.
+    :param event: event dictionary
+    """
+    for sink in sinks:
+        sink.record(event)
+
+
+def count(name, value=1, **fields):
+    """
+    Count an event.
+    :param name: name of the counter
+    :param value: amount added
+    :param fields: extra values of the event
+    """
+    emit(dict(fields, type="counter", name=name, value=value))
+
+
+@contextmanager
+def stage(name, **fields):
+    """
+    Measure the wrapped code as a stage. The timer is yielded, so its elapsed time can be read after the block.
+    Stages which raise an exception are not recorded.
+    :param name: name of the stage
+    :param fields: extra values of the event
+    """
+    global _profiling
+
+    profiler = None
+    memory = trackMemory
+
+    if memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        allocated = tracemalloc.get_traced_memory()[0]
+
+    if ("*" in profileStages or name in profileStages) and not _profiling:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        _profiling = True
+
+    try:
+        with Timer() as timed:
+            yield timed
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            _profiling = False
+
+    event = dict(fields, type="timer", name=name, seconds=timed.elapsed)
+
+    if profiler is not None:
+        number = _profileCounts.get(name, 0)
+        _profileCounts[name] = number + 1
+
+        event["profile"] = os.path.join(profileDir, "{}-{}.prof".format(name, number))
+        profiler.dump_stats(event["profile"])
+
+    if memory:
+        event["peakMemoryBytes"] = tracemalloc.get_traced_memory()[1] - allocated
+
+    emit(event)
+
+
+configure(cfg.instrumentationLog, cfg.instrumentMemory, cfg.profileStages, cfg.profileDir)
@@ -0,0 +1,204 @@
+"""
+Index of movies over their latent factors for "more movies like this one" queries.
+
+Movies are compared by the cosine similarity of their rows of moviesPreferences. Two search modes are available:
+
+ * exact: brute force over every movie, in blocks of queries.
+ * approximate: inverted file (IVF). Movies are clustered with spherical k-means and only the movies of the clusters
+   whose centroids are the most similar to the query are compared. Movies of each cluster are stored contiguously,
+   grouped with a sort order and an offsets array as in data.RatingsData.
+"""
+
+import numpy as np
+from scipy import sparse
+from chrono import Timer
+
+from ranking import top_n
+
+
+def normalize(vectors):
+    """
+    Scale rows to unit length. Rows of zeros are left unchanged.
+    :param vectors: 2-D array
+    :return: float32 array
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+
+    return vectors / norms
+
+
+class ItemIndex:
+    """
+    Exact and approximate cosine similarity search over item vectors.
+    """
+
+    def __init__(self, vectors, centroids, order, offsets):
+        """
+        Use ItemIndex.build to create an index.
+        :param vectors: (items, features) array of unit length rows
+        :param centroids: (lists, features) array of unit length centroids of the clusters
+        :param order: items sorted by cluster
+        :param offsets: boundaries of every cluster in order. Cluster i spans offsets[i]:offsets[i + 1]
+        """
+        self.vectors = vectors
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, vectors, numLists=None, iterations=10, seed=0, blockSize=65536):
+        """
+        Cluster the vectors with spherical k-means and create the index.
+        :param vectors: (items, features) array
+        :param numLists: number of clusters. Defaults to the square root of the number of items
+        :param iterations: iterations of k-means
+        :param seed: seed of the initial centroids
+        :param blockSize: number of items assigned to clusters at once
+        :return: ItemIndex object
+        """
+        vectors = normalize(vectors)
+        numItems = len(vectors)
+        numLists = max(1, min(numLists or int(np.sqrt(numItems)), numItems))
+
+        # Initial centroids: random items
+        centroids = vectors[np.random.RandomState(seed).choice(numItems, numLists, replace=False)]
+
+        for _ in range(iterations):
+            assignment = cls.assign(vectors, centroids, blockSize)
+
+            # Mean of the items of every cluster, as a sparse product
+            members = sparse.csr_matrix((np.ones(numItems, dtype=np.float32), (assignment, np.arange(numItems))),
+                                        shape=(numLists, numItems))
+            sums = members @ vectors
+
+            # Empty clusters keep their centroid
+            empty = np.asarray(members.sum(axis=1)).ravel() == 0
+            sums[empty] = centroids[empty]
+            centroids = normalize(sums)
+
+        assignment = cls.assign(vectors, centroids, blockSize)
+
+        order = np.argsort(assignment, kind='stable').astype(np.int32)
+        offsets = np.zeros(numLists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=numLists), out=offsets[1:])
+
+        return cls(vectors, centroids, order, offsets)
+
+    @staticmethod
+    def assign(vectors, centroids, blockSize):
+        """
+        Most similar centroid of every vector.
+        :return: array of cluster indexes
+        """
+        assignment = np.empty(len(vectors), dtype=np.int64)
+
+        for start in range(0, len(vectors), blockSize):
+            assignment[start:start + blockSize] = np.argmax(vectors[start:start + blockSize] @ centroids.T, axis=1)
+
+        return assignment
+
+    def search_exact(self, item, n=10):
+        """
+        Most similar items comparing against every item.
+        :param item: index of the query item
+        :param n: number of items
+        :return: (indexes, similarities) sorted by descending similarity, without the query item
+        """
+        scores = self.vectors @ self.vectors[item]
+        scores[item] = -np.inf
+
+        best = top_n(scores, n)
+
+        return best, scores[best]
+
+    def search_exact_batch(self, items, n=10, blockSize=1024):
+        """
+        Most similar items of many query items, comparing blocks of queries against every item.
+        :param items: indexes of the query items
+        :param n: number of items for every query
+        :param blockSize: number of queries compared at once
+        :return: (indexes, similarities) as (queries, n) arrays
+        """
+        items = np.asarray(items)
+        n = min(n, len(self.vectors) - 1)
+        indexes = np.empty((len(items), n), dtype=np.int32)
+        similarities = np.empty((len(items), n), dtype=np.float32)
+
+        for start in range(0, len(items), blockSize):
+            queries = items[start:start + blockSize]
+            scores = self.vectors[queries] @ self.vectors.T
+            scores[np.arange(len(queries)), queries] = -np.inf
+
+            best = top_n(scores, n)
+            indexes[start:start + len(queries)] = best
+            similarities[start:start + len(queries)] = np.take_along_axis(scores, best, axis=1)
+
+        return indexes, similarities
+
+    def search(self, item, n=10, numProbes=8):
+        """
+        Most similar items comparing only against the items of the closest clusters.
+        :param item: index of the query item
+        :param n: number of items
+        :param numProbes: number of clusters visited
+        :return: (indexes, similarities) sorted by descending similarity, without the query item
+        """
+        query = self.vectors[item]
+
+        # Items of the clusters with the most similar centroids
+        lists = top_n(self.centroids @ query, numProbes)
+        candidates = np.concatenate([self.order[self.offsets[cluster]:self.offsets[cluster + 1]] for cluster in lists])
+        candidates = candidates[candidates != item]
+
+        scores = self.vectors[candidates] @ query
+        best = top_n(scores, n)
+
+        return candidates[best], scores[best]
+
+    def recall_report(self, n=10, probes=(1, 2, 4, 8, 16), numQueries=1000, seed=0):
+        """
+        Compare the approximate search against the exact one on random query items.
+        :param n: number of items of every query
+        :param probes: values of numProbes to evaluate
+        :param numQueries: number of query items
+        :param seed: seed to choose the query items
+        :return: list of dictionaries with mode, numProbes, recall and average latency in milliseconds
+        """
+        numItems = len(self.vectors)
+        queries = np.random.RandomState(seed).choice(numItems, min(numQueries, numItems), replace=False)
+
+        with Timer() as timed:
+            exact = [set(self.search_exact(item, n)[0].tolist()) for item in queries]
+
+        report = [{"mode": "exact", "numProbes": None, "recall": 1.0,
+                   "latencyMs": 1000.0 * timed.elapsed / len(queries)}]
+
+        for numProbes in probes:
+            with Timer() as timed:
+                found = [set(self.search(item, n, numProbes)[0].tolist()) for item in queries]
+
+            hits = sum(len(approximate & truth) for approximate, truth in zip(found, exact))
+            total = sum(len(truth) for truth in exact)
+
+            report.append({"mode": "approximate", "numProbes": numProbes, "recall": hits / max(total, 1),
+                           "latencyMs": 1000.0 * timed.elapsed / len(queries)})
+
+        return report
+
+    def to_arrays(self):
+        """
+        Arrays to be stored on disk.
+        :return: dictionary key=name value=array
+        """
+        return {"vectors": self.vectors, "centroids": self.centroids, "order": self.order, "offsets": self.offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Build the index from the arrays returned by to_arrays. Arrays are not copied, so they can be memory-mapped.
+        :param arrays: dictionary key=name value=array
+        :return: ItemIndex object
+        """
+        return cls(arrays["vectors"], arrays["centroids"], arrays["order"], arrays["offsets"])
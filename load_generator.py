@@ -0,0 +1,164 @@
+"""
+Load generator for the HTTP service (see server).
+
+Opens a number of concurrent keep-alive connections which send requests back to back for a fixed time, and reports
+the throughput and the p50/p99 latency of every endpoint. Users and movies are drawn at random from the ids of the
+stored dataset.
+
+Run with: python load_generator.py [--host HOST] [--port PORT] [--connections N] [--seconds S] [--endpoint NAME]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import numpy as np
+
+import config as cfg
+import model_store
+from artifact_cache import ArtifactCache
+from data import dataset_key
+
+
+async def send(reader, writer, target):
+    """
+    Send a GET request over an open connection and read the response.
+    :param reader: asyncio StreamReader of the connection
+    :param writer: asyncio StreamWriter of the connection
+    :param target: path and query string
+    :return: (status code, body)
+    """
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(target).encode())
+    await writer.drain()
+
+    status = int((await reader.readline()).split()[1])
+    length = 0
+
+    while True:
+        line = await reader.readline()
+
+        if line in (b"\r\n", b"\n", b""):
+            break
+
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+
+    return status, await reader.readexactly(length)
+
+
+async def client(host, port, targets, deadline, latencies, errors):
+    """
+    Send requests over one connection until the deadline.
+    :param targets: function returning the next (endpoint, target)
+    :param deadline: time.perf_counter() value to stop at
+    :param latencies: dictionary key=endpoint value=list of seconds. Filled with every successful request
+    :param errors: list filled with the status code of every failed request
+    """
+    reader, writer = await asyncio.open_connection(host, port)
+
+    try:
+        while time.perf_counter() < deadline:
+            endpoint, target = targets()
+            start = time.perf_counter()
+            status, _ = await send(reader, writer, target)
+
+            if status == 200:
+                latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+            else:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+def report(latencies, errors, seconds):
+    """
+    Summarize the latencies of a run.
+    :param latencies: dictionary key=endpoint value=list of seconds
+    :param errors: list of status codes of failed requests
+    :param seconds: duration of the run
+    :return: list of dictionaries with endpoint, requests, throughput (requests per second), p50 and p99 in milliseconds
+    """
+    rows = []
+
+    for endpoint, values in sorted(latencies.items()) + [("all", sum(latencies.values(), []))]:
+        values = np.asarray(values) * 1000.0
+        rows.append({
+            "endpoint": endpoint,
+            "requests": len(values),
+            "throughput": len(values) / seconds,
+            "p50": float(np.percentile(values, 50)) if len(values) else None,
+            "p99": float(np.percentile(values, 99)) if len(values) else None,
+        })
+
+    rows[-1]["errors"] = len(errors)
+
+    return rows
+
+
+async def run(host, port, connections, seconds, endpoints, userIds, movieIds, seed=0):
+    """
+    Run the load test.
+    :param connections: number of concurrent connections
+    :param seconds: duration of the run
+    :param endpoints: endpoints to send requests to, chosen at random for every request
+    :param userIds: ids of users to query
+    :param movieIds: ids of movies to query
+    :param seed: seed of the random requests
+    :return: rows of report
+    """
+    generator = random.Random(seed)
+
+    def targets():
+        endpoint = generator.choice(endpoints)
+        user, movie = generator.choice(userIds), generator.choice(movieIds)
+
+        return endpoint, {
+            "recommend": "/recommend?user={}&n=10".format(user),
+            "predict": "/predict?user={}&movie={}".format(user, movie),
+            "similar": "/similar?movie={}&n=10".format(movie),
+        }[endpoint]
+
+    latencies, errors = {}, []
+    start = time.perf_counter()
+
+    await asyncio.gather(*(client(host, port, targets, start + seconds, latencies, errors)
+                           for _ in range(connections)))
+
+    return report(latencies, errors, time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure latency and throughput of the HTTP service")
+    parser.add_argument("--host", default=cfg.serverHost)
+    parser.add_argument("--port", type=int, default=cfg.serverPort)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--endpoint", action="append", choices=["recommend", "predict", "similar"])
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    arguments = parser.parse_args()
+
+    # Ids of users and movies of the stored dataset
+    cache = ArtifactCache(cfg.cache, maxEntries=cfg.cacheMaxEntries)
+    path = cache.lookup("dataset", dataset_key(cache))
+
+    if path is None:
+        raise SystemExit("No stored dataset for the current csv files: run the system once first")
+
+    _, arrays = model_store.read_arrays(path, kind="dataset")
+
+    rows = asyncio.run(run(arguments.host, arguments.port, arguments.connections, arguments.seconds,
+                           arguments.endpoint or ["recommend"], arrays["userIds"].tolist(),
+                           arrays["movieIds"].tolist()))
+
+    if arguments.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        for row in rows:
+            print("{endpoint:>10}: {requests} requests, {throughput:.1f} req/s, p50 {p50:.2f} ms, p99 {p99:.2f} ms"
+                  .format(**row))
+
+        print("Errors: {}".format(rows[-1]["errors"]))
@@ -0,0 +1,146 @@
+"""
+Binary on-disk format for models and datasets.
+
+Every artifact is a directory with one raw .npy file per array and a small JSON header. The header holds the format
+version, free metadata (hyperparameters, titles...) and the shape, dtype and checksum of every array. Arrays are opened
+memory-mapped, so loading does not parse anything and several processes share the same pages through the OS cache.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# Version of the format written by this module
+FORMAT_VERSION = 1
+
+# Name of the header file inside an artifact directory
+HEADER = "header.json"
+
+
+class FormatError(Exception):
+    """
+    Raised when an artifact directory cannot be read: unknown version, missing arrays or wrong checksum.
+    """
+    pass
+
+
+def exists(path):
+    """
+    Check if a complete artifact is stored in the directory. The header is written last, so an interrupted write is
+    not considered complete.
+    :param path: artifact directory
+    :return: boolean
+    """
+    return os.path.isfile(os.path.join(path, HEADER))
+
+
+def checksum(filename, blockSize=1 << 20):
+    """
+    SHA-256 of a file.
+    :param filename: path of the file
+    :param blockSize: bytes read at once
+    :return: hexadecimal digest
+    """
+    digest = hashlib.sha256()
+
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(blockSize), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def write_arrays(path, kind, arrays, metadata=None):
+    """
+    Write an artifact directory.
+    :param path: artifact directory. Created if it does not exist
+    :param kind: type of artifact ("model", "dataset"...), checked when reading
+    :param arrays: dictionary key=name value=numpy array
+    :param metadata: JSON serializable dictionary stored in the header
+    """
+    os.makedirs(path, exist_ok=True)
+
+    # Remove the header first, so a reader never sees a header with arrays from another write
+    if exists(path):
+        os.remove(os.path.join(path, HEADER))
+
+    description = {}
+
+    for name, array in arrays.items():
+        filename = os.path.join(path, name + ".npy")
+        np.save(filename, np.ascontiguousarray(array))
+
+        description[name] = {
+            "shape": list(np.shape(array)),
+            "dtype": np.asarray(array).dtype.str,
+            "sha256": checksum(filename),
+        }
+
+    header = {
+        "kind": kind,
+        "version": FORMAT_VERSION,
+        "metadata": metadata or {},
+        "arrays": description,
+    }
+
+    # Global checksum over the checksum of every array
+    header["checksum"] = hashlib.sha256(
+        "".join(description[name]["sha256"] for name in sorted(description)).encode()).hexdigest()
+
+    temporary = os.path.join(path, HEADER + ".tmp")
+    with open(temporary, 'w') as file:
+        json.dump(header, file)
+
+    os.replace(temporary, os.path.join(path, HEADER))
+
+
+def read_header(path):
+    """
+    Read the header of an artifact directory.
+    :param path: artifact directory
+    :return: header dictionary
+    """
+    with open(os.path.join(path, HEADER)) as file:
+        header = json.load(file)
+
+    if header.get("version") != FORMAT_VERSION:
+        raise FormatError("Unsupported format version {} in {}".format(header.get("version"), path))
+
+    return header
+
+
+def read_arrays(path, kind, mmapMode='r', verify=False):
+    """
+    Read an artifact directory.
+    :param path: artifact directory
+    :param kind: expected type of artifact
+    :param mmapMode: mode to memory-map the arrays (see numpy.load), None to read them in memory
+    :param verify: check the checksum of every array. Reads every file completely
+    :return: (metadata, dictionary key=name value=array)
+    """
+    header = read_header(path)
+
+    if header["kind"] != kind:
+        raise FormatError("{} holds a {}, expected a {}".format(path, header["kind"], kind))
+
+    arrays = {}
+
+    for name, description in header["arrays"].items():
+        filename = os.path.join(path, name + ".npy")
+
+        if not os.path.isfile(filename):
+            raise FormatError("Array {} is missing in {}".format(name, path))
+
+        if verify and checksum(filename) != description["sha256"]:
+            raise FormatError("Checksum of array {} does not match in {}".format(name, path))
+
+        array = np.load(filename, mmap_mode=mmapMode)
+
+        if list(array.shape) != description["shape"] or array.dtype.str != description["dtype"]:
+            raise FormatError("Array {} does not match its header in {}".format(name, path))
+
+        arrays[name] = array
+
+    return header["metadata"], arrays
@@ -0,0 +1,245 @@
+"""
+Training engines that run each epoch of SGD over several worker processes.
+
+Ratings, residuals and the values of the feature being trained live in shared memory (see shared_workers),
+so workers read and update them in place without copies. Each worker runs a serial engine (see training) over its
+share of the ratings:
+
+ * hogwild: ratings are split in contiguous shards, one per worker, and every worker updates the shared values without
+   locks. Ratings are sorted by user, so workers rarely touch the same users; movies are shared.
+ * dsgd: users and movies are split in as many blocks as workers. An epoch runs in as many strata as workers and, in
+   each stratum, every worker takes a block of ratings whose users and movies are not touched by any other worker.
+
+Engines are registered in training.ENGINES, so they are selected by name like serial engines.
+"""
+
+import os
+
+import numpy as np
+from chrono import Timer
+
+import shared_workers
+import training
+from data import split_coordinates
+from shared_workers import SharedWorkers
+
+# Serial engine of every worker process
+_workerEngine = None
+
+
+def _create_engine(engineName):
+    """
+    Initializer of the worker processes, once attached to the shared arrays: create the serial engine.
+    :param engineName: name of the serial engine run by every worker
+    """
+    global _workerEngine
+    _workerEngine = training.get_engine(engineName)
+
+
+def _run_shard(task):
+    """
+    Run the serial engine over a range of the shared ratings.
+    :param task: (start, end, learningRate, regularizeParameter)
+    """
+    start, end, learningRate, regularizeParameter = task
+    arrays = shared_workers.workerArrays
+
+    if end > start:
+        arrays["errors"][start:end] = _workerEngine.run_epoch(
+            arrays["userIndexes"][start:end],
+            arrays["movieIndexes"][start:end],
+            arrays["residuals"][start:end],
+            arrays["userValue"],
+            arrays["movieValue"],
+            learningRate,
+            regularizeParameter)
+
+
+class HogwildEngine:
+    """
+    Lock-free parallel SGD over contiguous shards of the ratings.
+    """
+
+    name = "hogwild"
+
+    def __init__(self, numWorkers=None, engineName="auto"):
+        """
+        :param numWorkers: number of worker processes. Defaults to the number of CPUs
+        :param engineName: serial engine run by every worker (see training.get_engine)
+        """
+        self.numWorkers = numWorkers or os.cpu_count()
+        self.engineName = engineName
+        self.workers = None
+        self.ratings = None
+
+    def start(self, userIndexes, movieIndexes, userValue, movieValue):
+        """
+        Copy the ratings to shared memory and start the workers, unless they were started for the same ratings.
+        """
+        if self.workers is not None and self.ratings is userIndexes:
+            return
+
+        self.close()
+        self.ratings = userIndexes
+        self.workers = SharedWorkers({
+            "userIndexes": userIndexes,
+            "movieIndexes": movieIndexes,
+            "residuals": np.zeros(len(userIndexes), dtype=np.float32),
+            "errors": np.zeros(len(userIndexes), dtype=np.float32),
+            "userValue": userValue,
+            "movieValue": movieValue,
+        }, self.numWorkers, initializer=_create_engine, initargs=(self.engineName,))
+
+    def run_epoch(self, userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate,
+                  regularizeParameter):
+        """
+        Run one epoch of Hogwild SGD. Same parameters as training.ReferenceEngine.run_epoch
+        """
+        self.start(userIndexes, movieIndexes, userValue, movieValue)
+        shared = self.workers.arrays
+
+        shared["residuals"][...] = residuals
+        shared["userValue"][...] = userValue
+        shared["movieValue"][...] = movieValue
+
+        bounds = np.linspace(0, len(residuals), self.numWorkers + 1).astype(np.int64)
+        self.workers.map(_run_shard, [(start, end, learningRate, regularizeParameter)
+                                      for (start, end) in zip(bounds[:-1], bounds[1:])])
+
+        userValue[...] = shared["userValue"]
+        movieValue[...] = shared["movieValue"]
+
+        return shared["errors"].copy()
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory.
+        """
+        if self.workers is not None:
+            self.workers.close()
+
+        self.workers = None
+        self.ratings = None
+
+
+class DSGDEngine(HogwildEngine):
+    """
+    Stratified SGD over blocks of ratings with disjoint users and movies.
+    """
+
+    name = "dsgd"
+
+    def __init__(self, numWorkers=None, engineName="auto", seed=0):
+        """
+        :param numWorkers: number of worker processes and of blocks of users and movies. Defaults to the number of CPUs
+        :param engineName: serial engine run by every worker (see training.get_engine)
+        :param seed: seed of the random assignment of users and movies to blocks
+        """
+        super().__init__(numWorkers, engineName)
+        self.seed = seed
+        self.order = None
+        self.offsets = None
+
+    def start(self, userIndexes, movieIndexes, userValue, movieValue):
+        """
+        Sort the ratings by block, copy them to shared memory and start the workers, unless they were started for the
+        same ratings.
+        """
+        if self.workers is not None and self.ratings is userIndexes:
+            return
+
+        numBlocks = self.numWorkers
+        random = np.random.RandomState(self.seed)
+
+        # Users and movies are assigned to blocks at random, which balances the number of ratings of the blocks
+        userBlocks = random.permutation(len(userValue)) % numBlocks
+        movieBlocks = random.permutation(len(movieValue)) % numBlocks
+        blocks = userBlocks[userIndexes] * numBlocks + movieBlocks[movieIndexes]
+
+        # Ratings grouped by block, keeping their order inside each block
+        self.order = np.argsort(blocks, kind='stable')
+        self.offsets = np.zeros(numBlocks * numBlocks + 1, dtype=np.int64)
+        np.cumsum(np.bincount(blocks, minlength=numBlocks * numBlocks), out=self.offsets[1:])
+
+        super().start(userIndexes[self.order], movieIndexes[self.order], userValue, movieValue)
+        self.ratings = userIndexes
+
+    def run_epoch(self, userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate,
+                  regularizeParameter):
+        """
+        Run one epoch of DSGD. Same parameters as training.ReferenceEngine.run_epoch
+        """
+        self.start(userIndexes, movieIndexes, userValue, movieValue)
+        shared = self.workers.arrays
+        numBlocks = self.numWorkers
+
+        shared["residuals"][...] = residuals[self.order]
+        shared["userValue"][...] = userValue
+        shared["movieValue"][...] = movieValue
+
+        # In stratum s, worker w trains users of block w with movies of block (w + s) % numBlocks
+        for stratum in range(numBlocks):
+            blocks = [worker * numBlocks + (worker + stratum) % numBlocks for worker in range(numBlocks)]
+            self.workers.map(_run_shard, [(self.offsets[block], self.offsets[block + 1], learningRate,
+                                           regularizeParameter) for block in blocks])
+
+        userValue[...] = shared["userValue"]
+        movieValue[...] = shared["movieValue"]
+
+        # Errors in the original order of the ratings
+        errors = np.empty(len(residuals), dtype=np.float32)
+        errors[self.order] = shared["errors"]
+
+        return errors
+
+
+training.ENGINES[HogwildEngine.name] = HogwildEngine
+training.ENGINES[DSGDEngine.name] = DSGDEngine
+
+
+def scaling_report(system, workers=(2, 4, 8), holdout=0.1, seed=0):
+    """
+    Train the system with the serial engine and with every parallel engine and number of workers on the same
+    training split, and compare wall time and RMSE on the held-out split. Factor matrices of the system are
+    reinitialized before every training, and are left as trained by the last engine.
+    :param system: initialized SVDNetflix object
+    :param workers: numbers of worker processes to evaluate
+    :param holdout: fraction of held-out ratings
+    :param seed: seed of the split
+    :return: list of dictionaries with engine, workers, seconds, speedup, efficiency and held-out RMSE
+    """
+    trainSet, testSet = split_coordinates(system.ratingsCoordinates, holdout, seed)
+
+    configurations = [(training.get_engine("auto"), 1)]
+    for numWorkers in workers:
+        configurations.append((HogwildEngine(numWorkers), numWorkers))
+        configurations.append((DSGDEngine(numWorkers), numWorkers))
+
+    # Warm up the serial engine, so compilation time is not measured
+    warmUp = tuple(array[:1000] for array in trainSet)
+    system.init_factors()
+    system.fit(warmUp, configurations[0][0])
+
+    report = []
+
+    for engine, numWorkers in configurations:
+        system.init_factors()
+
+        with Timer() as timed:
+            system.fit(trainSet, engine)
+
+        serialTime = report[0]["seconds"] if report else timed.elapsed
+
+        report.append({
+            "engine": engine.name,
+            "workers": numWorkers,
+            "seconds": timed.elapsed,
+            "speedup": serialTime / timed.elapsed,
+            "efficiency": serialTime / (timed.elapsed * numWorkers),
+            "rmse": system.rmse(testSet),
+        })
+
+        print("{engine} with {workers} workers: {seconds:.2f}s, speedup {speedup:.2f}, efficiency {efficiency:.2f}, "
+              "held-out RMSE {rmse:.4f}".format(**report[-1]))
+
+    return report
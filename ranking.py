@@ -0,0 +1,24 @@
+"""
+Selection of the best items from arrays of scores.
+"""
+
+import numpy as np
+
+
+def top_n(scores, n):
+    """
+    Indexes of the n highest scores along the last axis, sorted by descending score.
+    :param scores: 1-D or 2-D array of scores
+    :param n: number of indexes to return
+    :return: array of indexes
+    """
+    n = max(0, min(n, scores.shape[-1]))
+
+    if n == 0:
+        return np.empty(scores.shape[:-1] + (0,), dtype=np.int64)
+
+    # Unsorted n best, then sort only them
+    candidates = np.argpartition(-scores, n - 1, axis=-1)[..., :n]
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind='stable')
+
+    return np.take_along_axis(candidates, order, axis=-1)
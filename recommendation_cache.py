@@ -0,0 +1,120 @@
+"""
+Bounded cache of the recommendations of every user.
+
+Entries are keyed by (model version, user id, number of movies) and evicted in least recently used order, so the most
+active users are answered without scoring any movie. A new model (new version) makes every entry stale, and so does an
+online update which changes factors of movies; an update which only changes factors of users makes the entries of those
+users stale (see SVDNetflix.add_ratings). Stale entries are dropped explicitly.
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class RecommendationCache:
+    """
+    LRU cache with hit, miss, eviction and invalidation counters. Safe to use from several threads.
+    """
+
+    def __init__(self, maxEntries=10000):
+        """
+        :param maxEntries: maximum number of entries. 0 disables the cache
+        """
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.keysByUser = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Cached value of a key, which becomes the most recently used one.
+        :param key: (model version, user id, n)
+        :return: value, None if it is not cached
+        """
+        with self.lock:
+            value = self.entries.get(key)
+
+            if value is None:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return value
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used entries beyond maxEntries.
+        :param key: (model version, user id, n)
+        :param value: recommendations
+        """
+        if self.maxEntries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.keysByUser.setdefault(key[1], set()).add(key)
+
+            while len(self.entries) > self.maxEntries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.forget(evicted)
+                self.evictions += 1
+
+    def forget(self, key):
+        """
+        Remove a key from the keys of its user. Called with the lock held.
+        """
+        keys = self.keysByUser.get(key[1])
+
+        if keys is not None:
+            keys.discard(key)
+
+            if not keys:
+                del self.keysByUser[key[1]]
+
+    def invalidate_users(self, user_ids):
+        """
+        Drop every entry of some users.
+        :param user_ids: ids of the users
+        """
+        with self.lock:
+            for user in user_ids:
+                for key in self.keysByUser.pop(user, ()):
+                    del self.entries[key]
+                    self.invalidations += 1
+
+    def invalidate_all(self):
+        """
+        Drop every entry, for instance when a new model is loaded.
+        """
+        with self.lock:
+            self.invalidations += len(self.entries)
+            self.entries.clear()
+            self.keysByUser.clear()
+
+    def stats(self):
+        """
+        Counters of the cache.
+        :return: dictionary with entries, hits, misses, evictions, invalidations and hit rate
+        """
+        with self.lock:
+            requests = self.hits + self.misses
+
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hitRate": self.hits / requests if requests else 0.0,
+            }
+
+    def __len__(self):
+        return len(self.entries)
@@ -2,12 +2,24 @@
 Script to hold code to construct the content-based recommender system.
 """
 
-from data import Reader
-from chrono import Timer
+from data import Reader, create_ratings_matrix, load_dataset, dataset_key, load_similarities, write_similarities, \
+    split_coordinates, AppendBuffer
+from similarity import TagSimilarities
+from artifact_cache import ArtifactCache
+from recommendation_cache import RecommendationCache
+from checkpoint import CheckpointManager, random_state, set_random_state
+from ranking import top_n
+from item_index import ItemIndex
+from als import ALSSolver, solve_rows
 import numpy as np
-import pickle
+import model_store
+import instrumentation
 import config as cfg
+import importlib.util
 import os
+import json
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 class SVDNetflix:
 
@@ -20,57 +32,298 @@ class SVDNetflix:
     userIndexes = None
     moviesIndexes = None
     ratingsTuples = None
+    _ratingsCoordinates = None
+    trainingCoordinates = None
+    validationCoordinates = None
+
+    # Name of the engine which trained the current factor matrices
+    trainedEngine = None
+
+    # Ids of the users and movies of the rating shards the factor matrices were trained on (see fit_shards), in index
+    # order, for systems without ratings in memory
+    shardUserIds = None
+    shardMovieIds = None
 
     # Singular Value Decomposition parameters
     usersPreferences = None
     moviesPreferences = None
+
+    # Baseline of the predictions: globalMean + userBiases[u] + movieBiases[i] is added to the product of the factors.
+    # Biases are computed from the ratings before training the factors, shrunk towards 0 by a regularization which
+    # acts as that number of ratings at the global mean. With useBiases disabled the baseline is 0
+    useBiases = True
+    userBiasRegularization = 10
+    movieBiasRegularization = 25
+    globalMean = 0.0
+    userBiases = None
+    movieBiases = None
     numLatentFactors = 40
     initializationValue = 0.1
     learningRate = 0.001
     regularizeParameter = 0.02 # As recommended in the article https://sifter.org/~simon/journal/20061211.html
     numEpochs = 120
 
+    # Fraction of ratings held out to validate the training. Training of a feature stops once the validation RMSE
+    # improves less than convergenceTolerance in an epoch
+    validationFraction = 0.05
+    convergenceTolerance = 1e-5
+
+    # Factor applied to the learning rate after every epoch of a feature
+    learningRateDecay = 1.0
+
+    # Engine that trains the system: SGD engines "reference", "numpy", "numba", "hogwild", "dsgd" or "auto", or
+    # "als" for Alternating Least Squares
+    trainingEngine = "auto"
+
+    # Worker processes of the ALS solver
+    trainingWorkers = 1
+
+    # Sweeps of the ALS solver
+    alsSweeps = 10
+
+    # Number of users scored at once by recommend_batch
+    batchChunkSize = 512
+
+    # Clusters visited by the approximate search of similar movies (see item_index)
+    itemIndexProbes = 8
+
+    # SGD steps over the new ratings run by add_ratings, and their learning rate
+    onlineSteps = 5
+    onlineLearningRate = 0.01
+
     def __init__(self):
         self.tag_movie = {}
         self.initialized = False
-        self.movie_similarities = {}
 
-        # Cache for avoiding calculating product between feature vectors on each call to predict function.
+        # k most similar movies of every movie according to their tags (see similarity.TagSimilarities)
+        self.movie_similarities = None
+
+        # Residual of every rating left by the features which are not being trained. Avoids calculating the product
+        # between feature vectors on each prediction during training. Same for validation ratings.
         self.cache = None
+        self.validationCache = None
+
+        # Hyperparameters of the last model loaded from disk
+        self.modelHyperparameters = None
+
+        # JSON lines log of the metrics of every epoch of fit, None not to log them
+        self.trainingLog = cfg.trainingLog
+
+        # Artifacts computed from the csv files: binary data and models
+        self.artifacts = ArtifactCache(cfg.cache, maxEntries=cfg.cacheMaxEntries)
+        self.datasetKey = None
+        self.modelPath = None
+
+        # Index of movies over their latent factors, for similar_items
+        self.itemIndex = None
+
+        # Ratings added by add_ratings since the system was initialized, and buffers the factor matrices grow in
+        self.onlineUpdates = 0
+        self.factorBuffers = None
 
-    def initialize_system(self):
+        # Recommendations of query, keyed by (modelVersion, user_id, query_limit). modelVersion changes whenever the
+        # factor matrices are replaced
+        self.modelVersion = 0
+        self.recommendationCache = RecommendationCache(cfg.recommendationCacheSize)
+
+    def initialize_system(self, datasetPath=None):
+        """
+        Read the data and initialize the factor matrices.
+        :param datasetPath: dataset directory (see data.load_dataset) read instead of the one of the current csv files,
+        which are then not read at all. Its name is its key in the artifact cache
+        """
         if not self.initialized:
-            # Read data directly from this class
-            reader = Reader()
-            reader.write_serialized()
+            # Read binary data if stored for the current csv files, csv files otherwise
+            if datasetPath is not None:
+                self.datasetKey = os.path.basename(os.path.normpath(datasetPath))
+                path = datasetPath
+            else:
+                self.datasetKey = dataset_key(self.artifacts)
+                path = self.artifacts.lookup("dataset", self.datasetKey)
 
-            users, movies, self.ratingsTuples = reader.load_serialized()
-            (self.ratingsMatrix, self.userIndexes, self.moviesIndexes) = reader.create_ratings_matrix(users, movies)
+            if path is not None:
+                print("Serialized data exists. Reading from disk...")
+                users, movies, self.ratingsTuples = load_dataset(path)
+            else:
+                users, movies, self.ratingsTuples = Reader(cache=self.artifacts).write_serialized()
+
+            (self.ratingsMatrix, self.userIndexes, self.moviesIndexes) = create_ratings_matrix(users, movies)
+            self.ratingsCoordinates = None
 
             # Store data in class attributes
             self.users = users
             self.movies = movies
 
             # Initialize both matrix from SVD
-            numUsers = len(users)
-            numMovies = len(movies)
-
-            ## Users preferences: numUsers * numLatentFactors
-            self.usersPreferences = np.full(
-                shape=(numUsers, self.numLatentFactors),
-                fill_value=self.initializationValue,
-                dtype=float)
-
-            ## Movies description: numMovies * numLatentFactors
-            self.moviesPreferences = np.full(
-                shape=(numMovies, self.numLatentFactors),
-                fill_value=self.initializationValue,
-                dtype=float
-            )
+            self.init_factors()
 
             # Control initialization of the system
             self.initialized = True
 
+    @property
+    def ratingsCoordinates(self):
+        """
+        Coordinates of every rating (see RatingsMatrix.coo), built when first read after the ratings change, so
+        loading a model for serving does not copy the ratings.
+        """
+        if self._ratingsCoordinates is None and self.ratingsMatrix is not None:
+            self._ratingsCoordinates = self.ratingsMatrix.coo()
+
+        return self._ratingsCoordinates
+
+    @ratingsCoordinates.setter
+    def ratingsCoordinates(self, coordinates):
+        self._ratingsCoordinates = coordinates
+
+    def init_factors(self, shape=None):
+        """
+        Set every value of both matrix from SVD to initializationValue.
+        :param shape: (number of users, number of movies). Defaults to the shape of the ratings matrix
+        """
+        numUsers, numMovies = shape or self.ratingsMatrix.shape
+
+        ## Users preferences: numUsers * numLatentFactors
+        self.usersPreferences = np.full(
+            shape=(numUsers, self.numLatentFactors),
+            fill_value=self.initializationValue,
+            dtype=float)
+
+        ## Movies description: numMovies * numLatentFactors
+        self.moviesPreferences = np.full(
+            shape=(numMovies, self.numLatentFactors),
+            fill_value=self.initializationValue,
+            dtype=float
+        )
+
+        # No baseline until compute_biases
+        self.globalMean = 0.0
+        self.userBiases = np.zeros(numUsers)
+        self.movieBiases = np.zeros(numMovies)
+
+        self.new_model_version()
+
+    def compute_biases(self, chunks):
+        """
+        Compute the baseline of the predictions from the ratings: global mean, then bias of every movie and then bias of
+        every user on what is left, each one regularized. Vectorized sums per chunk of ratings, so it runs over shards.
+        :param chunks: iterable of (user indexes, movie indexes, scores) of the ratings, read twice
+        """
+        numUsers, numMovies = len(self.usersPreferences), len(self.moviesPreferences)
+        self.userBiases = np.zeros(numUsers)
+        self.movieBiases = np.zeros(numMovies)
+        self.globalMean = 0.0
+
+        if not self.useBiases:
+            return
+
+        # Global mean and residual of every movie
+        total, count = 0.0, 0
+        movieSums, movieCounts = np.zeros(numMovies), np.zeros(numMovies)
+
+        for (_, movieIndexes, scores) in chunks:
+            total += float(np.sum(scores, dtype=np.float64))
+            count += len(scores)
+            movieSums += np.bincount(movieIndexes, weights=scores, minlength=numMovies)
+            movieCounts += np.bincount(movieIndexes, minlength=numMovies)
+
+        self.globalMean = total / max(count, 1)
+        self.movieBiases = (movieSums - self.globalMean * movieCounts) / (self.movieBiasRegularization + movieCounts)
+
+        # Residual of every user once the movie biases are removed
+        userSums, userCounts = np.zeros(numUsers), np.zeros(numUsers)
+
+        for (userIndexes, movieIndexes, scores) in chunks:
+            userSums += np.bincount(userIndexes, weights=scores - self.globalMean - self.movieBiases[movieIndexes],
+                                    minlength=numUsers)
+            userCounts += np.bincount(userIndexes, minlength=numUsers)
+
+        self.userBiases = userSums / (self.userBiasRegularization + userCounts)
+
+    def baseline(self, userIndexes, movieIndexes):
+        """
+        Baseline of the predictions of the given (user, movie) cells.
+        :param userIndexes: index of the user of each cell
+        :param movieIndexes: index of the movie of each cell
+        :return: array of baselines
+        """
+        return self.globalMean + self.userBiases[userIndexes] + self.movieBiases[movieIndexes]
+
+    def new_model_version(self):
+        """
+        Mark the factor matrices as replaced: cached recommendations of every user are dropped.
+        """
+        self.modelVersion += 1
+        self.recommendationCache.invalidate_all()
+
+    def initialize_similarities(self, k=None):
+        """
+        Load the similarities between movies from the artifact cache, or compute them from the tags of the movies.
+        :param k: number of similar movies stored for every movie. Defaults to cfg.similarNeighbors
+        """
+        k = k or cfg.similarNeighbors
+        self.movie_similarities = load_similarities(self.artifacts, k)
+
+        if self.movie_similarities is None:
+            print("Computing similarities between movies...")
+            self.movie_similarities = TagSimilarities.from_tags(self.ratingsMatrix.movieIds,
+                                                                self.movies.tags, k)
+            write_similarities(self.artifacts, self.movie_similarities)
+
+    def similar_movies(self, id_movie, n=10):
+        """
+        Movies most similar to the given one according to their tags.
+        :param id_movie: id of the movie
+        :param n: maximum number of movies, up to the number of similar movies stored
+        :return: list of (movie_id, title, similarity) sorted by descending similarity
+        """
+        if self.movie_similarities is None:
+            self.initialize_similarities()
+
+        return [(movie, self.movies[movie].get_title(), similarity)
+                for (movie, similarity) in self.movie_similarities.similar(id_movie, n)]
+
+    def initialize_item_index(self, rebuild=False):
+        """
+        Load the index of movies over moviesPreferences stored next to the model, or build it (see item_index).
+        :param rebuild: build the index even if it is stored
+        """
+        path = os.path.join(self.modelPath, "item_index") if self.modelPath is not None else None
+
+        if path is not None and model_store.exists(path) and not rebuild:
+            _, arrays = model_store.read_arrays(path, kind="item_index")
+            self.itemIndex = ItemIndex.from_arrays(arrays)
+            return
+
+        print("Building index of movies...")
+        self.itemIndex = ItemIndex.build(self.moviesPreferences)
+
+        # Store next to the model, so it is removed with it
+        if path is not None:
+            model_store.write_arrays(path, kind="item_index", arrays=self.itemIndex.to_arrays())
+
+    def similar_items(self, id_movie, n=10, exact=False):
+        """
+        Movies with the most similar latent factors to the given one.
+        :param id_movie: id of the movie
+        :param n: maximum number of movies
+        :param exact: compare against every movie instead of using the approximate index
+        :return: list of (movie_id, title, cosine similarity) sorted by descending similarity
+        """
+        if self.itemIndex is None:
+            self.initialize_item_index()
+
+        movieIndex = self.moviesIndexes[id_movie]
+
+        if exact:
+            indexes, similarities = self.itemIndex.search_exact(movieIndex, n)
+        else:
+            indexes, similarities = self.itemIndex.search(movieIndex, n, self.itemIndexProbes)
+
+        movieIds = self.ratingsMatrix.movieIds[indexes].tolist()
+
+        return [(movie, self.movies[movie].get_title(), float(similarity))
+                for movie, similarity in zip(movieIds, similarities)]
+
     def predict(self, user, movie):
         """
         Predict rating to the item for the given user.
@@ -87,129 +340,855 @@ class SVDNetflix:
         userPreferences = self.usersPreferences[userIndex, :]
         movieDescriptions = self.moviesPreferences[movieIndex, :]
 
-        # Perform scalar product for bot vectors
-        predictedRating = np.dot(userPreferences, movieDescriptions)
+        # Perform scalar product for bot vectors, over the baseline
+        predictedRating = self.baseline(userIndex, movieIndex) + np.dot(userPreferences, movieDescriptions)
 
         # Return predicted value
         return predictedRating
 
-    def train_system(self):
+    def train_system(self, engine=None, resume=False):
+        """
+        Method to train the SVD system using Stochastic Gradient Descent. SGD training writes a checkpoint every
+        cfg.checkpointInterval epochs in the artifact cache (see checkpoint).
+        :param engine: name of the engine that runs each epoch (see training.ENGINES), or "als" to train with
+        Alternating Least Squares instead (see als). Defaults to trainingEngine
+        :param resume: continue from the last checkpoint of a stopped training with the same data and parameters
+        """
+
+        engine = self.create_engine(engine)
+
+        # If latent factors are stored for the same data and parameters, not to train.
+        path = self.artifacts.lookup("model", self.model_key(engine.name))
+
+        if path is not None:
+            print("Trained model exists. Reading from disk...")
+            self.load_data(path)
+            return
+
+        # Hold out ratings to validate the training
+        if self.validationFraction > 0:
+            trainSet, validationSet = split_coordinates(self.ratingsCoordinates, self.validationFraction)
+        else:
+            trainSet, validationSet = self.ratingsCoordinates, None
+
+        if isinstance(engine, ALSSolver):
+            self.fit_als(trainSet, engine)
+
+            if validationSet is not None:
+                print("Validation RMSE: {:.5f}".format(self.rmse(validationSet)))
+        else:
+            checkpoints = None
+
+            if cfg.checkpointInterval > 0:
+                checkpoints = CheckpointManager(self.artifacts.path("checkpoint", self.model_key(engine.name)),
+                                                cfg.checkpointInterval, cfg.checkpointsKept)
+
+            self.fit(trainSet, engine, validationSet, checkpoints, resume)
+
+    def create_engine(self, name=None):
+        """
+        Create the engine that trains the system.
+        :param name: "als" for ALSSolver or the name of an SGD engine (see training.get_engine). Defaults to
+        trainingEngine
+        :return: engine object
+        """
+        from training import get_engine
+
+        name = name or self.trainingEngine
+
+        if name == ALSSolver.name:
+            return ALSSolver(numSweeps=self.alsSweeps, numWorkers=self.trainingWorkers)
+
+        return get_engine(name)
+
+    def engine_name(self, name=None):
+        """
+        Name of the engine create_engine would return, without importing training (and numba).
+        :param name: name of the engine. Defaults to trainingEngine
+        :return: name
+        """
+        name = name or self.trainingEngine
+
+        # Same choice as training.get_engine
+        if name == "auto":
+            return "numba" if importlib.util.find_spec("numba") is not None else "numpy"
+
+        return name
+
+    def fit_als(self, coordinates, solver):
+        """
+        Train every feature at once with Alternating Least Squares on the given ratings.
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings to train with
+        :param solver: ALSSolver object
+        """
+        self.trainingCoordinates = coordinates
+        self.compute_biases([coordinates])
+
+        # Factors fit what the baseline leaves
+        userIndexes, movieIndexes, scores = coordinates
+        residuals = (userIndexes, movieIndexes, scores - self.baseline(userIndexes, movieIndexes))
+
+        solver.fit(residuals, self.usersPreferences, self.moviesPreferences, self.regularizeParameter)
+        solver.close()
+
+        self.trainedEngine = solver.name
+        self.new_model_version()
+
+    def fit(self, coordinates, engine, validation=None, checkpoints=None, resume=False):
+        """
+        Train every feature, starting from the current values of the matrix, on the given ratings.
+
+        Training of a feature stops after numEpochs epochs or once the RMSE of the validation ratings (of the training
+        ratings if there is no validation set) improves less than convergenceTolerance. If the last epoch made it
+        worse, values of the previous epoch are kept. Metrics of every epoch are kept in trainingMetrics and appended
+        as JSON lines to trainingLog (cfg.trainingLog by default).
+
+        With checkpoints, the state of the training is saved every checkpoints.interval epochs: factor matrices, values
+        and residual caches of the feature being trained, next feature and epoch, learning rate, RMSE of the last
+        epoch and state of the NumPy random generator. Checkpoints are removed once every feature is trained.
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings to train with
+        :param engine: training engine object (see training)
+        :param validation: (user indexes, movie indexes, scores) of the ratings to validate with, or None
+        :param checkpoints: checkpoint.CheckpointManager object, or None not to write checkpoints
+        :param resume: continue from the last checkpoint instead of the first epoch, if there is one
+        """
+
+        # Coordinates of every rating
+        self.trainingCoordinates = coordinates
+        self.validationCoordinates = validation
+        userIndexes, movieIndexes, scores = coordinates
+
+        # Baseline of the predictions, so features only fit what it leaves
+        self.compute_biases([coordinates])
+
+        # Wall time of every epoch: (feature, epoch, seconds)
+        self.epochTimes = []
+        self.trainingMetrics = []
+
+        state = None
+
+        if checkpoints is not None:
+            state = checkpoints.latest() if resume else None
+
+            if state is None:
+                checkpoints.clear()
+            else:
+                state = self.restore_checkpoint(state, coordinates)
+
+        with open(self.trainingLog or os.devnull, 'a') as log:
+
+            # For each feature
+            for feature in range(state["feature"] if state else 0, self.numLatentFactors):
+
+                if state is not None:
+                    # Continue the feature being trained when the checkpoint was written
+                    userValue, movieValue = state["userValue"], state["movieValue"]
+                    learningRate, previousRmse, firstEpoch = state["learningRate"], state["previousRmse"], \
+                        state["epoch"]
+                    state = None
+                else:
+                    # Initialize cache for the first feature, then update it with the previous one
+                    if feature == 0:
+                        self.init_cache(feature)
+                    else:
+                        self.update_cache(feature - 1, feature)
+
+                    # Get user and movie values from users preferences and movie descriptions for this feature
+                    userValue = np.ascontiguousarray(self.usersPreferences[:, feature])
+                    movieValue = np.ascontiguousarray(self.moviesPreferences[:, feature])
+
+                    learningRate = self.learningRate
+                    previousRmse = np.inf
+                    firstEpoch = 0
+
+                # Value to fit with this feature for each rating
+                residuals = self.cache
+
+                # Train during numEpochs iterations at most
+                for epoch in range(firstEpoch, self.numEpochs):
+                    previousValues = (userValue.copy(), movieValue.copy())
+
+                    with instrumentation.stage("training.epoch", engine=engine.name, feature=feature,
+                                               epoch=epoch) as timed:
+                        errors = engine.run_epoch(userIndexes, movieIndexes, residuals, userValue, movieValue,
+                                                  learningRate, self.regularizeParameter)
+
+                    self.epochTimes.append((feature, epoch, timed.elapsed))
+
+                    metrics = {
+                        "engine": engine.name,
+                        "feature": feature,
+                        "epoch": epoch,
+                        "learningRate": learningRate,
+                        "trainRmse": root_mean_square(errors),
+                        "validationRmse": None,
+                        "seconds": timed.elapsed,
+                    }
+
+                    if validation is not None:
+                        validationUsers, validationMovies, _ = validation
+                        metrics["validationRmse"] = root_mean_square(
+                            self.validationCache - userValue[validationUsers] * movieValue[validationMovies])
+
+                    self.trainingMetrics.append(metrics)
+                    log.write(json.dumps(metrics) + "\n")
+
+                    print("Feature {} epoch {}: train RMSE {:.5f}, validation RMSE {} ({} engine, {:.3f}s)".format(
+                        feature + 1, epoch + 1, metrics["trainRmse"],
+                        "-" if validation is None else "{:.5f}".format(metrics["validationRmse"]),
+                        engine.name, timed.elapsed))
+
+                    # Stop when the RMSE does not improve enough
+                    rmse = metrics["trainRmse"] if validation is None else metrics["validationRmse"]
+
+                    if previousRmse - rmse < self.convergenceTolerance:
+                        if rmse > previousRmse:
+                            userValue[...], movieValue[...] = previousValues
+
+                        print("Feature {} converged after {} epochs".format(feature + 1, epoch + 1))
+                        break
+
+                    previousRmse = rmse
+                    learningRate *= self.learningRateDecay
+
+                    if checkpoints is not None and checkpoints.epoch_done():
+                        self.save_checkpoint(checkpoints, feature, epoch + 1, userValue, movieValue, learningRate,
+                                             previousRmse)
+
+                # Store trained values
+                self.usersPreferences[:, feature] = userValue
+                self.moviesPreferences[:, feature] = movieValue
+
+        # Release resources of the engine, such as worker processes
+        engine.close()
+
+        if checkpoints is not None:
+            checkpoints.clear()
+
+        self.trainedEngine = engine.name
+        self.new_model_version()
+
+    def save_checkpoint(self, checkpoints, feature, epoch, userValue, movieValue, learningRate, previousRmse):
+        """
+        Write the state of fit before an epoch.
+        :param checkpoints: checkpoint.CheckpointManager object
+        :param feature: feature being trained
+        :param epoch: next epoch of the feature
+        :param userValue: values of the users for the feature
+        :param movieValue: values of the movies for the feature
+        :param learningRate: learning rate of the next epoch
+        :param previousRmse: RMSE of the last epoch
+        """
+        keys, randomState = random_state()
+        arrays = {
+            "usersPreferences": self.usersPreferences,
+            "moviesPreferences": self.moviesPreferences,
+            "userValue": userValue,
+            "movieValue": movieValue,
+            "cache": self.cache,
+            "randomKeys": keys,
+        }
+
+        if self.validationCache is not None:
+            arrays["validationCache"] = self.validationCache
+
+        with instrumentation.stage("training.checkpoint", feature=feature, epoch=epoch):
+            path = checkpoints.save(arrays, {
+                "feature": feature,
+                "epoch": epoch,
+                "learningRate": learningRate,
+                "previousRmse": previousRmse,
+                "randomState": randomState,
+                "numRatings": len(self.cache),
+                "trainingMetrics": self.trainingMetrics,
+                "epochTimes": self.epochTimes,
+            })
+
+        print("Checkpoint written to {}".format(path))
+
+    def restore_checkpoint(self, checkpoint, coordinates):
         """
-        Method to train the SVD system using Stochastic Gradient Descent.
+        Restore the state of fit saved by save_checkpoint.
+        :param checkpoint: (metadata, arrays) returned by CheckpointManager.latest
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings being trained with
+        :return: dictionary with feature, epoch, userValue, movieValue, learningRate and previousRmse
+        """
+        metadata, arrays = checkpoint
+
+        if metadata["numRatings"] != len(coordinates[0]) or \
+                arrays["usersPreferences"].shape != self.usersPreferences.shape or \
+                arrays["moviesPreferences"].shape != self.moviesPreferences.shape:
+            raise model_store.FormatError("Checkpoint was written by a training with other ratings or factors")
+
+        self.usersPreferences[...] = arrays["usersPreferences"]
+        self.moviesPreferences[...] = arrays["moviesPreferences"]
+        self.cache = arrays["cache"]
+        self.validationCache = arrays.get("validationCache")
+        self.trainingMetrics = metadata["trainingMetrics"]
+        self.epochTimes = [tuple(times) for times in metadata["epochTimes"]]
+        set_random_state(arrays["randomKeys"], metadata["randomState"])
+
+        print("Resuming training at feature {} epoch {}".format(metadata["feature"] + 1, metadata["epoch"] + 1))
+
+        return dict(metadata, userValue=arrays["userValue"], movieValue=arrays["movieValue"])
+
+    def fit_shards(self, shards, engine=None):
         """
+        Train every feature with SGD over ratings stored in shards (see ingest), for datasets larger than memory. Every
+        epoch is a pass over the shards, memory-mapped one at a time, and the residual of every rating is kept in a
+        scratch column next to its shard, so memory holds the factor matrices and one shard.
+
+        Training of a feature stops after numEpochs epochs or once the training RMSE improves less than
+        convergenceTolerance. Factor matrices are created from the shape of the shards if they do not match it.
+        :param shards: ingest.RatingShards object
+        :param engine: training engine object (see training). Serial engines are expected. Defaults to trainingEngine
+        """
+        from training import get_engine
+
+        engine = engine or get_engine(self.trainingEngine)
+
+        if self.usersPreferences is None or self.usersPreferences.shape[0] != shards.shape[0] or \
+                self.moviesPreferences.shape[0] != shards.shape[1]:
+            self.init_factors(shards.shape)
+
+        self.compute_biases(shards)
+        self.shardUserIds, self.shardMovieIds = shards.userIds, shards.movieIds
+
+        residuals = shards.scratch("residuals")
+        self.epochTimes = []
 
-        # For each feature
         for feature in range(self.numLatentFactors):
 
-            # Initialize cache for this feature
-            self.init_cache(feature)
+            # Residuals of every feature but this one, shard by shard
+            for number, coordinates in enumerate(shards):
+                if feature == 0:
+                    residuals[number][...] = self.residuals(coordinates, feature)
+                else:
+                    residuals[number] -= self.feature_contribution(feature - 1, coordinates)
+                    residuals[number] += self.feature_contribution(feature, coordinates)
 
-            # If latent factors file exists, not to train.
-            if os.path.isfile(cfg.matrix):
-                self.load_data()
-                return
+            userValue = np.ascontiguousarray(self.usersPreferences[:, feature])
+            movieValue = np.ascontiguousarray(self.moviesPreferences[:, feature])
+
+            learningRate = self.learningRate
+            previousRmse = np.inf
 
-            # Train during numEpochs iterations
             for epoch in range(self.numEpochs):
-                print("Training epoch {} for feature {}".format(epoch + 1, feature + 1))
+                squaredErrors = 0.0
 
-                # Get user and movie values from users preferences and movie descriptions for this feature
-                userValue = self.usersPreferences[:, feature]
-                movieValue = self.moviesPreferences[:, feature]
+                with instrumentation.stage("training.epoch", engine=engine.name, feature=feature, epoch=epoch,
+                                           shards=len(shards)) as timed:
+                    for number, (userIndexes, movieIndexes, _) in enumerate(shards):
+                        errors = engine.run_epoch(userIndexes, movieIndexes, residuals[number], userValue, movieValue,
+                                                  learningRate, self.regularizeParameter)
+                        squaredErrors += float(np.sum(np.square(errors, dtype=np.float64)))
 
-                # errors
-                errors = []
+                rmse = float(np.sqrt(squaredErrors / max(shards.numRatings, 1)))
+                self.epochTimes.append((feature, epoch, timed.elapsed))
 
-                # Iterate throughout all ratings
-                for (user, movie) in self.ratingsTuples:
+                print("Feature {} epoch {}: train RMSE {:.5f} ({} shards, {:.3f}s)".format(
+                    feature + 1, epoch + 1, rmse, len(shards), timed.elapsed))
 
-                    # Retrieve user and movie indexes
-                    userIndex = self.userIndexes[user]
-                    movieIndex = self.moviesIndexes[movie]
+                if previousRmse - rmse < self.convergenceTolerance:
+                    print("Feature {} converged after {} epochs".format(feature + 1, epoch + 1))
+                    break
 
-                    # Predict
-                    predictedRating = self.predict_precalculated(user, movie, feature)
+                previousRmse = rmse
+                learningRate *= self.learningRateDecay
 
-                    # Calculate error
-                    err = self.ratingsTuples[(user, movie)] - predictedRating
-                    errors.append(err)
+            self.usersPreferences[:, feature] = userValue
+            self.moviesPreferences[:, feature] = movieValue
 
-                    # Perform Gradient Descent
-                    initialUserValue = userValue[userIndex] # To avoid that update on userValue modifies update on movieValue
-                    userValue[userIndex] += self.learningRate * (err * movieValue[movieIndex] - self.regularizeParameter * userValue[userIndex])
-                    movieValue[movieIndex] += self.learningRate * (err * initialUserValue - self.regularizeParameter * movieValue[movieIndex])
+        engine.close()
 
-                print("Avg error: {}".format(np.mean(errors)))
+        self.trainedEngine = engine.name
+        self.new_model_version()
 
-    def store_data(self):
-        data = (self.usersPreferences, self.moviesPreferences)
+    def hyperparameters(self):
+        """
+        Parameters of the training, stored with the model.
+        :return: dictionary
+        """
+        return {
+            "numLatentFactors": self.numLatentFactors,
+            "initializationValue": self.initializationValue,
+            "learningRate": self.learningRate,
+            "regularizeParameter": self.regularizeParameter,
+            "numEpochs": self.numEpochs,
+            "alsSweeps": self.alsSweeps,
+            "validationFraction": self.validationFraction,
+            "convergenceTolerance": self.convergenceTolerance,
+            "learningRateDecay": self.learningRateDecay,
+            "useBiases": self.useBiases,
+            "userBiasRegularization": self.userBiasRegularization,
+            "movieBiasRegularization": self.movieBiasRegularization,
+        }
 
-        with open(cfg.matrix, 'wb') as matrix:
-            pickle.dump(data, matrix)
+    def model_key(self, engineName=None):
+        """
+        Key of the model in the artifact cache: depends on the data, the hyperparameters and the training engine.
+        :param engineName: name of the training engine. Defaults to the one that trained the model, or trainingEngine
+        :return: key
+        """
+        engineName = engineName or self.trainedEngine or self.engine_name()
 
-    def load_data(self):
+        parameters = {
+            "dataset": self.datasetKey,
+            "hyperparameters": self.hyperparameters(),
+            "engine": engineName,
+        }
 
-        with open(cfg.matrix, 'rb') as matrix:
-            data = pickle.load(matrix)
+        # Ratings added online change the data the model was fitted to
+        if self.onlineUpdates > 0:
+            parameters["onlineUpdates"] = self.onlineUpdates
 
-        self.usersPreferences = data[0]
-        self.moviesPreferences = data[1]
+        return self.artifacts.key("model", parameters=parameters)
 
-    def init_cache(self, feature):
+    def store_data(self, path=None):
         """
-        This method is to precalculate ratings matrix except one feature. This will make the calculations faster.
-        :param user:
-        :param movie:
-        :return: predicted rating.
+        Store the model in binary format (see model_store): factor matrices, biases, ids of users and movies in index
+        order and hyperparameters. Ratings added by add_ratings are stored too, so the model loads back on top of the
+        same dataset.
+        :param path: model directory. Defaults to the entry of the model in the artifact cache
         """
+        key = None
 
-        # Extract arrays for user preferences and movie descriptions
-        userPreferencesModified = np.delete(self.usersPreferences, feature, axis=1)
-        movieDescriptionsModified = np.delete(self.moviesPreferences, feature, axis=1)
+        if path is None:
+            key = self.model_key()
+            path = self.artifacts.path("model", key)
+
+        # Model was loaded from this directory: nothing changed
+        if path == self.modelPath and model_store.exists(path):
+            return
 
-        # Perform scalar product for both matrix
-        precalculatedRatingMatrix = np.dot(userPreferencesModified, movieDescriptionsModified.T)
+        # Index of movies built from previous factors is not valid anymore
+        shutil.rmtree(os.path.join(path, "item_index"), ignore_errors=True)
 
-        # Store precalculated matrix
-        self.cache = precalculatedRatingMatrix
+        # Ids of the rows of the factor matrices: those of the shards if there are no ratings in memory
+        if self.ratingsMatrix is None:
+            userIds, movieIds = self.shardUserIds, self.shardMovieIds
+        else:
+            userIds, movieIds = self.ratingsMatrix.userIds, self.ratingsMatrix.movieIds
 
-    def predict_precalculated(self, user, movie, feature):
+        arrays = {
+            "usersPreferences": self.usersPreferences,
+            "moviesPreferences": self.moviesPreferences,
+            "userBiases": self.userBiases,
+            "movieBiases": self.movieBiases,
+            "userIds": userIds,
+            "movieIds": movieIds,
+        }
+        metadata = {"hyperparameters": self.hyperparameters(), "engine": self.trainedEngine,
+                    "globalMean": self.globalMean, "dataset": self.datasetKey}
+
+        # Ratings, users and movies added online: ids past the number of users and movies of the dataset are new
+        pending = self.ratingsMatrix.pending if self.ratingsMatrix is not None else None
+
+        if pending is not None:
+            arrays.update({
+                "onlineUserIndexes": pending["userIndexes"].array,
+                "onlineMovieIndexes": pending["movieIndexes"].array,
+                "onlineScores": pending["scores"].array,
+            })
+
+            newMovies = self.ratingsMatrix.movieIds[len(self.ratingsMatrix.ratingsData.movieIds):].tolist()
+            metadata["online"] = {
+                "numUsers": len(self.ratingsMatrix.ratingsData.userIds),
+                "numMovies": len(self.ratingsMatrix.ratingsData.movieIds),
+                "updates": self.onlineUpdates,
+                "titles": {str(movie): self.movies.titles.get(movie) for movie in newMovies},
+            }
+
+        with instrumentation.stage("model.store"):
+            model_store.write_arrays(path, kind="model", arrays=arrays, metadata=metadata)
+
+        if key is not None:
+            self.artifacts.commit("model", key)
+
+        self.modelPath = path
+
+    def load_data(self, path=None, mmapMode='r'):
         """
-        Accelerate predictions during training.
-        :param user:
-        :param movie:
+        Load a model stored by store_data. Factor matrices are memory-mapped read-only by default.
+        :param path: model directory. Defaults to the entry in the artifact cache for the current data and parameters
+        :param mmapMode: mode to memory-map the arrays, None to read them in memory
+        """
+        if path is None:
+            path = self.artifacts.lookup("model", self.model_key())
+
+            if path is None:
+                raise FileNotFoundError("No trained model for the current data and parameters")
+
+        with instrumentation.stage("model.load"):
+            metadata, arrays = model_store.read_arrays(path, kind="model", mmapMode=mmapMode)
+
+        # Indexes of the model must be the same as those of the ratings matrix
+        if self.ratingsMatrix is not None:
+            if "online" in metadata and self.ratingsMatrix.pending is None:
+                self.restore_online_ratings(metadata["online"], arrays)
+
+            if not (np.array_equal(arrays["userIds"], self.ratingsMatrix.userIds) and
+                    np.array_equal(arrays["movieIds"], self.ratingsMatrix.movieIds)):
+                raise model_store.FormatError("Model in {} was trained with other users or movies".format(path))
+
+        self.usersPreferences = arrays["usersPreferences"]
+        self.moviesPreferences = arrays["moviesPreferences"]
+
+        # Models stored before biases existed have no baseline
+        self.globalMean = metadata.get("globalMean", 0.0)
+        self.userBiases = arrays.get("userBiases", np.zeros(len(self.usersPreferences)))
+        self.movieBiases = arrays.get("movieBiases", np.zeros(len(self.moviesPreferences)))
+        self.modelHyperparameters = metadata["hyperparameters"]
+        self.trainedEngine = metadata["engine"]
+        self.modelPath = path
+        self.new_model_version()
+
+    def restore_online_ratings(self, online, arrays):
+        """
+        Append to the ratings matrix the ratings, users and movies added online to a stored model, if the model was
+        stored on top of the current dataset.
+        :param online: "online" metadata of the model
+        :param arrays: arrays of the model
+        """
+        numUsers, numMovies = online["numUsers"], online["numMovies"]
+
+        if not (np.array_equal(arrays["userIds"][:numUsers], self.ratingsMatrix.userIds) and
+                np.array_equal(arrays["movieIds"][:numMovies], self.ratingsMatrix.movieIds)):
+            return
+
+        newUsers = arrays["userIds"][numUsers:].tolist()
+        newMovies = arrays["movieIds"][numMovies:].tolist()
+
+        self.userIndexes.update(zip(newUsers, range(numUsers, numUsers + len(newUsers))))
+        self.moviesIndexes.update(zip(newMovies, range(numMovies, numMovies + len(newMovies))))
+        self.ratingsMatrix.append(arrays["onlineUserIndexes"], arrays["onlineMovieIndexes"], arrays["onlineScores"],
+                                  newUsers, newMovies)
+        self.ratingsCoordinates = None
+        self.movies.titles.update({int(movie): title for movie, title in online["titles"].items()})
+        self.onlineUpdates = online["updates"]
+
+    def add_ratings(self, user_ids, movie_ids, scores, titles=None):
+        """
+        Update the model with new ratings without retraining it. Unknown users and movies get the next indexes, and
+        the factor matrices grow in buffers whose capacity doubles, so adding rows is amortized.
+
+        Biases and factors of new movies are solved by least squares against the fixed biases and factors of their
+        users, then those of new users against the fixed ones of their movies (see als.solve_rows). Finally onlineSteps
+        steps of SGD over the new ratings adjust the factors of the users and movies they touch.
+        :param user_ids: id of the user of each rating
+        :param movie_ids: id of the movie of each rating
+        :param scores: score of each rating
+        :param titles: dictionary key=id_movie value=title of new movies
+        :return: indexes of the users whose recommendations changed
+        """
+        scores = np.asarray(scores, dtype=np.float32)
+        numUsers, numMovies = self.ratingsMatrix.shape
+
+        # Indexes of the ratings, assigning new ones to unknown users and movies
+        newUsers = [user for user in dict.fromkeys(user_ids) if user not in self.userIndexes]
+        newMovies = [movie for movie in dict.fromkeys(movie_ids) if movie not in self.moviesIndexes]
+
+        for index, user in enumerate(newUsers):
+            self.userIndexes[user] = numUsers + index
+
+        for index, movie in enumerate(newMovies):
+            self.moviesIndexes[movie] = numMovies + index
+
+        userIndexes = np.fromiter((self.userIndexes[user] for user in user_ids), dtype=np.int32, count=len(scores))
+        movieIndexes = np.fromiter((self.moviesIndexes[movie] for movie in movie_ids), dtype=np.int32,
+                                   count=len(scores))
+
+        self.ratingsMatrix.append(userIndexes, movieIndexes, scores, newUsers, newMovies)
+        instrumentation.count("online.ratings", len(scores), newUsers=len(newUsers), newMovies=len(newMovies))
+
+        # Coordinates are rebuilt when training reads them, not on every update
+        self.ratingsCoordinates = None
+
+        if titles:
+            self.movies.titles.update(titles)
+
+        self.grow_factors(len(newUsers), len(newMovies))
+
+        # Fold in new movies, then new users
+        self.fold_in(range(numMovies, numMovies + len(newMovies)), self.ratingsMatrix.movie_column,
+                     self.moviesPreferences, self.movieBiases, self.usersPreferences, self.userBiases,
+                     self.movieBiasRegularization)
+        self.fold_in(range(numUsers, numUsers + len(newUsers)), self.ratingsMatrix.user_row,
+                     self.usersPreferences, self.userBiases, self.moviesPreferences, self.movieBiases,
+                     self.userBiasRegularization)
+
+        # SGD steps over the new ratings, every feature at once
+        residuals = scores - self.baseline(userIndexes, movieIndexes)
+
+        for _ in range(self.onlineSteps):
+            users = self.usersPreferences[userIndexes]
+            movies = self.moviesPreferences[movieIndexes]
+            errors = residuals - np.einsum('ij,ij->i', users, movies)
+
+            np.add.at(self.usersPreferences, userIndexes, self.onlineLearningRate *
+                      (errors[:, None] * movies - self.regularizeParameter * users))
+            np.add.at(self.moviesPreferences, movieIndexes, self.onlineLearningRate *
+                      (errors[:, None] * users - self.regularizeParameter * movies))
+
+        # Model and index of movies do not match the stored ones anymore
+        self.onlineUpdates += len(scores)
+        self.itemIndex = None
+        self.modelPath = None
+
+        # New movies, and the SGD steps over the rows of the rated movies, change the scores of every user. Without
+        # them only the rows of the users who rated change
+        if newMovies or self.onlineSteps > 0:
+            self.new_model_version()
+        else:
+            self.recommendationCache.invalidate_users(dict.fromkeys(user_ids))
+
+        return np.unique(userIndexes)
+
+    def grow_factors(self, numNewUsers, numNewMovies):
+        """
+        Add rows of zeros to the factor matrices and biases. They are moved to growable buffers on the first call, which
+        also copies memory-mapped matrices to memory.
+        :param numNewUsers: number of rows added to usersPreferences and userBiases
+        :param numNewMovies: number of rows added to moviesPreferences and movieBiases
+        """
+        arrays = (self.usersPreferences, self.moviesPreferences, self.userBiases, self.movieBiases)
+
+        # Arrays replaced since the last call (trained or loaded again) are moved to new buffers
+        if self.factorBuffers is None or any(array.base is not buffer.buffer
+                                             for array, buffer in zip(arrays, self.factorBuffers)):
+            self.factorBuffers = tuple(AppendBuffer(array) for array in arrays)
+
+        usersBuffer, moviesBuffer, userBiasesBuffer, movieBiasesBuffer = self.factorBuffers
+        usersBuffer.append(np.zeros((numNewUsers,) + self.usersPreferences.shape[1:]))
+        moviesBuffer.append(np.zeros((numNewMovies,) + self.moviesPreferences.shape[1:]))
+        userBiasesBuffer.append(np.zeros(numNewUsers))
+        movieBiasesBuffer.append(np.zeros(numNewMovies))
+
+        self.usersPreferences = usersBuffer.array
+        self.moviesPreferences = moviesBuffer.array
+        self.userBiases = userBiasesBuffer.array
+        self.movieBiases = movieBiasesBuffer.array
+
+    def fold_in(self, indexes, ratings, factors, biases, fixed, fixedBiases, biasRegularization):
+        """
+        Solve the bias and the factors of some users or movies against the fixed ones of the other side.
+        :param indexes: range of indexes of the users or movies
+        :param ratings: function returning (indexes of the other side, scores) of a user or movie
+        :param factors: factor matrix of the side solved. Rows of indexes are overwritten
+        :param biases: biases of the side solved. Items of indexes are overwritten
+        :param fixed: factor matrix of the other side
+        :param fixedBiases: biases of the other side
+        :param biasRegularization: regularization of the biases solved
+        """
+        if len(indexes) == 0:
+            return
+
+        others, scores = zip(*(ratings(index) for index in indexes))
+        counts = np.array([len(row) for row in others])
+        indptr = np.zeros(len(indexes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+
+        # Bias: regularized mean of what the global mean and the biases of the other side leave
+        others = np.concatenate(others)
+        residuals = np.concatenate(scores).astype(np.float64) - self.globalMean - fixedBiases[others]
+        rows = np.repeat(np.arange(len(indexes)), counts)
+
+        if self.useBiases:
+            biases[indexes] = np.bincount(rows, weights=residuals, minlength=len(indexes)) / \
+                (biasRegularization + counts)
+
+        residuals -= biases[indexes][rows]
+
+        factors[indexes] = solve_rows(indptr, others, residuals, fixed, self.regularizeParameter, 0, len(indexes))
+
+    def predict_rated(self, userIndexes, movieIndexes, chunkSize=1000000):
+        """
+        Predict the ratings of the given (user, movie) cells with the baseline and every feature.
+        :param userIndexes: index of the user of each cell
+        :param movieIndexes: index of the movie of each cell
+        :param chunkSize: number of cells computed at once, to bound the size of the temporary arrays
+        :return: predicted rating of each cell
+        """
+        predictions = np.empty(len(userIndexes), dtype=np.float32)
+
+        for start in range(0, len(userIndexes), chunkSize):
+            end = start + chunkSize
+            predictions[start:end] = np.einsum('ij,ij->i',
+                                               self.usersPreferences[userIndexes[start:end]],
+                                               self.moviesPreferences[movieIndexes[start:end]])
+            predictions[start:end] += self.baseline(userIndexes[start:end], movieIndexes[start:end])
+
+        return predictions
+
+    def rmse(self, coordinates):
+        """
+        Root mean squared error of the predictions of the given ratings.
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings
+        :return: float
+        """
+        userIndexes, movieIndexes, scores = coordinates
+
+        return root_mean_square(scores - self.predict_rated(userIndexes, movieIndexes))
+
+    def feature_contribution(self, feature, coordinates=None):
+        """
+        Contribution of one feature to the prediction of every rating.
         :param feature:
-        :return:
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings. Defaults to the training ratings
+        :return: array aligned with the coordinates
         """
+        userIndexes, movieIndexes, _ = coordinates if coordinates is not None else self.trainingCoordinates
 
-        # Get user and movies indexes.
-        userIndex = self.userIndexes[user]
-        movieIndex = self.moviesIndexes[movie]
+        return self.usersPreferences[userIndexes, feature] * self.moviesPreferences[movieIndexes, feature]
 
-        # Get precalculated value
-        predictedRating = self.cache[userIndex, movieIndex]
+    def residuals(self, coordinates, feature):
+        """
+        Residual left in every rating by every feature except the given one. Only rated cells are computed.
+        :param coordinates: (user indexes, movie indexes, scores) of the ratings
+        :param feature:
+        :return: float32 array aligned with the coordinates
+        """
+        userIndexes, movieIndexes, scores = coordinates
 
-        # Calculate contribution from this feature to this rating
-        predictedRating += self.usersPreferences[userIndex, feature] * self.moviesPreferences[movieIndex, feature]
+        # Residual: rating minus the prediction of every feature but this one
+        residuals = scores - self.predict_rated(userIndexes, movieIndexes)
+        residuals += self.feature_contribution(feature, coordinates)
 
-        return predictedRating
+        return residuals
+
+    def init_cache(self, feature):
+        """
+        This method is to precalculate, for every training and validation rating, the residual left by every feature
+        except the given one.
+        :param feature: feature which is going to be trained
+        """
+        with instrumentation.stage("training.cache_build", feature=feature):
+            self.cache = self.residuals(self.trainingCoordinates, feature)
+
+            if self.validationCoordinates is not None:
+                self.validationCache = self.residuals(self.validationCoordinates, feature)
+
+    def update_cache(self, trainedFeature, nextFeature):
+        """
+        Move the caches from one feature to the next one once the first has been trained: subtract the new
+        contribution of the trained feature and add back the contribution of the next one.
+        :param trainedFeature: feature whose training has finished
+        :param nextFeature: feature which is going to be trained
+        """
+        with instrumentation.stage("training.cache_update", feature=nextFeature):
+            self.cache -= self.feature_contribution(trainedFeature)
+            self.cache += self.feature_contribution(nextFeature)
+
+            if self.validationCoordinates is not None:
+                self.validationCache -= self.feature_contribution(trainedFeature, self.validationCoordinates)
+                self.validationCache += self.feature_contribution(nextFeature, self.validationCoordinates)
 
     def query(self, user_id, query_limit=10):
-        not_seen = set(self.movies).difference(set([id_movie for (id_movie, rating) in self.users[user_id].get_ratings()]))
+        """
+        Recommend the movies with the highest predicted rating among those not rated yet by the user.
+        :param user_id: id of the user
+        :param query_limit: maximum number of movies to recommend
+        :return: list of (movie_id, title, predicted rating) sorted by descending predicted rating. Cached until the
+        model or the ratings of the user change
+        """
+        key = (self.modelVersion, user_id, query_limit)
+        recommendations = self.recommendationCache.get(key)
 
-        ranking = []
+        if recommendations is not None:
+            instrumentation.count("query.cache_hits")
+            return recommendations
 
-        for movie in not_seen:
-            rating = self.predict(user_id, movie)
-            ranking.append((movie, rating))
+        with instrumentation.stage("query"):
+            ranking, scores = self.top_movies(np.array([self.userIndexes[user_id]]), query_limit)
 
-        # Sort ranking
+            # Fewer movies than query_limit are left to the user
+            kept = ~np.isneginf(scores[0])
+            movieIds = self.ratingsMatrix.movieIds[ranking[0][kept]].tolist()
 
-        ranking = sorted(ranking, key=lambda x: x[1], reverse=True)
-        ranking = ranking[:10]
+            recommendations = [(movie, self.movies.titles.get(movie), score)
+                               for movie, score in zip(movieIds, scores[0][kept].tolist())]
+        self.recommendationCache.put(key, recommendations)
 
-        recommendation = ""
-        for movie in ranking:
-            recommendation += str(movie[0]) + ". " + self.movies[movie[0]].get_title() + ": " + str(movie[1]) + "\n"
+        return recommendations
+
+    def top_movies(self, rows, n, rated=None):
+        """
+        Best movies of some users among those they have not rated, predicted with one matrix product.
+        :param rows: indexes of the users
+        :param n: number of movies of every user
+        :param rated: sparse (users, movies) matrix of the movies to exclude. Defaults to the ratings matrix
+        :return: (movie indexes, predicted ratings) as (len(rows), min(n, number of movies)) arrays sorted by descending
+        rating. Positions past the movies left to a user have a rating of -inf
+        """
+        # Predictions for every movie
+        scores = self.usersPreferences[rows] @ self.moviesPreferences.T
+        scores += self.movieBiases[None, :] + (self.globalMean + self.userBiases[rows])[:, None]
+
+        # Mask rated movies using the rows of the sparse matrix
+        scores[self.ratingsMatrix.rows_coo(rows) if rated is None else rated[rows].nonzero()] = -np.inf
+
+        ranking = top_n(scores, n)
+
+        return ranking, np.take_along_axis(scores, ranking, axis=1)
+
+    def recommend_batch(self, user_ids, n=10, chunkSize=None, numThreads=1):
+        """
+        Recommend movies to many users at once. Users are processed in chunks: the predictions of a chunk are computed
+        with one matrix product, movies already rated are masked and the best n of every row are selected.
+        :param user_ids: ids of the users
+        :param n: number of movies to recommend to each user
+        :param chunkSize: number of users scored at once, which bounds memory to chunkSize * numMovies predictions.
+        Defaults to batchChunkSize
+        :param numThreads: number of threads processing chunks. Matrix products release the GIL
+        :return: (movie ids, predicted ratings) as (len(user_ids), n) int32 and float32 arrays. Rows of users with
+        less than n movies left to recommend are padded with -1 and -inf.
+        """
+
+        chunkSize = chunkSize or self.batchChunkSize
+        userIndexes = np.fromiter((self.userIndexes[user] for user in user_ids), dtype=np.int64, count=len(user_ids))
+        movieIds = self.ratingsMatrix.movieIds
+
+        n = min(n, len(movieIds))
+        recommendedMovies = np.empty((len(userIndexes), n), dtype=np.int32)
+        recommendedScores = np.empty((len(userIndexes), n), dtype=np.float32)
+
+        def recommend_chunk(start):
+            rows = userIndexes[start:start + chunkSize]
+            ranking, rankingScores = self.top_movies(rows, n)
+
+            recommendedMovies[start:start + len(rows)] = np.where(np.isneginf(rankingScores), -1, movieIds[ranking])
+            recommendedScores[start:start + len(rows)] = rankingScores
+
+        starts = range(0, len(userIndexes), chunkSize)
+
+        with instrumentation.stage("recommend_batch", users=len(userIndexes)):
+            if numThreads > 1:
+                with ThreadPoolExecutor(max_workers=numThreads) as pool:
+                    list(pool.map(recommend_chunk, starts))
+            else:
+                for start in starts:
+                    recommend_chunk(start)
+
+        return recommendedMovies, recommendedScores
+
+
+def root_mean_square(errors):
+    """
+    Root mean square of an array of errors.
+    :param errors: array
+    :return: float
+    """
+    return float(np.sqrt(np.mean(np.square(errors, dtype=np.float64))))
+
+
+def format_recommendations(recommendations):
+    """
+    Format the result of SVDNetflix.query as text, one movie per line.
+    :param recommendations: list of (movie_id, title, predicted rating). Title is None for movies without one
+    :return: string
+    """
+    recommendation = ""
+    for (movie, title, score) in recommendations:
+        recommendation += str(movie) + ". " + str(title) + ": " + str(score) + "\n"
 
-        return recommendation
+    return recommendation
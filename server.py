@@ -0,0 +1,399 @@
+"""
+Headless HTTP service over a trained model.
+
+The model is loaded read-only (memory-mapped) and served with asyncio. Every endpoint answers JSON to GET requests:
+
+ * /recommend?user=<id>&n=<count>: movies with the highest predicted rating not rated yet by the user
+ * /predict?user=<id>&movie=<id>: predicted rating of a movie by a user
+ * /similar?movie=<id>&n=<count>&exact=<0|1>: movies with the most similar latent factors (see item_index)
+ * /stats: counters of the recommendation cache (see recommendation_cache) and of the batches
+
+Concurrent recommend and predict requests arriving within cfg.batchWindow seconds are micro-batched: they are answered
+with a single call to SVDNetflix.recommend_batch or SVDNetflix.predict_rated, that is, one matrix product, run in a
+worker thread so the event loop keeps accepting requests. Recommendations cached by the system skip the batches.
+
+Run with: python server.py [--host HOST] [--port PORT]
+"""
+
+import argparse
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+import config as cfg
+import model_store
+
+# Reason phrases of the status codes sent
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    """
+    Error answered to the client with the given status code.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Group the items submitted within a time window and process them with a single call.
+    """
+
+    def __init__(self, function, window, maxSize):
+        """
+        :param function: function receiving a list of items and returning the list of their results. Run in a worker
+        thread
+        :param window: seconds to wait for more items after the first one of a batch
+        :param maxSize: maximum number of items of a batch
+        """
+        self.function = function
+        self.window = window
+        self.maxSize = maxSize
+        self.queue = None
+        self.task = None
+
+        # Number of batches and items processed
+        self.numBatches = 0
+        self.numItems = 0
+
+    async def submit(self, item):
+        """
+        Add an item to the next batch and wait for its result.
+        :param item: item passed to the function
+        :return: result of the item
+        """
+        if self.task is None:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.ensure_future(self.run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+
+        return await future
+
+    async def run(self):
+        """
+        Collect batches from the queue and process them, forever.
+        """
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+
+            while len(batch) < self.maxSize:
+                timeout = deadline - loop.time()
+
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            items, futures = zip(*batch)
+
+            try:
+                results = await loop.run_in_executor(None, self.function, list(items))
+            except Exception as error:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(error)
+                continue
+
+            self.numBatches += 1
+            self.numItems += len(items)
+
+            for future, result in zip(futures, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def close(self):
+        """
+        Stop processing batches.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+class RecommendationServer:
+    """
+    HTTP server answering the requests with a trained SVDNetflix system.
+    """
+
+    def __init__(self, system, window=None, maxBatchSize=None):
+        """
+        :param system: initialized SVDNetflix object with a trained model
+        :param window: seconds to wait for more requests before answering a batch. Defaults to cfg.batchWindow
+        :param maxBatchSize: maximum number of requests answered together. Defaults to cfg.maxBatchSize
+        """
+        self.system = system
+        window = cfg.batchWindow if window is None else window
+        maxBatchSize = maxBatchSize or cfg.maxBatchSize
+
+        self.recommendations = MicroBatcher(self.recommend_many, window, maxBatchSize)
+        self.predictions = MicroBatcher(self.predict_many, window, maxBatchSize)
+
+        self.routes = {
+            "/recommend": self.recommend,
+            "/predict": self.predict,
+            "/similar": self.similar,
+            "/stats": self.stats,
+        }
+
+    def recommend_many(self, requests):
+        """
+        Recommendations of a batch of requests with one call to recommend_batch. They are stored in the
+        recommendation cache of the system, as returned by SVDNetflix.query.
+        :param requests: list of (user_id, n)
+        :return: list of lists of (movie_id, title, predicted rating)
+        """
+        version = self.system.modelVersion
+        users = [user for (user, _) in requests]
+        titles = self.system.movies.titles
+        movies, scores = self.system.recommend_batch(users, max(n for (_, n) in requests))
+
+        results = []
+
+        for row, (user, n) in enumerate(requests):
+            recommendations = [(movie, titles.get(movie), score)
+                               for movie, score in zip(movies[row, :n].tolist(), scores[row, :n].tolist())
+                               if movie >= 0]
+            self.system.recommendationCache.put((version, user, n), recommendations)
+            results.append(recommendations)
+
+        return results
+
+    def predict_many(self, requests):
+        """
+        Predictions of a batch of requests with one call to predict_rated.
+        :param requests: list of (user index, movie index)
+        :return: list of predicted ratings
+        """
+        userIndexes, movieIndexes = (np.asarray(column) for column in zip(*requests))
+
+        return self.system.predict_rated(userIndexes, movieIndexes).tolist()
+
+    def user_index(self, user):
+        """
+        Index of a user, answering 404 if it is unknown.
+        """
+        if user not in self.system.userIndexes:
+            raise HTTPError(404, "Unknown user {}".format(user))
+
+        return self.system.userIndexes[user]
+
+    def movie_index(self, movie):
+        """
+        Index of a movie, answering 404 if it is unknown.
+        """
+        if movie not in self.system.moviesIndexes:
+            raise HTTPError(404, "Unknown movie {}".format(movie))
+
+        return self.system.moviesIndexes[movie]
+
+    async def recommend(self, parameters):
+        """
+        /recommend endpoint.
+        :param parameters: dictionary returned by parse_qs
+        """
+        user = integer_parameter(parameters, "user")
+        n = integer_parameter(parameters, "n", 10, minimum=0)
+        self.user_index(user)
+
+        # Hot users are answered from the cache without joining a batch
+        recommendations = self.system.recommendationCache.get((self.system.modelVersion, user, n))
+
+        if recommendations is None:
+            recommendations = await self.recommendations.submit((user, n))
+
+        return {"user": user,
+                "movies": [{"movie": movie, "title": title, "score": score}
+                           for (movie, title, score) in recommendations]}
+
+    async def predict(self, parameters):
+        """
+        /predict endpoint.
+        :param parameters: dictionary returned by parse_qs
+        """
+        user = integer_parameter(parameters, "user")
+        movie = integer_parameter(parameters, "movie")
+
+        score = await self.predictions.submit((self.user_index(user), self.movie_index(movie)))
+
+        return {"user": user, "movie": movie, "score": score}
+
+    async def similar(self, parameters):
+        """
+        /similar endpoint.
+        :param parameters: dictionary returned by parse_qs
+        """
+        movie = integer_parameter(parameters, "movie")
+        n = integer_parameter(parameters, "n", 10, minimum=0)
+        exact = integer_parameter(parameters, "exact", 0) != 0
+        self.movie_index(movie)
+
+        similar = self.system.similar_items(movie, n, exact)
+
+        return {"movie": movie,
+                "movies": [{"movie": other, "title": title, "similarity": similarity}
+                           for (other, title, similarity) in similar]}
+
+    async def stats(self, parameters):
+        """
+        /stats endpoint: counters of the recommendation cache and of the batches.
+        :param parameters: dictionary returned by parse_qs
+        """
+        return {
+            "modelVersion": self.system.modelVersion,
+            "cache": self.system.recommendationCache.stats(),
+            "batches": {name: {"batches": batcher.numBatches, "requests": batcher.numItems}
+                        for name, batcher in (("recommend", self.recommendations), ("predict", self.predictions))},
+        }
+
+    async def handle(self, reader, writer):
+        """
+        Answer the requests of a connection until the client closes it. Connections are kept alive.
+        """
+        try:
+            while True:
+                requestLine = await reader.readline()
+
+                if not requestLine:
+                    break
+
+                # Headers are read and ignored: only GET requests without body are served
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+
+                status, body = await self.dispatch(requestLine.decode("latin-1"))
+                payload = json.dumps(body).encode()
+
+                writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n".format(
+                    status, REASONS[status], len(payload)).encode() + payload)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, requestLine):
+        """
+        Route a request to its endpoint.
+        :param requestLine: first line of the HTTP request
+        :return: (status code, JSON serializable body)
+        """
+        try:
+            method, target, _ = requestLine.split(" ", 2)
+
+            if method != "GET":
+                raise HTTPError(405, "Only GET requests are served")
+
+            url = urlsplit(target)
+
+            if url.path not in self.routes:
+                raise HTTPError(404, "Unknown endpoint {}".format(url.path))
+
+            return 200, await self.routes[url.path](parse_qs(url.query))
+        except HTTPError as error:
+            return error.status, {"error": str(error)}
+        except ValueError:
+            return 400, {"error": "Malformed request"}
+        except Exception as error:
+            return 500, {"error": repr(error)}
+
+    async def serve(self, host, port):
+        """
+        Accept connections until cancelled.
+        :param host: interface to listen on
+        :param port: TCP port
+        """
+        server = await asyncio.start_server(self.handle, host, port)
+        print("Serving on http://{}:{}".format(host, port))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.recommendations.close()
+            self.predictions.close()
+
+
+def integer_parameter(parameters, name, default=None, minimum=None):
+    """
+    Read an integer from the query string.
+    :param parameters: dictionary returned by parse_qs
+    :param name: name of the parameter
+    :param default: value if it is missing, None if it is required
+    :param minimum: smallest value accepted, None to accept any
+    :return: int
+    """
+    if name not in parameters:
+        if default is None:
+            raise HTTPError(400, "Missing parameter {}".format(name))
+
+        return default
+
+    try:
+        value = int(parameters[name][0])
+    except ValueError:
+        raise HTTPError(400, "Parameter {} must be an integer".format(name))
+
+    if minimum is not None and value < minimum:
+        raise HTTPError(400, "Parameter {} must be at least {}".format(name, minimum))
+
+    return value
+
+
+def load_system(path=None, datasetPath=None, itemIndex=False):
+    """
+    Read the data and load a trained model, memory-mapped read-only. Given a model directory, the data is the dataset
+    the model was trained on, read from the artifact cache without reading the csv files.
+    :param path: model directory. Defaults to the model for the current parameters in the artifact cache
+    :param datasetPath: dataset directory (see data.load_dataset). Defaults to the dataset of the model
+    :param itemIndex: load or build the index of movies now, so the first /similar request does not wait for it.
+    Otherwise it is built by the first call to similar_items
+    :return: SVDNetflix object
+    """
+    from recommender_system import SVDNetflix
+
+    system = SVDNetflix()
+
+    # Models stored without the key of their dataset are loaded on top of the current csv files
+    if path is not None and datasetPath is None:
+        datasetKey = model_store.read_header(path)["metadata"].get("dataset")
+
+        if datasetKey is not None:
+            datasetPath = system.artifacts.lookup("dataset", datasetKey)
+
+            if datasetPath is None:
+                raise FileNotFoundError("Dataset {} of the model in {} is not in the artifact cache".format(
+                    datasetKey, path))
+
+    system.initialize_system(datasetPath)
+    system.load_data(path, mmapMode='r')
+
+    if itemIndex:
+        system.initialize_item_index()
+
+    return system
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve recommendations of a trained model over HTTP")
+    parser.add_argument("--host", default=cfg.serverHost)
+    parser.add_argument("--port", type=int, default=cfg.serverPort)
+    arguments = parser.parse_args()
+
+    try:
+        asyncio.run(RecommendationServer(load_system(itemIndex=True)).serve(arguments.host, arguments.port))
+    except KeyboardInterrupt:
+        pass
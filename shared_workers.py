@@ -0,0 +1,87 @@
+"""
+Pool of worker processes attached to arrays in shared memory (multiprocessing.shared_memory), so workers read and update
+them in place without copies. Used by the parallel SGD engines (parallel_training) and the ALS solver (als).
+
+Arrays are copied once to shared memory when the pool starts, and every worker attaches to them before running its own
+initializer. Tasks find them in workerArrays, and the parent process in SharedWorkers.arrays.
+"""
+
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# Arrays attached by every worker process: dictionary key=name value=numpy array in shared memory
+workerArrays = {}
+_workerMemory = []
+
+
+def _attach_worker(descriptions, initializer, initargs):
+    """
+    Initializer of the worker processes: attach to the shared arrays, then run the initializer of the caller.
+    :param descriptions: dictionary key=name value=(shared memory name, shape, dtype)
+    :param initializer: function run by every worker once attached, None to run nothing
+    :param initargs: arguments of initializer
+    """
+    for name, (memoryName, shape, dtype) in descriptions.items():
+        memory = shared_memory.SharedMemory(name=memoryName)
+        _workerMemory.append(memory)
+        workerArrays[name] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+
+    if initializer is not None:
+        initializer(*initargs)
+
+
+class SharedWorkers:
+    """
+    Pool of worker processes attached to arrays in shared memory.
+    """
+
+    def __init__(self, arrays, numWorkers, initializer=None, initargs=()):
+        """
+        Copy the arrays to shared memory and start the workers.
+        :param arrays: dictionary key=name value=numpy array
+        :param numWorkers: number of processes
+        :param initializer: function run by every worker once attached to the arrays, None to run nothing
+        :param initargs: arguments of initializer
+        """
+        self.memory = []
+        self.arrays = {}
+        descriptions = {}
+
+        for name, array in arrays.items():
+            memory = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared = np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)
+            shared[...] = array
+
+            self.memory.append(memory)
+            self.arrays[name] = shared
+            descriptions[name] = (memory.name, array.shape, array.dtype.str)
+
+        self.pool = multiprocessing.get_context().Pool(processes=numWorkers, initializer=_attach_worker,
+                                                       initargs=(descriptions, initializer, initargs))
+
+    def map(self, function, tasks):
+        """
+        Run a function over every task in the workers and wait for all of them.
+        :param function: module level function, which reads the shared arrays from workerArrays
+        :param tasks: iterable of arguments of function
+        :return: list of results
+        """
+        return self.pool.map(function, tasks)
+
+    def close(self):
+        """
+        Stop the workers and free the shared memory.
+        """
+        self.pool.close()
+        self.pool.join()
+
+        # Views must be released before closing the memory
+        self.arrays = {}
+
+        for memory in self.memory:
+            memory.close()
+            memory.unlink()
+
+        self.memory = []
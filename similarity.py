@@ -0,0 +1,146 @@
+"""
+Content-based similarities between movies computed from their tags.
+
+Every movie is described by a TF-IDF vector over the tags it received, normalized to unit length, so the cosine
+similarity between two movies is the dot product of their vectors. The k most similar movies of every movie are found
+by multiplying blocks of rows of the sparse TF-IDF matrix by the whole matrix, so a full movies * movies matrix is
+never created. Neighbors are stored as two (movies, k) arrays: indexes of the neighbors and their similarities.
+"""
+
+import numpy as np
+from scipy import sparse
+
+from ranking import top_n
+
+
+def tfidf_matrix(movieIndexes, tags, numMovies):
+    """
+    Create the TF-IDF matrix of the tags.
+    :param movieIndexes: index of the movie of each tag occurrence
+    :param tags: text of each tag occurrence. Every distinct tag (case insensitive) is a term
+    :param numMovies: number of movies
+    :return: sparse CSR matrix movies * terms with rows of unit length (or empty rows for movies without tags)
+    """
+    import pandas as pd
+
+    terms, vocabulary = pd.factorize(pd.Series(tags, dtype=object).str.strip().str.lower())
+
+    # Term frequencies: repeated (movie, term) pairs are summed
+    frequencies = sparse.csr_matrix((np.ones(len(terms), dtype=np.float32), (movieIndexes, terms)),
+                                    shape=(numMovies, len(vocabulary)))
+    frequencies.sum_duplicates()
+
+    # Smoothed inverse document frequency
+    documentFrequencies = np.bincount(frequencies.indices, minlength=len(vocabulary))
+    idf = np.log((1.0 + numMovies) / (1.0 + documentFrequencies)) + 1.0
+
+    tfidf = frequencies.multiply(idf.astype(np.float32)).tocsr()
+
+    # Normalize rows so that dot products are cosine similarities
+    norms = np.sqrt(np.asarray(tfidf.multiply(tfidf).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+
+    return sparse.diags(1.0 / norms).dot(tfidf).tocsr().astype(np.float32)
+
+
+def top_k_neighbors(matrix, k, blockSize=1024):
+    """
+    Find the k rows most similar to every row of a matrix with rows of unit length.
+    :param matrix: sparse CSR matrix
+    :param k: number of neighbors of every row
+    :param blockSize: number of rows compared at once against the whole matrix
+    :return: (neighbors, similarities) as (rows, k) int32 and float32 arrays. Neighbors with no similarity are -1
+    """
+    numRows = matrix.shape[0]
+    k = min(k, max(numRows - 1, 0))
+
+    neighbors = np.full((numRows, k), -1, dtype=np.int32)
+    similarities = np.zeros((numRows, k), dtype=np.float32)
+    transposed = matrix.T.tocsc()
+
+    for start in range(0, numRows, blockSize):
+        end = min(start + blockSize, numRows)
+
+        block = (matrix[start:end] @ transposed).toarray()
+
+        # A movie is not its own neighbor
+        block[np.arange(end - start), np.arange(start, end)] = -np.inf
+
+        best = top_n(block, k)
+        bestSimilarities = np.take_along_axis(block, best, axis=1)
+        found = bestSimilarities > 0
+
+        neighbors[start:end] = np.where(found, best, -1)
+        similarities[start:end] = np.where(found, bestSimilarities, 0)
+
+    return neighbors, similarities
+
+
+class TagSimilarities:
+    """
+    k most similar movies of every movie according to their tags.
+    """
+
+    def __init__(self, movieIds, neighbors, similarities):
+        """
+        :param movieIds: id of every movie in index order
+        :param neighbors: (movies, k) array of indexes of the neighbors of every movie, -1 when there is no neighbor
+        :param similarities: (movies, k) array of cosine similarities of the neighbors
+        """
+        self.movieIds = np.asarray(movieIds)
+        self.neighbors = neighbors
+        self.similarities = similarities
+        self.moviesIndexes = dict(zip(self.movieIds.tolist(), range(len(self.movieIds))))
+
+    @classmethod
+    def from_tags(cls, movieIds, tags, k=20, blockSize=1024):
+        """
+        Compute the similarities from the tags of every movie.
+        :param movieIds: id of every movie in index order
+        :param tags: dictionary key=id_movie value=list of tags
+        :param k: number of neighbors of every movie
+        :param blockSize: number of movies compared at once
+        :return: TagSimilarities object
+        """
+        movieIds = np.asarray(movieIds)
+        moviesIndexes = dict(zip(movieIds.tolist(), range(len(movieIds))))
+
+        movieIndexes, texts = [], []
+        for movie, movie_tags in tags.items():
+            if movie in moviesIndexes:
+                movieIndexes.extend([moviesIndexes[movie]] * len(movie_tags))
+                texts.extend(movie_tags)
+
+        matrix = tfidf_matrix(np.asarray(movieIndexes, dtype=np.int64), texts, len(movieIds))
+        neighbors, similarities = top_k_neighbors(matrix, k, blockSize)
+
+        return cls(movieIds, neighbors, similarities)
+
+    def to_arrays(self):
+        """
+        Arrays to be stored on disk.
+        :return: dictionary key=name value=array
+        """
+        return {"movieIds": self.movieIds, "neighbors": self.neighbors, "similarities": self.similarities}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Build the object from the arrays returned by to_arrays. Arrays are not copied, so they can be memory-mapped.
+        :param arrays: dictionary key=name value=array
+        :return: TagSimilarities object
+        """
+        return cls(arrays["movieIds"], arrays["neighbors"], arrays["similarities"])
+
+    def similar(self, id_movie, n=10):
+        """
+        Movies most similar to the given one.
+        :param id_movie: id of the movie
+        :param n: maximum number of movies
+        :return: list of (id_movie, similarity) sorted by descending similarity
+        """
+        index = self.moviesIndexes[id_movie]
+        neighbors = self.neighbors[index, :n]
+        found = neighbors >= 0
+
+        return list(zip(self.movieIds[neighbors[found]].tolist(), self.similarities[index, :n][found].tolist()))
@@ -0,0 +1,194 @@
+"""
+Engines to run the epochs of Stochastic Gradient Descent used to train one feature of the SVD system.
+
+Every engine receives the ratings as contiguous arrays: user index and movie index of each rating (int32) and the
+residual of each rating (float32), that is, the score minus the contribution of every other feature. The values of
+the feature being trained for users and movies are updated in place.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+class ReferenceEngine:
+    """
+    Pure Python loop over every rating. Slow, kept as the reference implementation for the other engines.
+    """
+
+    name = "reference"
+
+    def run_epoch(self, userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate,
+                  regularizeParameter):
+        """
+        Run one epoch of SGD over every rating.
+        :param userIndexes: user index of each rating
+        :param movieIndexes: movie index of each rating
+        :param residuals: value to fit for each rating with this feature
+        :param userValue: values of this feature for every user. Updated in place
+        :param movieValue: values of this feature for every movie. Updated in place
+        :param learningRate: step of the gradient descent
+        :param regularizeParameter: regularization of the values
+        :return: error of each rating, computed before its update
+        """
+        errors = []
+
+        for (userIndex, movieIndex, residual) in zip(userIndexes.tolist(), movieIndexes.tolist(), residuals.tolist()):
+
+            # Calculate error
+            err = residual - userValue[userIndex] * movieValue[movieIndex]
+            errors.append(err)
+
+            # Perform Gradient Descent
+            initialUserValue = userValue[userIndex] # To avoid that update on userValue modifies update on movieValue
+            userValue[userIndex] += learningRate * (err * movieValue[movieIndex] - regularizeParameter * userValue[userIndex])
+            movieValue[movieIndex] += learningRate * (err * initialUserValue - regularizeParameter * movieValue[movieIndex])
+
+        return np.asarray(errors, dtype=np.float32)
+
+    def close(self):
+        """
+        Release the resources of the engine. Nothing to release.
+        """
+        pass
+
+
+class NumpyEngine:
+    """
+    Minibatch gradient descent with NumPy. Gradients of the ratings in a batch are computed at once from the values at
+    the beginning of the batch and accumulated per user and movie, so results differ slightly from sequential SGD.
+    Ratings are visited in a fixed random order so that a batch does not hold many ratings of the same user.
+    """
+
+    name = "numpy"
+
+    def __init__(self, batchSize=65536, seed=0):
+        """
+        :param batchSize: number of ratings in each minibatch
+        :param seed: seed of the random order of the ratings
+        """
+        self.batchSize = batchSize
+        self.seed = seed
+        self.order = None
+
+    def run_epoch(self, userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate,
+                  regularizeParameter):
+        """
+        Run one epoch of minibatch gradient descent. Same parameters as ReferenceEngine.run_epoch
+        """
+        numRatings = len(residuals)
+
+        if self.order is None or len(self.order) != numRatings:
+            self.order = np.random.RandomState(self.seed).permutation(numRatings)
+
+        userIndexes = userIndexes[self.order]
+        movieIndexes = movieIndexes[self.order]
+        residuals = residuals[self.order]
+
+        errors = np.empty(numRatings, dtype=np.float32)
+
+        for start in range(0, numRatings, self.batchSize):
+            end = min(start + self.batchSize, numRatings)
+            users = userIndexes[start:end]
+            movies = movieIndexes[start:end]
+
+            # Values at the beginning of the batch
+            userValues = userValue[users]
+            movieValues = movieValue[movies]
+
+            err = residuals[start:end] - userValues * movieValues
+            errors[start:end] = err
+
+            # Accumulate gradients of every rating on its user and movie
+            userValue += learningRate * np.bincount(users, weights=err * movieValues - regularizeParameter * userValues,
+                                                    minlength=len(userValue))
+            movieValue += learningRate * np.bincount(movies, weights=err * userValues - regularizeParameter * movieValues,
+                                                     minlength=len(movieValue))
+
+        # Return errors in the original order of the ratings
+        errors[self.order] = errors.copy()
+
+        return errors
+
+    def close(self):
+        """
+        Release the resources of the engine. Nothing to release.
+        """
+        pass
+
+
+if numba is not None:
+
+    @numba.njit(cache=True, nogil=True)
+    def _sgd_epoch(userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate, regularizeParameter,
+                   errors):
+        for i in range(residuals.shape[0]):
+            userIndex = userIndexes[i]
+            movieIndex = movieIndexes[i]
+
+            err = residuals[i] - userValue[userIndex] * movieValue[movieIndex]
+            errors[i] = err
+
+            initialUserValue = userValue[userIndex]
+            userValue[userIndex] += learningRate * (err * movieValue[movieIndex] - regularizeParameter * userValue[userIndex])
+            movieValue[movieIndex] += learningRate * (err * initialUserValue - regularizeParameter * movieValue[movieIndex])
+
+
+class NumbaEngine:
+    """
+    Sequential SGD compiled with numba. Same updates, in the same order, as ReferenceEngine.
+    """
+
+    name = "numba"
+
+    def __init__(self):
+        if numba is None:
+            raise ImportError("numba is required to use the numba training engine")
+
+    def run_epoch(self, userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate,
+                  regularizeParameter):
+        """
+        Run one epoch of sequential SGD. Same parameters as ReferenceEngine.run_epoch
+        """
+        errors = np.empty(len(residuals), dtype=np.float32)
+        _sgd_epoch(userIndexes, movieIndexes, residuals, userValue, movieValue, learningRate, regularizeParameter,
+                   errors)
+
+        return errors
+
+    def close(self):
+        """
+        Release the resources of the engine. Nothing to release.
+        """
+        pass
+
+
+# Available engines by name
+ENGINES = {
+    ReferenceEngine.name: ReferenceEngine,
+    NumpyEngine.name: NumpyEngine,
+    NumbaEngine.name: NumbaEngine,
+}
+
+
+def get_engine(name="auto"):
+    """
+    Create a training engine.
+    :param name: name of the engine in ENGINES (serial engines, or "hogwild" and "dsgd" from parallel_training),
+    or "auto" to use numba when installed and NumPy otherwise
+    :return: engine object
+    """
+    if name == "auto":
+        name = NumbaEngine.name if numba is not None else NumpyEngine.name
+
+    # Parallel engines register themselves when their module is imported
+    if name not in ENGINES:
+        import parallel_training
+
+    if name not in ENGINES:
+        raise ValueError("Unknown training engine: {}. Available: {}".format(name, ", ".join(ENGINES)))
+
+    return ENGINES[name]()